@@ -1,8 +1,34 @@
 from django.contrib import admin
 
-from .models import AircraftType, Airstrip, Checkout
+from .models import AircraftType, Airstrip, Checkout, DailyUsage, SlowQuery
 
 admin.site.register(AircraftType)
 admin.site.register(Airstrip)
 admin.site.register(Checkout)
 
+
+class SlowQueryAdmin(admin.ModelAdmin):
+    """Read-only view of the statements recorded by the SlowQueries middleware"""
+    list_display = ('created', 'view', 'duration', 'path')
+    list_filter = ('view',)
+    readonly_fields = ('created', 'view', 'path', 'duration', 'sql', 'stack', 'plan')
+    fields = readonly_fields
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(SlowQuery, SlowQueryAdmin)
+
+
+class DailyUsageAdmin(admin.ModelAdmin):
+    """Read-only view of the rollups made by the rollup_analytics command"""
+    list_display = ('date', 'route', 'requests', 'users', 'client_errors', 'server_errors', 'slowest')
+    list_filter = ('route',)
+    date_hierarchy = 'date'
+    readonly_fields = ('date', 'route', 'requests', 'users', 'ips', 'client_errors', 'server_errors', 'slowest')
+    fields = readonly_fields
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(DailyUsage, DailyUsageAdmin)
@@ -0,0 +1,223 @@
+"""Reading the analytics log written by checkouts.middleware.Analytics
+
+Nothing in this module depends on Django, so the scripts in scripts/utilities
+can use it to process copies of the logs away from the server (with the
+cotracker directory on the PYTHONPATH).
+"""
+import collections
+import datetime
+import functools
+import gzip
+import json
+import re
+
+
+# Column order for tabular exports of the log (e.g. analytics_to_csv.py)
+FIELDS = [
+    'date', 'time', 'pid', 'level', 'username', 'ip', 'method', 'path',
+    'queue', 'real', 'mw', 'view', 'tpl', 'db', 'queries',
+    'status', 'bytes', 'useragent',
+]
+
+MILLISECOND_FIELDS = frozenset(['queue', 'real', 'mw', 'view', 'tpl', 'db'])
+INTEGER_FIELDS = frozenset(['bytes', 'queries'])
+
+# 2019-08-01T11:49:05+0000 [1234]: at=INFO client=kim@10.0.0.1 ... useragent="..."
+# The useragent is always last and is the only value which may contain spaces,
+# so it's split off before the rest of the line is tokenized.
+PREFIX = re.compile(r'(\S+) \[(\d+)\]: (.*)$')
+PAIR = re.compile(r'(\w+)=(\S*)')
+USERAGENT = ' useragent="'
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+# With ANALYTICS_LOG_FORMAT = 'json', each line is instead an object with
+# the keys of a parsed record (less 'date' and 'time') plus the schema
+# version 'v'. pid and status are numbers rather than strings:
+# {"v": 1, "timestamp": "2019-08-01T11:49:05+0000", "pid": 1234, "level": "INFO",
+#  "username": "kim", "ip": "10.0.0.1", "method": "GET", "path": "/checkouts/",
+#  "queue": 3, "real": 45, "mw": 2, "view": 30, "tpl": 13, "db": 20,
+#  "queries": 7, "status": 200, "bytes": 5120, "useragent": "..."}
+JSON_SCHEMA_VERSION = 1
+
+# Paths -> the view (or area) which served them, mirroring cotracker/urls.py,
+# so that e.g. every /pilots/<username>/ request is reported as PilotDetail
+ROUTES = [(re.compile(pattern), name) for pattern, name in [
+    (r'^/$',                            'home'),
+    (r'^/login/$',                      'login'),
+    (r'^/logout/$',                     'logout'),
+    (r'^/password_change/(done/)?$',    'password_change'),
+    (r'^/emerald/profiles/$',           'ProfileList'),
+    (r'^/emerald/profiles/[\w-]+/$',    'ProfileDetail'),
+    (r'^/emerald/usage/$',              'UsageDashboard'),
+    (r'^/emerald/dbstats/$',            'DatabaseStats'),
+    (r'^/emerald/',                     'admin'),
+    (r'^/pilots/$',                     'PilotList'),
+    (r'^/pilots/\w+/$',                 'PilotDetail'),
+    (r'^/airstrips/$',                  'AirstripList'),
+    (r'^/airstrips/\w+/$',              'AirstripDetail'),
+    (r'^/bases/$',                      'BaseList'),
+    (r'^/bases/\w+/attached/$',         'BaseAttachedDetail'),
+    (r'^/bases/\w+/unattached/$',       'BaseUnattachedDetail'),
+    (r'^/bases/\w+/edit/$',             'BaseEditAttached'),
+    (r'^/checkouts/$',                  'FilterFormView'),
+    (r'^/checkouts/edit/$',             'CheckoutEditFormView'),
+    (r'^/weights/$',                    'WeightList'),
+    (r'^/weights/\w+/edit/$',           'WeightEdit'),
+    (r'^/static/',                      'static'),
+]]
+
+
+def open_log(filename):
+    """Opens a log for reading text, decompressing it if it was gzipped (as
+    rotated logs are)."""
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(filename, 'rt', encoding='utf-8', errors='replace')
+    return open(filename, 'r', encoding='utf-8', errors='replace')
+
+
+def parse_line(line):
+    """Returns a dictionary of the fields in an analytics log line, or None if
+    the line isn't in the expected format. Lines may be text or JSON."""
+    if line.startswith('{'):
+        return parse_json_line(line)
+    head, found, useragent = line.rstrip('\n').partition(USERAGENT)
+    match = PREFIX.match(head)
+    if match is None:
+        return None
+    timestamp, pid, pairs = match.groups()
+    record = dict(PAIR.findall(pairs))
+    record['timestamp'] = timestamp
+    record['date'] = timestamp[:10]
+    record['time'] = timestamp[11:19]
+    record['pid'] = pid
+    if 'at' in record:
+        record['level'] = record.pop('at')
+    if 'client' in record:
+        record['username'], _, record['ip'] = record.pop('client').rpartition('@')
+    try:
+        for name in MILLISECOND_FIELDS.intersection(record):
+            value = record[name]
+            record[name] = int(value[:-2] if value.endswith('ms') else value)
+        for name in INTEGER_FIELDS.intersection(record):
+            record[name] = int(record[name])
+    except ValueError:
+        return None
+    if found:
+        record['useragent'] = useragent[:-1] if useragent.endswith('"') else useragent
+    return record
+
+
+def parse_json_line(line):
+    try:
+        record = json.loads(line)
+        if record.pop('v') != JSON_SCHEMA_VERSION:
+            return None
+        timestamp = record['timestamp']
+        record['date'] = timestamp[:10]
+        record['time'] = timestamp[11:19]
+        record['pid'] = str(record['pid'])
+        record['status'] = str(record['status'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    return record
+
+
+class EpochParser():
+    """Converts log timestamps to seconds since the epoch.
+
+    Many consecutive lines share a timestamp (the log has one second
+    resolution), so the most recent conversion is remembered.
+    """
+    def __init__(self):
+        self.last_timestamp = None
+        self.last_epoch = None
+
+    def __call__(self, timestamp):
+        if timestamp != self.last_timestamp:
+            moment = datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+            self.last_epoch = moment.timestamp()
+            self.last_timestamp = timestamp
+        return self.last_epoch
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_route(path):
+    """Returns the name of the view which serves the path, or 'other'."""
+    for pattern, name in ROUTES:
+        if pattern.match(path):
+            return name
+    return 'other'
+
+
+class LatencySketch():
+    """Mergeable histogram of millisecond latencies, for percentiles.
+
+    Like an HDR histogram, values below 128 are counted exactly and larger
+    ones in buckets no wider than 1/64th of their value, so percentiles are
+    accurate to within about 1.6% however many values are added. Sketches
+    merge by adding their counts, so they can be built in parallel or saved
+    (with to_dict) and combined later.
+    """
+    EXACT = 128
+    SIGNIFICANT_BITS = 7
+
+    def __init__(self, counts=None, maximum=None):
+        self.counts = collections.Counter()
+        self.total = 0
+        self.maximum = 0
+        if counts:
+            for bucket, count in counts.items():
+                self.counts[int(bucket)] += count
+                self.total += count
+            self.maximum = self.upper(max(self.counts)) if maximum is None else maximum
+
+    def bucket(self, value):
+        if value < self.EXACT:
+            return value
+        shift = value.bit_length() - self.SIGNIFICANT_BITS
+        return (shift << (self.SIGNIFICANT_BITS - 1)) + (value >> shift)
+
+    def lower(self, bucket):
+        if bucket < self.EXACT:
+            return bucket
+        half = 1 << (self.SIGNIFICANT_BITS - 1)
+        shift = bucket // half - 1
+        return (bucket - shift * half) << shift
+
+    def upper(self, bucket):
+        if bucket < self.EXACT:
+            return bucket
+        return self.lower(bucket + 1) - 1
+
+    def add(self, value, count=1):
+        value = max(int(value), 0)
+        self.counts[self.bucket(value)] += count
+        self.total += count
+        if value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, p):
+        """Nearest-rank percentile (the middle of its bucket), or None if the
+        sketch is empty."""
+        if not self.total:
+            return None
+        if p >= 100:
+            return self.maximum
+        rank = max(-(-p * self.total // 100), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min((self.lower(bucket) + self.upper(bucket)) // 2, self.maximum)
+        return self.maximum
+
+    def to_dict(self):
+        return {str(bucket): count for bucket, count in self.counts.items()}
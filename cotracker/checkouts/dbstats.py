@@ -0,0 +1,167 @@
+"""Sizes and row counts of the database's tables, for the dbstats command and
+the database page in the admin
+
+Row counts come from the statistics the database keeps anyway, so a report
+costs one query rather than a scan of every table. On PostgreSQL that's a
+single query of the catalog: the live and dead row counts kept by the
+statistics collector (falling back on the planner's estimate), the sizes of
+each table and its indexes, and when it was last vacuumed and analyzed. A high
+proportion of dead rows, or a table much bigger than its rows would suggest,
+is a sign of bloat which vacuuming hasn't caught up with.
+
+SQLite (for local development) keeps no such statistics unless ANALYZE has
+been run, and its databases are small, so tables are counted there instead;
+sizes come from the dbstat table when SQLite was built with it.
+
+Exact counts are only made when asked for, on several connections at once.
+"""
+import concurrent.futures
+import queue
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+
+# Connections used at once for exact counts
+EXACT_JOBS = 4
+
+POSTGRES_QUERY = """
+    SELECT c.relname,
+           COALESCE(NULLIF(s.n_live_tup, 0), GREATEST(c.reltuples, 0))::bigint,
+           s.n_dead_tup,
+           pg_table_size(c.oid),
+           pg_indexes_size(c.oid),
+           pg_total_relation_size(c.oid),
+           GREATEST(s.last_vacuum, s.last_autovacuum),
+           GREATEST(s.last_analyze, s.last_autoanalyze)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.relkind = 'r' AND n.nspname = 'public'
+    ORDER BY pg_total_relation_size(c.oid) DESC, c.relname
+"""
+
+
+def table_stats(using=DEFAULT_DB_ALIAS, exact=False, jobs=EXACT_JOBS):
+    """Returns a dict for each table: its name, estimated 'rows' (and the
+    'exact' count, if asked for), its 'table_bytes', 'index_bytes' and
+    'total_bytes', its 'dead_rows' and their 'dead_ratio', and when it was
+    'last_vacuum'ed and 'last_analyze'd. Whatever the database can't tell is
+    None."""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        tables = postgres_stats(connection)
+    else:
+        tables = sqlite_stats(connection)
+    if exact:
+        counts = exact_counts([table['table'] for table in tables], using, jobs)
+        for table in tables:
+            table['exact'] = counts[table['table']]
+    return tables
+
+
+def postgres_stats(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(POSTGRES_QUERY)
+        results = cursor.fetchall()
+    tables = []
+    for name, rows, dead, table_bytes, index_bytes, total_bytes, vacuumed, analyzed in results:
+        tables.append({
+            'table': name,
+            'rows': rows,
+            'exact': None,
+            'table_bytes': table_bytes,
+            'index_bytes': index_bytes,
+            'total_bytes': total_bytes,
+            # Tables the statistics collector hasn't seen have no dead rows
+            # to speak of, rather than none
+            'dead_rows': dead,
+            'dead_ratio': dead / (rows + dead) if dead else dead,
+            'last_vacuum': vacuumed,
+            'last_analyze': analyzed,
+        })
+    return tables
+
+
+def sqlite_query(connection, sql):
+    """Returns the rows, or None if the statistics table doesn't exist."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall()
+    except DatabaseError:
+        return None
+
+
+def sqlite_stats(connection):
+    names = connection.introspection.table_names()
+    # The first number of a table's stat is its row count
+    analyzed = {
+        table: int(stat.split()[0])
+        for table, stat in sqlite_query(connection, "SELECT tbl, stat FROM sqlite_stat1") or []
+    }
+    sizes = sqlite_query(connection, "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+    owners = dict(sqlite_query(connection, "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'"))
+    table_bytes = {}
+    index_bytes = {}
+    for name, size in sizes or []:
+        if name in owners:
+            index_bytes[owners[name]] = index_bytes.get(owners[name], 0) + size
+        else:
+            table_bytes[name] = size
+    counts = exact_counts([name for name in names if name not in analyzed], connection.alias, jobs=1)
+
+    tables = []
+    for name in names:
+        table = {
+            'table': name,
+            'rows': analyzed.get(name, counts.get(name)),
+            'exact': None,
+            'table_bytes': None,
+            'index_bytes': None,
+            'total_bytes': None,
+            'dead_rows': None,
+            'dead_ratio': None,
+            'last_vacuum': None,
+            'last_analyze': None,
+        }
+        if sizes is not None:
+            table['table_bytes'] = table_bytes.get(name, 0)
+            table['index_bytes'] = index_bytes.get(name, 0)
+            table['total_bytes'] = table['table_bytes'] + table['index_bytes']
+        tables.append(table)
+    tables.sort(key=lambda table: (-(table['total_bytes'] or 0), table['table']))
+    return tables
+
+
+def count_rows(connection, table):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM %s" % connection.ops.quote_name(table))
+        return cursor.fetchone()[0]
+
+
+def exact_counts(tables, using=DEFAULT_DB_ALIAS, jobs=EXACT_JOBS):
+    """Counts the rows of each table, returning them by name. With more than
+    one job, the tables are counted on a pool of that many connections of
+    their own, which are closed afterwards."""
+    connection = connections[using]
+    if jobs <= 1 or len(tables) <= 1:
+        return {table: count_rows(connection, table) for table in tables}
+
+    pool = queue.Queue()
+    copies = [connection.copy(allow_thread_sharing=True) for _ in range(min(jobs, len(tables)))]
+    for copy in copies:
+        pool.put(copy)
+
+    def count(table):
+        borrowed = pool.get()
+        try:
+            return table, count_rows(borrowed, table)
+        finally:
+            pool.put(borrowed)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(copies)) as executor:
+            return dict(executor.map(count, tables))
+    finally:
+        for copy in copies:
+            copy.close()
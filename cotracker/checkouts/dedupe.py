@@ -0,0 +1,166 @@
+"""Removing duplicate checkouts, from fixtures or from the database
+
+A checkout is a duplicate if an earlier one has the same pilot, airstrip and
+aircraft type. Fixtures are read one object at a time, so however big the
+file, only the keys of the checkouts seen so far are kept in memory: a set
+of (pilot, airstrip, aircraft type) tuples of integer primary keys, rather
+than whole records or strings.
+
+Checkout is unique on those three fields, so the database shouldn't hold any
+duplicates, but a table restored or loaded without the constraint can. They
+are found with a single query, ranking each checkout among those with the same
+key, and all but the oldest of each are deleted. SQLite only has window
+functions from 3.25, so older versions find the oldest of each key by grouping
+instead.
+"""
+import json
+import sqlite3
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .models import Checkout
+
+
+CHECKOUT_MODEL = 'checkouts.checkout'
+KEY_FIELDS = ('pilot', 'airstrip', 'aircraft_type')
+READ_SIZE = 64 * 1024
+# Within SQLite's limit on the parameters of a query
+DELETE_BATCH_SIZE = 500
+
+
+def iter_json_array(f, read_size=READ_SIZE):
+    """Yields the elements of the JSON array in the text file one at a time,
+    reading no more of it than it takes to decode the next."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    while True:
+        # Skip to the start of the next element
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a JSON array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                rest = buffer[position + 1:]
+                while rest:
+                    if rest.strip():
+                        raise ValueError("Unexpected data after the JSON array")
+                    rest = f.read(read_size)
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Most likely cut off by the end of the buffer; if it isn't,
+                # it's raised once there's nothing more to read
+                element = end = None
+            if end is not None and end < len(buffer):
+                yield element
+                position = end
+                continue
+        data = f.read(read_size)
+        if not data:
+            if position < len(buffer):
+                decoder.raw_decode(buffer, position)
+            raise ValueError("The JSON array isn't closed")
+        buffer = buffer[position:] + data
+        position = 0
+
+
+def checkout_key(fields):
+    # Foreign keys are integers, or natural keys (lists) if dumped with them
+    return tuple(
+        fields[name] if isinstance(fields[name], int) else tuple(fields[name])
+        for name in KEY_FIELDS
+    )
+
+
+class FixtureDeduplicator():
+    """Passes a fixture's objects through, leaving out duplicate checkouts
+    and optionally numbering the checkouts which remain from 1"""
+    def __init__(self, renumber=False):
+        self.renumber = renumber
+        self.seen = set()
+        self.checkouts = 0
+        self.duplicates = 0
+
+    def filter(self, objects):
+        for obj in objects:
+            if obj.get('model') != CHECKOUT_MODEL:
+                yield obj
+                continue
+            key = checkout_key(obj['fields'])
+            if key in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.add(key)
+            self.checkouts += 1
+            if self.renumber:
+                obj['pk'] = self.checkouts
+            yield obj
+
+
+def write_json_array(f, objects):
+    """Writes the objects as a JSON array, one at a time, indented as
+    dumpdata --indent=4 would. Returns how many were written."""
+    count = 0
+    f.write('[')
+    for obj in objects:
+        f.write(',\n' if count else '\n')
+        f.write(json.dumps(obj, indent=4, sort_keys=True))
+        count += 1
+    f.write('\n]\n' if count else ']\n')
+    return count
+
+
+def supports_window_functions(connection):
+    return connection.vendor != 'sqlite' or sqlite3.sqlite_version_info >= (3, 25)
+
+
+def duplicate_checkout_pks(using=DEFAULT_DB_ALIAS):
+    """Returns the primary keys of the checkouts with the same pilot, airstrip
+    and aircraft type as an older one (by primary key)."""
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    table = quote(Checkout._meta.db_table)
+    pk = quote(Checkout._meta.pk.column)
+    key_columns = [quote(Checkout._meta.get_field(name).column) for name in KEY_FIELDS]
+    if supports_window_functions(connection):
+        sql = (
+            "SELECT {pk} FROM ("
+            "SELECT {pk}, ROW_NUMBER() OVER (PARTITION BY {columns} ORDER BY {pk}) AS position "
+            "FROM {table}"
+            ") ranked WHERE position > 1 ORDER BY {pk}"
+        ).format(table=table, pk=pk, columns=', '.join(key_columns))
+    else:
+        sql = (
+            "SELECT checkout.{pk} FROM {table} checkout JOIN ("
+            "SELECT {columns}, MIN({pk}) AS oldest FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1"
+            ") duplicated ON {joined} AND checkout.{pk} > duplicated.oldest ORDER BY checkout.{pk}"
+        ).format(
+            table=table, pk=pk, columns=', '.join(key_columns),
+            joined=' AND '.join('checkout.{0} = duplicated.{0}'.format(column) for column in key_columns),
+        )
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def delete_duplicate_checkouts(using=DEFAULT_DB_ALIAS):
+    """Deletes the duplicate checkouts, keeping the oldest of each. Returns
+    how many were deleted.
+
+    They're deleted through the ORM, so that a Deletion is recorded for each
+    and incremental backups carry them."""
+    deleted = 0
+    with transaction.atomic(using=using):
+        pks = duplicate_checkout_pks(using)
+        for start in range(0, len(pks), DELETE_BATCH_SIZE):
+            batch = pks[start:start + DELETE_BATCH_SIZE]
+            deleted += Checkout.objects.using(using).filter(pk__in=batch).delete()[1].get(Checkout._meta.label, 0)
+    return deleted
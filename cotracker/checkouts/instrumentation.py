@@ -0,0 +1,104 @@
+"""Hooks for observing the database activity of a block of code"""
+
+import contextlib
+import os
+import time
+import traceback
+
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Frames from these modules describe the instrumentation, not the caller
+IGNORED_FRAMES = ('instrumentation.py', 'middleware.py')
+
+
+class ObservedCursorWrapper(CursorWrapper):
+    """Reports every statement run through the cursor to an observer.
+
+    The observer is called as observer(connection, sql, params, milliseconds)
+    once the statement has finished, whether or not it succeeded.
+    """
+    def __init__(self, cursor, db, observer):
+        super(ObservedCursorWrapper, self).__init__(cursor, db)
+        self.observer = observer
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(ObservedCursorWrapper, self).execute(sql, params)
+        finally:
+            elapsed = (time.time() - start) * 1000.0
+            self.observer(self.db, sql, params, elapsed)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(ObservedCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            elapsed = (time.time() - start) * 1000.0
+            self.observer(self.db, sql, param_list, elapsed)
+
+
+def _observing(method, connection, observer):
+    """Wraps a cursor factory so that its cursors report to the observer"""
+    def wrapper(*args, **kwargs):
+        return ObservedCursorWrapper(method(*args, **kwargs), connection, observer)
+    return wrapper
+
+
+@contextlib.contextmanager
+def observe_queries(observer):
+    """Routes the statements of every database connection through the
+    observer while the block runs.
+
+    Observers may be nested; each one sees every statement. The connections
+    are restored to their previous state when the block exits.
+    """
+    patched = []
+    for connection in connections.all():
+        for name in ('cursor', 'chunked_cursor'):
+            if not hasattr(connection, name):
+                continue
+            previous = connection.__dict__.get(name)
+            method = getattr(connection, name)
+            setattr(connection, name, _observing(method, connection, observer))
+            patched.append((connection, name, previous))
+    try:
+        yield
+    finally:
+        for connection, name, previous in reversed(patched):
+            if previous is None:
+                delattr(connection, name)
+            else:
+                setattr(connection, name, previous)
+
+
+def trimmed_stack(limit=8):
+    """Describes the innermost frames of the current stack which belong to
+    this app (e.g. the checkouts.util function which ran a query). Falls back
+    to the innermost frames of any module if the app isn't on the stack.
+    """
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if os.path.basename(frame[0]) not in IGNORED_FRAMES
+    ]
+    ours = [frame for frame in frames if frame[0].startswith(APP_ROOT)]
+    selected = (ours or frames)[-limit:]
+    lines = []
+    for filename, lineno, function, _ in reversed(selected):
+        if filename.startswith(APP_ROOT):
+            filename = os.path.relpath(filename, os.path.dirname(APP_ROOT))
+        lines.append("%s:%d in %s" % (filename, lineno, function))
+    return '\n'.join(lines)
+
+
+def explain(connection, sql, params):
+    """Returns PostgreSQL's plan for the statement without running it, or an
+    empty string if no plan is available."""
+    if connection.vendor != 'postgresql' or not sql.lstrip().upper().startswith('SELECT'):
+        return ''
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
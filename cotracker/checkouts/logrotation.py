@@ -0,0 +1,220 @@
+"""A log handler which rotates its file by size and/or time
+
+Several gunicorn workers write to each log, so rotation is coordinated
+through the file system rather than in memory:
+
+- Every worker appends to the file and, before each write, checks that the
+  path still refers to the file it has open. Once another worker has rotated
+  it away, the path is reopened.
+- Rotation happens under an exclusive lock on a '.lock' file beside the log,
+  and the need to rotate is checked again once the lock is held, so only one
+  worker renames each segment.
+- Rotated segments are named after the time of their last entry (e.g.
+  analytics.log.20191018T221300) so that they sort in time order. The
+  newest segment is left alone, as other workers may still be finishing a
+  write to it (and so that tail_analytics.py can find it by inode); older
+  segments are gzipped on a background thread so no request waits on the
+  compression, and segments beyond the backup count are deleted.
+"""
+import fcntl
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+
+SEGMENT_TIME_FORMAT = '%Y%m%dT%H%M%S'
+# Strftime formats which identify the period a time falls in
+PERIODS = {
+    'hourly':   '%Y%m%d%H',
+    'midnight': '%Y%m%d',
+}
+
+
+class Compressor():
+    """Compresses and prunes rotated segments on a background thread.
+
+    The thread is started on first use in each process, since gunicorn
+    forks its workers after the settings (and so the logging) are loaded.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, filename, backup_count):
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.queue = queue.Queue()
+                self.thread = threading.Thread(target=self.run, name='log-compressor', daemon=True)
+                self.pid = os.getpid()
+                self.thread.start()
+        self.queue.put((filename, backup_count))
+
+    def run(self):
+        jobs = self.queue
+        while True:
+            filename, backup_count = jobs.get()
+            try:
+                tidy_segments(filename, backup_count)
+            except Exception:
+                logging.getLogger(__name__).exception("Failed to compress segments of %s" % filename)
+            finally:
+                jobs.task_done()
+
+    def join(self):
+        """Waits for the submitted segments to be dealt with."""
+        self.queue.join()
+
+
+compressor = Compressor()
+
+
+def segment_keys(filename):
+    """Returns the (stamp, suffix) and path of each rotated segment."""
+    directory, base = os.path.split(filename)
+    pattern = re.compile(r'^%s\.(\d{8}T\d{6})(?:-(\d+))?(?:\.gz)?$' % re.escape(base))
+    segments = []
+    for name in os.listdir(directory or '.'):
+        match = pattern.match(name)
+        if match:
+            stamp, suffix = match.groups()
+            segments.append(((stamp, int(suffix or 1)), os.path.join(directory, name)))
+    return segments
+
+
+def segment_names(filename):
+    """Returns the rotated segments of the log, oldest first."""
+    return [path for _, path in sorted(segment_keys(filename))]
+
+
+def next_segment_name(filename, stamp):
+    """Returns the name for a new segment with the stamp. Its suffix follows
+    those of the segments with the same stamp, even if earlier ones have been
+    pruned, so that it sorts after them."""
+    suffixes = [suffix for (other, suffix), _ in segment_keys(filename) if other == stamp]
+    if not suffixes:
+        return '%s.%s' % (filename, stamp)
+    return '%s.%s-%d' % (filename, stamp, max(suffixes) + 1)
+
+
+def compress(segment):
+    """Gzips the segment, unless another process already is (or has).
+
+    The segment is only removed once its .gz is complete, and it's locked
+    while it's compressed, so a process which dies part way through leaves
+    the segment to be compressed again rather than a stray file.
+    """
+    try:
+        source = open(segment, 'rb')
+    except FileNotFoundError:
+        return
+    with source:
+        try:
+            fcntl.flock(source, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        # Compressed and removed by another process since it was opened
+        if not os.path.exists(segment) or not os.path.samestat(os.stat(segment), os.fstat(source.fileno())):
+            return
+        with gzip.open(segment + '.gz.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(segment + '.gz.tmp', segment + '.gz')
+        os.remove(segment)
+
+
+def tidy_segments(filename, backup_count):
+    """Compresses all but the newest segment and deletes the oldest ones
+    beyond the backup count (0 keeps them all)."""
+    segments = segment_names(filename)
+    for segment in segments[:-1]:
+        if not segment.endswith('.gz'):
+            compress(segment)
+    if backup_count:
+        for segment in segment_names(filename)[:-backup_count]:
+            for path in (segment, segment + '.gz.tmp'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class RotatingFileHandler(logging.FileHandler):
+    """Appends to a file which is rotated once it exceeds max_bytes (if
+    given) or once a write falls in a later period than the file's last
+    modification, where 'when' is 'hourly' or 'midnight' (if given).
+    backup_count is the number of rotated segments kept (0 for all)."""
+    def __init__(self, filename, max_bytes=0, when=None, backup_count=0, encoding=None):
+        if when is not None and when not in PERIODS:
+            raise ValueError("Unknown rotation period '%s'" % when)
+        self.max_bytes = max_bytes
+        self.period = PERIODS.get(when)
+        self.backup_count = backup_count
+        self.stream_id = None
+        super(RotatingFileHandler, self).__init__(filename, mode='a', encoding=encoding, delay=True)
+        self.lock_filename = self.baseFilename + '.lock'
+
+    def _open(self):
+        stream = super(RotatingFileHandler, self)._open()
+        stat = os.fstat(stream.fileno())
+        self.stream_id = (stat.st_dev, stat.st_ino)
+        return stream
+
+    def current_stat(self):
+        try:
+            return os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return None
+
+    def should_rotate(self, stat, size, now):
+        if stat is None or stat.st_size == 0:
+            return False
+        if self.max_bytes and stat.st_size + size > self.max_bytes:
+            return True
+        if self.period:
+            return time.strftime(self.period, time.localtime(stat.st_mtime)) != time.strftime(self.period, time.localtime(now))
+        return False
+
+    def rotate(self, size, now):
+        """Renames the file to a new segment, unless another process has
+        just done so, and reopens it."""
+        with open(self.lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stat = self.current_stat()
+            if self.should_rotate(stat, size, now):
+                # Named for its last entry, so segments sort in time order
+                stamp = time.strftime(SEGMENT_TIME_FORMAT, time.localtime(stat.st_mtime))
+                os.rename(self.baseFilename, next_segment_name(self.baseFilename, stamp))
+                compressor.submit(self.baseFilename, self.backup_count)
+        self.close_stream()
+
+    def close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def emit(self, record):
+        try:
+            message = self.format(record) + self.terminator
+            if self.encoding:
+                size = len(message.encode(self.encoding))
+            else:
+                size = len(message)
+            now = record.created
+            stat = self.current_stat()
+            if self.should_rotate(stat, size, now):
+                self.rotate(size, now)
+            elif stat is None or (stat.st_dev, stat.st_ino) != self.stream_id:
+                # Rotated by another process (or deleted)
+                self.close_stream()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(message)
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
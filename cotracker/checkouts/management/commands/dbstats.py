@@ -0,0 +1,53 @@
+"""Reports the size and row count of each table in the database"""
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.template.defaultfilters import filesizeformat
+
+from checkouts.dbstats import EXACT_JOBS, table_stats
+
+
+def show(value, format=str):
+    return '-' if value is None else format(value)
+
+
+def size(value):
+    # filesizeformat separates the unit with a non-breaking space, for HTML
+    return filesizeformat(value).replace('\xa0', ' ')
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports each table's estimated rows, size on disk (of the table and "
+        "of its indexes) and, on PostgreSQL, dead rows and when it was last "
+        "vacuumed and analyzed, all from the database's own statistics. "
+        "With --exact, every table is also counted, on several connections "
+        "at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--exact', action='store_true',
+            help="count the rows of every table, rather than only estimating them")
+        parser.add_argument('--jobs', type=int, default=EXACT_JOBS,
+            help="connections to count on at once (default: %d)" % EXACT_JOBS)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help="the database to report on (default: '%s')" % DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        tables = table_stats(options['database'], options['exact'], options['jobs'])
+        count = 'exact' if options['exact'] else 'rows'
+        width = max([len(table['table']) for table in tables] + [5])
+        line = "%-*s %12s %10s %10s %10s %6s  %-16s %s"
+        self.stdout.write(line % (width, 'table', 'rows', 'table', 'indexes', 'total', 'dead', 'vacuumed', 'analyzed'))
+        for table in tables:
+            self.stdout.write(line % (
+                width,
+                table['table'],
+                show(table[count]),
+                show(table['table_bytes'], size),
+                show(table['index_bytes'], size),
+                show(table['total_bytes'], size),
+                show(table['dead_ratio'], '{:.0%}'.format),
+                show(table['last_vacuum'], '{:%Y-%m-%d %H:%M}'.format),
+                show(table['last_analyze'], '{:%Y-%m-%d %H:%M}'.format),
+            ))
+        self.stdout.write("%d tables with %d rows" % (len(tables), sum(table[count] or 0 for table in tables)))
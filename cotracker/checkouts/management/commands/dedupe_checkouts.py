@@ -0,0 +1,59 @@
+"""Removes duplicate checkouts from a fixture, or from the database"""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from checkouts.dedupe import FixtureDeduplicator, delete_duplicate_checkouts, iter_json_array, write_json_array
+
+
+class Command(BaseCommand):
+    help = (
+        "Copies a fixture without the checkouts which repeat an earlier one's "
+        "pilot, airstrip and aircraft type; everything else is copied as it "
+        "is. The fixture is streamed, so it can be any size. With "
+        "--in-database, deletes such checkouts from the database instead, "
+        "keeping the oldest of each."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('fixture', nargs='?', metavar='FIXTURE',
+            help="a JSON fixture, e.g. checkout.json")
+        parser.add_argument('--output', '-o', metavar='FILE',
+            help="where to write the de-duplicated fixture (default: unique_FIXTURE)")
+        parser.add_argument('--renumber', action='store_true',
+            help="number the remaining checkouts from 1")
+        parser.add_argument('--in-database', action='store_true',
+            help="delete duplicate checkouts from the database rather than a fixture")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help="the database to de-duplicate (default: '%s')" % DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        if options['in_database']:
+            if options['fixture']:
+                raise CommandError("Give either a fixture or --in-database, not both")
+            deleted = delete_duplicate_checkouts(options['database'])
+            self.stdout.write("Deleted %d duplicate checkouts" % deleted)
+            return
+
+        if not options['fixture']:
+            raise CommandError("Give a fixture to de-duplicate, or --in-database")
+        source = options['fixture']
+        directory, name = os.path.split(source)
+        output = options['output'] or os.path.join(directory, 'unique_' + name)
+        if os.path.abspath(output) == os.path.abspath(source):
+            raise CommandError("The fixture can't be de-duplicated in place")
+
+        deduplicator = FixtureDeduplicator(renumber=options['renumber'])
+        try:
+            with open(source, 'r', encoding='utf-8') as f, open(output + '.partial', 'w', encoding='utf-8') as out:
+                written = write_json_array(out, deduplicator.filter(iter_json_array(f)))
+        except (OSError, ValueError) as e:
+            if os.path.exists(output + '.partial'):
+                os.remove(output + '.partial')
+            raise CommandError("Couldn't de-duplicate '%s': %s" % (source, e))
+        os.replace(output + '.partial', output)
+
+        self.stdout.write("Kept %d unique checkouts; left out %d duplicates" % (
+            deduplicator.checkouts, deduplicator.duplicates))
+        self.stdout.write("Wrote %d objects to '%s'" % (written, output))
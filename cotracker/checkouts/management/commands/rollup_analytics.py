@@ -0,0 +1,123 @@
+"""Rolls the analytics log up into DailyUsage rows"""
+import collections
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from checkouts.analytics import LatencySketch, normalize_route, open_log, parse_line
+from checkouts.logrotation import segment_names
+from checkouts.models import DailyUsage
+
+
+class Rollup():
+    """Running totals for one route on one day"""
+    def __init__(self):
+        self.requests = 0
+        self.users = set()
+        self.ips = set()
+        self.client_errors = 0
+        self.server_errors = 0
+        self.shed = 0
+        self.latency = LatencySketch()
+
+    def add(self, record):
+        self.requests += 1
+        self.users.add(record.get('username'))
+        self.ips.add(record.get('ip'))
+        status = record.get('status', '')
+        if status.startswith('4'):
+            self.client_errors += 1
+        elif status.startswith('5'):
+            self.server_errors += 1
+            # Only LoadShedder answers with a 503
+            if status == '503':
+                self.shed += 1
+        if 'real' in record:
+            self.latency.add(record['real'])
+
+    def to_model(self, date, route):
+        return DailyUsage(
+            date=date,
+            route=route,
+            requests=self.requests,
+            users=len(self.users),
+            ips=len(self.ips),
+            client_errors=self.client_errors,
+            server_errors=self.server_errors,
+            shed=self.shed,
+            slowest=self.latency.maximum,
+            latency=json.dumps(self.latency.to_dict()),
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        "Rolls analytics logs up into daily usage per route. Every day found "
+        "in the logs replaces any rollup already stored for it, so pass all "
+        "of the logs which cover a day or limit the days with --since. By "
+        "default, analytics.log in LOGS_PATH is read with all of its rotated "
+        "segments."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', metavar='FILE',
+            help="analytics logs, optionally gzipped (default: analytics.log in LOGS_PATH and its segments)")
+        parser.add_argument('--since', metavar='YYYY-MM-DD',
+            help="ignore requests before this date")
+
+    def default_logs(self):
+        """Returns the analytics log and its rotated segments, oldest first,
+        and whether older segments may have been pruned."""
+        filename = os.path.join(settings.LOGS_PATH, 'analytics.log')
+        segments = segment_names(filename)
+        backup_count = settings.LOG_ROTATION['backup_count']
+        pruned = bool(backup_count) and len(segments) >= backup_count
+        return segments + [filename], pruned
+
+    def handle(self, *args, **options):
+        if options['files']:
+            files, pruned = options['files'], False
+        else:
+            files, pruned = self.default_logs()
+            files = [name for name in files if os.path.exists(name)]
+        since = options['since'] or ''
+
+        rollups = collections.defaultdict(Rollup)
+        skipped = 0
+        for name in files:
+            with open_log(name) as f:
+                for line in f:
+                    record = parse_line(line)
+                    if record is None:
+                        skipped += 1
+                        continue
+                    # Dates in the log are ISO 8601, so they compare as strings
+                    date = record['date']
+                    if date < since:
+                        continue
+                    route = '%s %s' % (record.get('method'), normalize_route(record.get('path', '')))
+                    rollups[date, route].add(record)
+                    rollups[date, DailyUsage.ALL_ROUTES].add(record)
+
+        dates = sorted(set(date for date, _ in rollups))
+        if pruned and dates and DailyUsage.objects.filter(date=dates[0]).exists():
+            # The oldest day may have lost its start with the pruned segments,
+            # and its rollup was made while they were still there
+            self.stderr.write("Kept the existing rollup for %s, which the logs may only partly cover" % dates[0])
+            rollups = {key: rollup for key, rollup in rollups.items() if key[0] != dates[0]}
+            dates = dates[1:]
+        rows = [rollup.to_model(date, route) for (date, route), rollup in sorted(rollups.items())]
+        with transaction.atomic():
+            DailyUsage.objects.filter(date__in=dates).delete()
+            DailyUsage.objects.bulk_create(rows, batch_size=500)
+
+        if skipped:
+            self.stderr.write("Skipped %d malformed lines" % skipped)
+        if dates:
+            self.stdout.write("Stored %d route rollups over %d days (%s to %s)" % (
+                len(rows) - len(dates), len(dates), dates[0], dates[-1]))
+        else:
+            self.stdout.write("No requests found")
@@ -1,21 +1,193 @@
 """Checkouts application middleware"""
 
+import cProfile
 import datetime
+import json
 import logging
+import os
+import random
 import subprocess
 import time
 
+from django.conf import settings
 from django.contrib import messages
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+
+from . import profiling
+from .analytics import JSON_SCHEMA_VERSION, TIMESTAMP_FORMAT
+from .instrumentation import explain, observe_queries, trimmed_stack
+from .models import SlowQuery
 
 logger = logging.getLogger('analytics')
+# Problems with the middleware itself don't belong in the analytics log
+checkouts_logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('slowqueries')
+
+
+def get_queue_start(request):
+    """Returns the timestamp this request started (as reported by downstream)"""
+    try:
+        header = request.META['HTTP_X_REQUEST_START'] # must be set by nginx
+        return float(header[2:]) # discard 't=' prefix
+    except KeyError:
+        return 0 # Header wasn't provided by reverse proxy
+    except ValueError:
+        return 0 # Header wasn't in the expected 't=1234.567' format
+
+class HealthCheck():
+    """Answers uptime monitors without running the rest of the application.
+
+    Requests for settings.HEALTH_CHECK_PATH are answered before any other
+    middleware runs, so they never touch static files, sessions, auth or the
+    analytics log. Database connectivity is verified with a trivial query at
+    most once per settings.HEALTH_CHECK_INTERVAL seconds; in between, the
+    result of the last ping is reused. This middleware should come first in
+    the project settings.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.path = settings.HEALTH_CHECK_PATH
+        self.interval = settings.HEALTH_CHECK_INTERVAL
+        self.last_ping = None
+        self.healthy = False
+
+
+    def ping_database(self):
+        """Returns True if the database answered a trivial query."""
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+        except Exception:
+            checkouts_logger.exception("Health check could not reach the database")
+            return False
+        return True
+
+
+    def is_healthy(self):
+        now = time.time()
+        if self.last_ping is None or now - self.last_ping >= self.interval:
+            self.healthy = self.ping_database()
+            self.last_ping = now
+        return self.healthy
+
+
+    def __call__(self, request):
+        if request.path != self.path:
+            return self.get_response(request)
+        if self.is_healthy():
+            return HttpResponse("ok\n", content_type='text/plain')
+        return HttpResponse("database unavailable\n", content_type='text/plain', status=503)
+
+
+class LoadShedder():
+    """Turns away expensive requests which have already waited too long.
+
+    When nginx reports (via X-Request-Start) that a request sat in the queue
+    for longer than its route's threshold, a 503 with a Retry-After header is
+    returned before any real work is done. Only the routes configured in
+    settings.LOAD_SHEDDING are eligible, so cheap pages keep working while
+    the workers catch up. Each route's rule may limit shedding to certain
+    methods and to requests carrying particular form values:
+
+        'checkout_filter': {
+            'methods': ('POST',),
+            'data': {'checkout_status': 'belum'},
+            'threshold_ms': 1500,
+        },
+
+    Each shed request is logged. This middleware should come after Analytics
+    so that the 503s appear in the analytics log, but before anything else:
+    rollup_analytics counts them per route and day (across every worker),
+    for the usage dashboard.
+    """
+    def __init__(self, get_response):
+        config = settings.LOAD_SHEDDING
+        if not config or not config['routes']:
+            raise MiddlewareNotUsed("Load shedding is disabled")
+        self.get_response = get_response
+        self.routes = config['routes']
+        self.retry_after = config['retry_after']
+        # Requests which queued for less time than this are never shed
+        self.minimum = min(rule['threshold_ms'] for rule in self.routes.values())
+
+
+    def get_route(self, request):
+        """Returns the URL name for the request, if it has one."""
+        try:
+            return resolve(request.path_info).url_name
+        except Resolver404:
+            return None
+
+
+    def is_expensive(self, request, route, queue):
+        """Returns True if the route's rule says this request should be shed."""
+        rule = self.routes.get(route)
+        if rule is None:
+            return False
+        if queue < rule['threshold_ms']:
+            return False
+        if 'methods' in rule and request.method not in rule['methods']:
+            return False
+        for field, value in rule.get('data', {}).items():
+            if request.POST.get(field) != value:
+                return False
+        return True
+
+
+    def shed(self, request, route, queue):
+        checkouts_logger.warning("Shedding %s %s (route=%s queue=%.0fms)" % (
+            request.method, request.path, route, queue))
+        response = HttpResponse(
+            "The server is busy right now. Please try again in a few seconds.\n",
+            content_type='text/plain',
+            status=503,
+        )
+        response['Retry-After'] = str(self.retry_after)
+        return response
+
+
+    def __call__(self, request):
+        queue_start = get_queue_start(request)
+        if queue_start:
+            queue = (time.time() - queue_start) * 1000.0
+            if queue >= self.minimum:
+                route = self.get_route(request)
+                if self.is_expensive(request, route, queue):
+                    return self.shed(request, route, queue)
+        return self.get_response(request)
+
 
 class Analytics():
     """Tracks request details useful for analysis of usage patterns.
 
-    To ensure that the name of the logged in user can be accessed, this
-    middleware should come after Django's built-in AuthenticationMiddleware
-    in the project settings.
+    Each response is also given a Server-Timing header which splits the time
+    spent on the request into phases: queue (as reported by nginx), the
+    middleware stack, the view, database queries and template rendering. The
+    same breakdown is written to the analytics log.
+
+    To capture the time spent in the rest of the middleware stack, this
+    middleware should come as early as possible in the project settings (just
+    after WhiteNoise, so that static files stay out of the logs). The name of
+    the logged in user is only looked up on the way out, by which point
+    Django's built-in AuthenticationMiddleware has already run.
+
+    Database queries run while rendering a template are counted towards both
+    the 'db' and 'tpl' phases. Responses which are not TemplateResponses count
+    the inner middleware on the way out as part of the view.
     """
+    timing_phases = (
+        ('queue', 'Queue'),
+        ('mw', 'Middleware'),
+        ('view', 'View'),
+        ('db', 'Database'),
+        ('tpl', 'Template'),
+        ('total', 'Total'),
+    )
+
     def __init__(self, get_response):
         self.get_response = get_response
 
@@ -38,12 +210,7 @@ class Analytics():
 
     def get_queue_start(self, request):
         """Returns the timestamp this request started (as reported by downstream)"""
-        try:
-            header = request.META['HTTP_X_REQUEST_START'] # must be set by nginx
-        except KeyError:
-            return 0 # Header wasn't provided by reverse proxy
-        value = float(header[2:]) # discard 't=' prefix
-        return value
+        return get_queue_start(request)
 
 
     def collect_request_details(self, request):
@@ -81,10 +248,72 @@ class Analytics():
             return # No metrics
         now = time.time()
         request._analytics_start_time = now
-        try:
-            request._queue_time = (now - self.get_queue_start(request)) * 1000.0
-        except AttributeError:
-            pass # Nothing to do, no queue time to report
+        request._timing = {'view': 0.0, 'tpl': 0.0, 'db': 0.0, 'queries': 0}
+        queue_start = self.get_queue_start(request)
+        if queue_start:
+            request._queue_time = (now - queue_start) * 1000.0
+
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Notes when the view started running."""
+        if hasattr(request, '_timing'):
+            request._timing['view_start'] = time.time()
+
+
+    def process_template_response(self, request, response):
+        """Notes when the view finished and times the template rendering."""
+        if not hasattr(request, '_timing'):
+            return response
+        timing = request._timing
+        render_start = time.time()
+        timing['view_end'] = render_start
+
+        def rendered(response):
+            timing['tpl'] = (time.time() - render_start) * 1000.0
+        response.add_post_render_callback(rendered)
+        return response
+
+
+    def query_observer(self, request):
+        """Returns a callable which totals the database time for the request."""
+        timing = request._timing
+
+        def observer(connection, sql, params, elapsed):
+            timing['db'] += elapsed
+            timing['queries'] += 1
+        return observer
+
+
+    def collect_timing(self, request):
+        """Splits the time spent on this request into phases (milliseconds)."""
+        timing = request._timing
+        now = time.time()
+        total = (now - request._analytics_start_time) * 1000.0
+        if 'view_start' in timing:
+            view_end = timing.get('view_end', now)
+            view = (view_end - timing['view_start']) * 1000.0
+        else:
+            view = 0.0 # Short-circuited by another middleware
+        return {
+            'mw':      max(total - view - timing['tpl'], 0.0),
+            'view':    view,
+            'tpl':     timing['tpl'],
+            'db':      timing['db'],
+            'queries': timing['queries'],
+            'total':   total,
+        }
+
+
+    def server_timing_header(self, request, phases):
+        """Formats the timing phases as a Server-Timing header value."""
+        durations = dict(phases)
+        if hasattr(request, '_queue_time'):
+            durations['queue'] = request._queue_time
+        entries = []
+        for name, description in self.timing_phases:
+            if name in durations:
+                entries.append('%s;desc="%s";dur=%.1f' % (name, description, durations[name]))
+        return ', '.join(entries)
 
 
     def process_response(self, request, response):
@@ -97,17 +326,49 @@ class Analytics():
         context['bytes'] = len(response.content)
 
         if hasattr(request, '_analytics_start_time'):
-            elapsed = (time.time() - request._analytics_start_time) * 1000.0
-            context['elapsed'] = elapsed
+            phases = self.collect_timing(request)
+            response['Server-Timing'] = self.server_timing_header(request, phases)
+            context['elapsed'] = phases['total']
+            context.update(phases)
         else:
             context['elapsed'] = -1.0
+            context.update({'mw': -1.0, 'view': -1.0, 'tpl': -1.0, 'db': -1.0, 'queries': 0})
 
-        template = "client=%(user)s@%(ip)s method=%(method)s path=%(path)s queue=%(queue).0fms real=%(elapsed).0fms status=%(status)s bytes=%(bytes)s useragent=\"%(useragent)s\""
-        logger.info(template % context)
+        if settings.ANALYTICS_LOG_FORMAT == 'json':
+            logger.info(self.format_json(context))
+        else:
+            template = "client=%(user)s@%(ip)s method=%(method)s path=%(path)s queue=%(queue).0fms real=%(elapsed).0fms mw=%(mw).0fms view=%(view).0fms tpl=%(tpl).0fms db=%(db).0fms queries=%(queries)d status=%(status)s bytes=%(bytes)s useragent=\"%(useragent)s\""
+            logger.info(template % context)
 
         return response
 
 
+    def format_json(self, context):
+        """Formats the request details as a JSON analytics log line. The
+        timestamp, process and level are included since the log's formatter
+        only writes the message in this mode."""
+        return json.dumps({
+            'v':         JSON_SCHEMA_VERSION,
+            'timestamp': time.strftime(TIMESTAMP_FORMAT),
+            'pid':       os.getpid(),
+            'level':     'INFO',
+            'username':  context['user'],
+            'ip':        context['ip'],
+            'method':    context['method'],
+            'path':      context['path'],
+            'queue':     round(context['queue']),
+            'real':      round(context['elapsed']),
+            'mw':        round(context['mw']),
+            'view':      round(context['view']),
+            'tpl':       round(context['tpl']),
+            'db':        round(context['db']),
+            'queries':   context['queries'],
+            'status':    context['status'],
+            'bytes':     context['bytes'],
+            'useragent': context['useragent'],
+        }, separators=(',', ':'))
+
+
     def current_django(self):
         with open('/home/checkniner/checkniner/requirements/base.txt', 'r') as f:
             line = f.readline()
@@ -151,5 +412,144 @@ class Analytics():
         #        self.update_check(request)
         #    except:
         #        logger.exception("Encountered an error during update_check middleware, skipping")
-        response = self.get_response(request)
+        if hasattr(request, '_timing'):
+            with observe_queries(self.query_observer(request)):
+                response = self.get_response(request)
+        else:
+            response = self.get_response(request)
         return self.process_response(request, response)
+
+
+class Profiler():
+    """Captures cProfile traces of slow requests for later inspection.
+
+    A sampled fraction of requests is captured, whatever their latency, to an
+    on-disk ring buffer (see checkouts.profiling). If a threshold is
+    configured, every request is run under cProfile and those which take
+    longer than it are captured too. A superuser may force a capture of a
+    single request by adding 'profile' to its query string.
+
+    Profiling is opt-in: without settings.PROFILER_CONFIG this middleware
+    removes itself from the stack at startup. It must come after Django's
+    built-in AuthenticationMiddleware so that superusers can be recognized.
+    """
+    def __init__(self, get_response):
+        if settings.PROFILER_CONFIG is None:
+            raise MiddlewareNotUsed("Request profiling is disabled")
+        self.get_response = get_response
+        self.config = settings.PROFILER_CONFIG
+
+
+    def is_forced(self, request):
+        """Returns True if a superuser has asked for this request to be profiled."""
+        return 'profile' in request.GET and request.user.is_superuser
+
+
+    def save(self, request, response, profile, elapsed):
+        details = {
+            'method':  request.method,
+            'path':    request.get_full_path(),
+            'user':    request.user.username or 'anonymous',
+            'status':  response.status_code,
+            'elapsed': elapsed,
+        }
+        try:
+            profiling.save_capture(profile, self.config, details)
+        except Exception:
+            checkouts_logger.exception("Unable to save the profile for %s, skipping" % request.path)
+
+
+    def __call__(self, request):
+        forced = self.is_forced(request)
+        sampled = random.random() < self.config['sample_rate']
+        threshold = self.config['threshold_ms']
+        if not forced and not sampled and threshold is None:
+            return self.get_response(request)
+
+        profile = cProfile.Profile()
+        start = time.time()
+        profile.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.disable()
+        elapsed = (time.time() - start) * 1000.0
+
+        if forced or sampled or elapsed >= threshold:
+            self.save(request, response, profile, elapsed)
+        return response
+
+
+class SlowQueries():
+    """Records database statements which take longer than a threshold.
+
+    Each slow statement is written to the 'slowqueries' log and to the
+    SlowQuery table (viewable in the admin) along with the view which ran it
+    and a trimmed stack pointing at the responsible app code. On PostgreSQL
+    the statement's plan can also be captured with EXPLAIN (not ANALYZE).
+
+    Records are collected while the request runs and saved once the response
+    is ready, so that the bookkeeping queries are never themselves observed.
+    This middleware should come just after Analytics in the project settings
+    so that the queries made by the rest of the middleware stack are seen.
+    Without settings.SLOW_QUERY_CONFIG it removes itself from the stack.
+    """
+    def __init__(self, get_response):
+        if settings.SLOW_QUERY_CONFIG is None:
+            raise MiddlewareNotUsed("Slow query recording is disabled")
+        self.get_response = get_response
+        self.config = settings.SLOW_QUERY_CONFIG
+
+
+    def get_view_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return '-' # The URL hasn't been resolved yet
+        return match.view_name
+
+
+    def save(self, request, captured):
+        view = self.get_view_name(request)
+        records = []
+        for connection, sql, params, elapsed, stack in captured:
+            plan = ''
+            if self.config['explain']:
+                try:
+                    plan = explain(connection, sql, params)
+                except Exception:
+                    slow_query_logger.exception("Unable to explain query from %s" % view)
+            statement = "%s; args=%r" % (sql, params)
+            slow_query_logger.warning("view=%s path=%s real=%.0fms sql=%s\n%s%s" % (
+                view, request.path, elapsed, statement, stack, '\n' + plan if plan else ''))
+            records.append(SlowQuery(
+                view=view[:255],
+                path=request.path[:255],
+                duration=elapsed,
+                sql=statement,
+                stack=stack,
+                plan=plan,
+            ))
+        SlowQuery.objects.bulk_create(records)
+
+        # Keep the table small by discarding everything but the newest records
+        oldest_kept = SlowQuery.objects.order_by('-id').values_list('id', flat=True)[self.config['capacity'] - 1:self.config['capacity']]
+        if oldest_kept:
+            SlowQuery.objects.filter(id__lt=oldest_kept[0]).delete()
+
+
+    def __call__(self, request):
+        threshold = self.config['threshold_ms']
+        captured = []
+
+        def observer(connection, sql, params, elapsed):
+            if elapsed >= threshold:
+                captured.append((connection, sql, params, elapsed, trimmed_stack()))
+
+        with observe_queries(observer):
+            response = self.get_response(request)
+        if captured:
+            try:
+                self.save(request, captured)
+            except Exception:
+                slow_query_logger.exception("Unable to record slow queries for %s, skipping" % request.path)
+        return response
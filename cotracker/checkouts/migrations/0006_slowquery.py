@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.25 on 2026-10-18 22:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkouts', '0005_auto_20151017_1209'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('view', models.CharField(max_length=255)),
+                ('path', models.CharField(max_length=255)),
+                ('duration', models.FloatField(help_text='Milliseconds')),
+                ('sql', models.TextField()),
+                ('stack', models.TextField(blank=True)),
+                ('plan', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name_plural': 'slow queries',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.25 on 2026-10-18 22:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkouts', '0006_slowquery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('date', models.DateField()),
+                ('route', models.CharField(help_text="Method and view, e.g. 'GET PilotDetail'", max_length=64)),
+                ('requests', models.PositiveIntegerField()),
+                ('users', models.PositiveIntegerField(help_text='Distinct usernames')),
+                ('ips', models.PositiveIntegerField(help_text='Distinct IP addresses')),
+                ('client_errors', models.PositiveIntegerField(help_text='4xx responses')),
+                ('server_errors', models.PositiveIntegerField(help_text='5xx responses')),
+                ('slowest', models.PositiveIntegerField(help_text='Milliseconds')),
+                ('latency', models.TextField(help_text='JSON LatencySketch counts of real= milliseconds')),
+            ],
+            options={
+                'verbose_name_plural': 'daily usage',
+                'ordering': ('-date', 'route'),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyusage',
+            unique_together=set([('date', 'route')]),
+        ),
+    ]
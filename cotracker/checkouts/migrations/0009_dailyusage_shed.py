@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.25 on 2026-10-18 23:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkouts', '0008_deletion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailyusage',
+            name='shed',
+            field=models.PositiveIntegerField(default=0, help_text='503 responses, i.e. requests turned away by LoadShedder'),
+        ),
+    ]
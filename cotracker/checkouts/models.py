@@ -1,9 +1,15 @@
 """Model definitions for the Checkouts app"""
+import contextlib
+import json
+
 from django.db import models
+from django.db.models.signals import post_delete
 from django.contrib.auth.models import User
 
 from model_utils.models import TimeStampedModel
 
+from .analytics import LatencySketch
+
 
 # =============================================================================
 # == Patching the built-in User model
@@ -104,3 +110,107 @@ class PilotWeight(TimeStampedModel):
 
     def __str__(self):
         return "%s: %dkg" % (self.pilot, self.weight)
+
+
+# =============================================================================
+# == Diagnostics
+# =============================================================================
+
+class SlowQuery(TimeStampedModel):
+    """A database statement which took longer than the threshold configured in
+    settings.SLOW_QUERY_CONFIG. Recorded by the SlowQueries middleware.
+    """
+    view = models.CharField(max_length=255)
+    path = models.CharField(max_length=255)
+    duration = models.FloatField(help_text="Milliseconds")
+    sql = models.TextField()
+    stack = models.TextField(blank=True)
+    plan = models.TextField(blank=True)
+
+    def __str__(self):
+        return "%s: %.0fms" % (self.view, self.duration)
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name_plural = 'slow queries'
+
+
+class DailyUsage(TimeStampedModel):
+    """Requests to one route on one day, rolled up from the analytics log by
+    the rollup_analytics command. Each day also has a row for ALL_ROUTES,
+    since unique users and IPs can't be added up across routes.
+    """
+    ALL_ROUTES = '*'
+
+    date = models.DateField()
+    route = models.CharField(max_length=64, help_text="Method and view, e.g. 'GET PilotDetail'")
+    requests = models.PositiveIntegerField()
+    users = models.PositiveIntegerField(help_text="Distinct usernames")
+    ips = models.PositiveIntegerField(help_text="Distinct IP addresses")
+    client_errors = models.PositiveIntegerField(help_text="4xx responses")
+    server_errors = models.PositiveIntegerField(help_text="5xx responses")
+    shed = models.PositiveIntegerField(default=0, help_text="503 responses, i.e. requests turned away by LoadShedder")
+    slowest = models.PositiveIntegerField(help_text="Milliseconds")
+    latency = models.TextField(help_text="JSON LatencySketch counts of real= milliseconds")
+
+    def __str__(self):
+        return "%s %s: %d requests" % (self.date, self.route, self.requests)
+
+    def sketch(self):
+        return LatencySketch(json.loads(self.latency), self.slowest)
+
+    class Meta:
+        ordering = ('-date', 'route')
+        unique_together = (('date', 'route'),)
+        verbose_name_plural = 'daily usage'
+
+
+# =============================================================================
+# == Backups
+# =============================================================================
+
+class Deletion(TimeStampedModel):
+    """A row deleted from one of the TRACKED_MODELS, so that incremental
+    backups (see scripts/backups) can carry deletions as well as changes.
+    Entries older than the latest full backup are pruned by the backups.
+    """
+    # In the order they're loaded, so that references can be resolved
+    TRACKED_MODELS = (
+        'auth.Group',
+        'auth.User',
+        'checkouts.Airstrip',
+        'checkouts.AircraftType',
+        'checkouts.Checkout',
+        'checkouts.PilotWeight',
+    )
+
+    model = models.CharField(max_length=64, help_text="App label and model, e.g. 'checkouts.Checkout'")
+    object_id = models.PositiveIntegerField()
+
+    def __str__(self):
+        return "%s %d" % (self.model, self.object_id)
+
+    class Meta:
+        ordering = ('created',)
+
+
+def record_deletion(sender, instance, **kwargs):
+    Deletion.objects.create(model=sender._meta.label, object_id=instance.pk)
+
+# Connected to each model separately, since a receiver for every model would
+# stop Django from deleting the others' rows in bulk
+for label in Deletion.TRACKED_MODELS:
+    post_delete.connect(record_deletion, sender=label, dispatch_uid='record_deletion_%s' % label)
+
+
+@contextlib.contextmanager
+def deletions_untracked():
+    """Deletes rows without recording Deletions for them, e.g. when replaying
+    deletions which were recorded elsewhere."""
+    for label in Deletion.TRACKED_MODELS:
+        post_delete.disconnect(sender=label, dispatch_uid='record_deletion_%s' % label)
+    try:
+        yield
+    finally:
+        for label in Deletion.TRACKED_MODELS:
+            post_delete.connect(record_deletion, sender=label, dispatch_uid='record_deletion_%s' % label)
@@ -0,0 +1,104 @@
+"""On-disk ring buffer of cProfile captures for slow requests
+
+Each capture is a pair of files in the configured directory: the marshalled
+pstats data (NAME.prof) and a small JSON description of the request
+(NAME.json). Names sort chronologically, so the oldest captures are removed
+first once the buffer grows past its capacity.
+"""
+import datetime
+import json
+import logging
+import os
+import pstats
+import re
+
+
+logger = logging.getLogger(__name__)
+
+# e.g. 20190801T114905123456-4321 (UTC timestamp and worker PID)
+CAPTURE_NAME = re.compile(r'^\d{8}T\d{12}-\d+$')
+
+
+def save_capture(profile, config, details):
+    """Writes the profile and its request details to the ring buffer."""
+    path = config['path']
+    os.makedirs(path, exist_ok=True)
+    timestamp = datetime.datetime.utcnow()
+    name = '%s-%d' % (timestamp.strftime('%Y%m%dT%H%M%S%f'), os.getpid())
+    base = os.path.join(path, name)
+
+    details = dict(details, name=name, captured=timestamp.isoformat())
+    with open(base + '.json.tmp', 'w') as f:
+        json.dump(details, f)
+    profile.dump_stats(base + '.prof.tmp')
+    # The .prof file is what marks a capture as complete, so it goes last
+    os.replace(base + '.json.tmp', base + '.json')
+    os.replace(base + '.prof.tmp', base + '.prof')
+    logger.info("Saved profile '%s' for %s %s (%.0fms)" % (name, details['method'], details['path'], details['elapsed']))
+
+    prune_captures(path, config['capacity'])
+    return name
+
+
+def capture_names(path):
+    """Returns the names of the complete captures, oldest first."""
+    try:
+        filenames = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    names = [f[:-len('.prof')] for f in filenames if f.endswith('.prof')]
+    return sorted(n for n in names if CAPTURE_NAME.match(n))
+
+
+def prune_captures(path, capacity):
+    """Removes the oldest captures beyond the buffer's capacity."""
+    names = capture_names(path)
+    for name in names[:max(len(names) - capacity, 0)]:
+        for extension in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(path, name + extension))
+            except FileNotFoundError:
+                pass # Another worker got here first
+
+
+def read_details(path, name):
+    try:
+        with open(os.path.join(path, name + '.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'name': name}
+
+
+def list_captures(path):
+    """Returns the request details for each capture, newest first."""
+    return [read_details(path, name) for name in reversed(capture_names(path))]
+
+
+def top_functions(filename, limit=40):
+    """Summarizes the functions with the greatest cumulative time."""
+    stats = pstats.Stats(filename)
+    rows = []
+    for func, (primitive, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            'function': pstats.func_std_string(func),
+            'ncalls':   ncalls,
+            'primitive': primitive,
+            'tottime':  tottime * 1000.0,
+            'cumtime':  cumtime * 1000.0,
+        })
+    rows.sort(key=lambda r: r['cumtime'], reverse=True)
+    return rows[:limit]
+
+
+def load_capture(path, name, limit=40):
+    """Returns the request details and top functions for the named capture,
+    or None if there is no such capture."""
+    if not CAPTURE_NAME.match(name):
+        return None
+    try:
+        functions = top_functions(os.path.join(path, name + '.prof'), limit)
+    except FileNotFoundError:
+        return None
+    capture = read_details(path, name)
+    capture['functions'] = functions
+    return capture
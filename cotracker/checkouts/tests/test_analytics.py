@@ -0,0 +1,130 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from checkouts import analytics
+
+
+LINE = '2019-08-01T11:49:05+0000 [1234]: at=INFO client=kim@example.com@10.0.0.1 method=POST path=/checkouts/ queue=3ms real=45ms mw=2ms view=30ms tpl=13ms db=20ms queries=7 status=200 bytes=5120 useragent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)"\n'
+OLD_LINE = '2019-08-01T11:49:05+0000 [1234]: at=INFO client=anonymous@10.0.0.1 method=GET path=/login/ queue=0ms real=5ms status=200 bytes=1346 useragent="None"\n'
+JSON_LINE = json.dumps({
+    'v': 1, 'timestamp': '2019-08-01T11:49:05+0000', 'pid': 1234, 'level': 'INFO',
+    'username': 'kim@example.com', 'ip': '10.0.0.1', 'method': 'POST', 'path': '/checkouts/',
+    'queue': 3, 'real': 45, 'mw': 2, 'view': 30, 'tpl': 13, 'db': 20, 'queries': 7,
+    'status': 200, 'bytes': 5120,
+    'useragent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)',
+}) + '\n'
+
+
+class ParseLineTests(unittest.TestCase):
+
+    def test_parse(self):
+        record = analytics.parse_line(LINE)
+        self.assertEqual(record['date'], '2019-08-01')
+        self.assertEqual(record['time'], '11:49:05')
+        self.assertEqual(record['pid'], '1234')
+        self.assertEqual(record['level'], 'INFO')
+        self.assertEqual(record['username'], 'kim@example.com')
+        self.assertEqual(record['ip'], '10.0.0.1')
+        self.assertEqual(record['path'], '/checkouts/')
+        self.assertEqual(record['real'], 45)
+        self.assertEqual(record['queries'], 7)
+        self.assertEqual(record['status'], '200')
+        self.assertEqual(record['bytes'], 5120)
+        self.assertEqual(record['useragent'], 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)')
+
+    def test_parse_without_timing_breakdown(self):
+        record = analytics.parse_line(OLD_LINE)
+        self.assertEqual(record['real'], 5)
+        self.assertNotIn('db', record)
+        self.assertEqual(record['useragent'], 'None')
+
+    def test_malformed(self):
+        self.assertIsNone(analytics.parse_line('Traceback (most recent call last):\n'))
+        self.assertIsNone(analytics.parse_line(LINE.replace('real=45ms', 'real=fast')))
+
+    def test_parse_json(self):
+        text = analytics.parse_line(LINE)
+        record = analytics.parse_line(JSON_LINE)
+        self.assertEqual(record, text)
+
+    def test_malformed_json(self):
+        self.assertIsNone(analytics.parse_line('{"v": 1, "timestamp": "2019-08-01T11:49:05+0000"\n'))
+        self.assertIsNone(analytics.parse_line(JSON_LINE.replace('"v": 1', '"v": 99')))
+        self.assertIsNone(analytics.parse_line('{"timestamp": 5}\n'))
+
+    def test_epoch(self):
+        to_epoch = analytics.EpochParser()
+        self.assertEqual(to_epoch('1970-01-01T00:01:00+0000'), 60)
+        self.assertEqual(to_epoch('1970-01-01T00:01:00-0100'), 3660)
+
+
+class OpenLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_plain_and_gzipped(self):
+        plain = os.path.join(self.path, 'analytics.log')
+        with open(plain, 'w') as f:
+            f.write(LINE)
+        compressed = os.path.join(self.path, 'analytics.log.1.gz')
+        with gzip.open(compressed, 'wt') as f:
+            f.write(OLD_LINE)
+
+        with analytics.open_log(plain) as f:
+            self.assertEqual(f.read(), LINE)
+        with analytics.open_log(compressed) as f:
+            self.assertEqual(f.read(), OLD_LINE)
+
+
+class NormalizeRouteTests(unittest.TestCase):
+
+    def test_routes_match_urls(self):
+        from django.urls import resolve
+        for path in ['/pilots/kim/', '/airstrips/WMKK/', '/bases/WMKK/attached/',
+                     '/bases/WMKK/unattached/', '/bases/WMKK/edit/', '/checkouts/',
+                     '/checkouts/edit/', '/weights/kim/edit/', '/emerald/profiles/x-1/',
+                     '/emerald/usage/', '/emerald/dbstats/']:
+            view = resolve(path).func.view_class.__name__
+            self.assertEqual(analytics.normalize_route(path), view)
+
+    def test_unknown(self):
+        self.assertEqual(analytics.normalize_route('/emerald/auth/user/'), 'admin')
+        self.assertEqual(analytics.normalize_route('/wp-login.php'), 'other')
+
+
+class LatencySketchTests(unittest.TestCase):
+
+    def test_buckets_cover_values(self):
+        sketch = analytics.LatencySketch()
+        for value in range(20000):
+            bucket = sketch.bucket(value)
+            self.assertLessEqual(sketch.lower(bucket), value)
+            self.assertGreaterEqual(sketch.upper(bucket), value)
+
+    def test_percentiles(self):
+        sketch = analytics.LatencySketch()
+        self.assertIsNone(sketch.percentile(50))
+        for value in range(1, 10001):
+            sketch.add(value)
+        self.assertAlmostEqual(sketch.percentile(50), 5000, delta=5000 / 64)
+        self.assertAlmostEqual(sketch.percentile(99), 9900, delta=9900 / 64)
+        self.assertEqual(sketch.percentile(100), 10000)
+        self.assertEqual(sketch.percentile(1), 100)
+
+    def test_merge(self):
+        whole, odd, even = analytics.LatencySketch(), analytics.LatencySketch(), analytics.LatencySketch()
+        for value in range(1000):
+            whole.add(value * 7)
+            (odd if value % 2 else even).add(value * 7)
+        even.merge(analytics.LatencySketch(odd.to_dict(), odd.maximum))
+        self.assertEqual(even.total, 1000)
+        self.assertEqual(even.counts, whole.counts)
+        self.assertEqual(even.percentile(95), whole.percentile(95))
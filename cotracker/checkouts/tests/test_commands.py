@@ -0,0 +1,171 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+
+from checkouts.models import Checkout, DailyUsage, Deletion
+import checkouts.tests.helper as helper
+
+
+LINES = [
+    '2019-08-01T11:49:05+0000 [1234]: at=INFO client=kim@10.0.0.1 method=GET path=/pilots/kim/ queue=0ms real=40ms status=200 bytes=100 useragent="x"',
+    '2019-08-01T11:49:06+0000 [1234]: at=INFO client=sam@10.0.0.2 method=GET path=/pilots/sam/ queue=0ms real=60ms status=404 bytes=100 useragent="x"',
+    '2019-08-01T11:49:07+0000 [1234]: at=INFO client=kim@10.0.0.1 method=POST path=/checkouts/ queue=0ms real=900ms status=500 bytes=100 useragent="x"',
+    'Traceback (most recent call last):',
+    '2019-08-02T08:00:00+0000 [1234]: at=INFO client=kim@10.0.0.1 method=GET path=/checkouts/ queue=0ms real=20ms status=200 bytes=100 useragent="x"',
+]
+
+
+class RollupAnalyticsTests(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log = os.path.join(self.path, 'analytics.log')
+        with open(self.log, 'w') as f:
+            f.write('\n'.join(LINES) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def rollup(self, *args):
+        call_command('rollup_analytics', self.log, *args, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_rollup(self):
+        self.rollup()
+        day = DailyUsage.objects.get(date='2019-08-01', route=DailyUsage.ALL_ROUTES)
+        self.assertEqual(day.requests, 3)
+        self.assertEqual(day.users, 2)
+        self.assertEqual(day.ips, 2)
+        self.assertEqual(day.client_errors, 1)
+        self.assertEqual(day.server_errors, 1)
+        self.assertEqual(day.slowest, 900)
+        self.assertEqual(day.sketch().percentile(50), 60)
+
+        pilots = DailyUsage.objects.get(date='2019-08-01', route='GET PilotDetail')
+        self.assertEqual(pilots.requests, 2)
+        self.assertEqual(DailyUsage.objects.filter(date='2019-08-02').count(), 2)
+
+    def test_rerun_replaces_days(self):
+        self.rollup()
+        self.rollup()
+        self.assertEqual(DailyUsage.objects.count(), 5)
+        self.assertEqual(DailyUsage.objects.get(date='2019-08-01', route=DailyUsage.ALL_ROUTES).requests, 3)
+
+    def test_since(self):
+        self.rollup('--since', '2019-08-02')
+        self.assertEqual(DailyUsage.objects.count(), 2)
+        self.assertFalse(DailyUsage.objects.filter(date='2019-08-01').exists())
+
+    def test_counts_shed_requests(self):
+        with open(self.log, 'a') as f:
+            f.write(LINES[2].replace('status=500', 'status=503') + '\n')
+        self.rollup()
+        day = DailyUsage.objects.get(date='2019-08-01', route=DailyUsage.ALL_ROUTES)
+        self.assertEqual(day.server_errors, 2)
+        self.assertEqual(day.shed, 1)
+        self.assertEqual(DailyUsage.objects.get(date='2019-08-01', route='POST FilterFormView').shed, 1)
+
+    def write_segments(self):
+        # The log was rotated by size part way through 2019-08-01
+        with gzip.open(os.path.join(self.path, 'analytics.log.20190801T114906.gz'), 'wt') as f:
+            f.write('\n'.join(LINES[:2]) + '\n')
+        with open(self.log, 'w') as f:
+            f.write('\n'.join(LINES[2:]) + '\n')
+
+    def rollup_default(self, backup_count):
+        with self.settings(LOGS_PATH=self.path, LOG_ROTATION={'backup_count': backup_count}):
+            call_command('rollup_analytics', stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_reads_rotated_segments(self):
+        self.write_segments()
+        self.rollup_default(backup_count=30)
+        self.assertEqual(DailyUsage.objects.get(date='2019-08-01', route=DailyUsage.ALL_ROUTES).requests, 3)
+
+    def test_keeps_day_of_pruned_segments(self):
+        self.write_segments()
+        self.rollup_default(backup_count=30)
+        os.remove(os.path.join(self.path, 'analytics.log.20190801T114906.gz'))
+        with gzip.open(os.path.join(self.path, 'analytics.log.20190801T114907.gz'), 'wt') as f:
+            f.write(LINES[2] + '\n')
+        with open(self.log, 'w') as f:
+            f.write('\n'.join(LINES[3:]) + '\n')
+        # Only one segment is kept, so earlier ones may have been pruned
+        self.rollup_default(backup_count=1)
+        self.assertEqual(DailyUsage.objects.get(date='2019-08-01', route=DailyUsage.ALL_ROUTES).requests, 3)
+        self.assertEqual(DailyUsage.objects.get(date='2019-08-02', route=DailyUsage.ALL_ROUTES).requests, 1)
+
+
+class DbstatsTests(TestCase):
+
+    def dbstats(self, *args):
+        output = io.StringIO()
+        call_command('dbstats', *args, stdout=output)
+        return output.getvalue()
+
+    def test_dbstats(self):
+        DailyUsage.objects.create(date='2019-08-01', route=DailyUsage.ALL_ROUTES, requests=1,
+            users=1, ips=1, client_errors=0, server_errors=0, slowest=1, latency='{}')
+        output = self.dbstats('--exact', '--jobs', '1')
+        line = next(line for line in output.splitlines() if line.startswith(DailyUsage._meta.db_table + ' '))
+        self.assertEqual(line.split()[1], '1')
+        self.assertIn('tables with', output.splitlines()[-1])
+
+
+class DedupeCheckoutsTests(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fixture = os.path.join(self.path, 'checkout.json')
+        checkouts = [
+            {'model': 'checkouts.checkout', 'pk': pk, 'fields': {'pilot': 1, 'airstrip': airstrip, 'aircraft_type': 1}}
+            for pk, airstrip in [(4, 1), (5, 2), (6, 1)]
+        ]
+        with open(self.fixture, 'w') as f:
+            json.dump(checkouts, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def dedupe(self, *args):
+        output = io.StringIO()
+        call_command('dedupe_checkouts', *args, stdout=output)
+        return output.getvalue()
+
+    def test_fixture(self):
+        output = self.dedupe(self.fixture, '--renumber')
+        self.assertIn('Kept 2 unique checkouts; left out 1 duplicates', output)
+        with open(os.path.join(self.path, 'unique_checkout.json')) as f:
+            checkouts = json.load(f)
+        self.assertEqual([(c['pk'], c['fields']['airstrip']) for c in checkouts], [(1, 1), (2, 2)])
+
+    def test_errors(self):
+        with self.assertRaises(CommandError):
+            self.dedupe()
+        with self.assertRaises(CommandError):
+            self.dedupe(self.fixture, '--output', self.fixture)
+        with open(self.fixture, 'a') as f:
+            f.write('trailing')
+        with self.assertRaises(CommandError):
+            self.dedupe(self.fixture)
+        self.assertEqual(os.listdir(self.path), ['checkout.json'])
+
+    def test_in_database(self):
+        self.assertIn('Deleted 0 duplicate checkouts', self.dedupe('--in-database'))
+
+        # Duplicates can only be added without the unique constraint (which
+        # comes back when the test's transaction is rolled back)
+        with connection.schema_editor() as editor:
+            editor.alter_unique_together(Checkout, Checkout._meta.unique_together, ())
+        first = helper.create_checkout()
+        for _ in range(2):
+            Checkout.objects.create(pilot=first.pilot, airstrip=first.airstrip, aircraft_type=first.aircraft_type)
+        self.assertIn('Deleted 2 duplicate checkouts', self.dedupe('--in-database'))
+        self.assertEqual(list(Checkout.objects.values_list('pk', flat=True)), [first.pk])
+        self.assertEqual(Deletion.objects.filter(model='checkouts.Checkout').count(), 2)
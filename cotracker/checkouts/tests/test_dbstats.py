@@ -0,0 +1,52 @@
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from checkouts.dbstats import exact_counts, table_stats
+from checkouts.models import Airstrip
+import checkouts.tests.helper as helper
+
+
+class TableStatsTests(TestCase):
+
+    def setUp(self):
+        for ident in ('AAAA', 'BBBB', 'CCCC'):
+            helper.create_airstrip(ident=ident)
+
+    def get_table(self, tables, name):
+        return next(table for table in tables if table['table'] == name)
+
+    def test_estimates(self):
+        tables = table_stats()
+        self.assertEqual(
+            sorted(table['table'] for table in tables),
+            sorted(connection.introspection.table_names()),
+        )
+        airstrips = self.get_table(tables, Airstrip._meta.db_table)
+        # SQLite's are counted, not estimated, until it has been analyzed
+        self.assertEqual(airstrips['rows'], 3)
+        self.assertIsNone(airstrips['exact'])
+        self.assertIsNone(airstrips['last_vacuum'])
+        if airstrips['total_bytes'] is not None:
+            self.assertEqual(airstrips['total_bytes'], airstrips['table_bytes'] + airstrips['index_bytes'])
+            self.assertGreater(airstrips['index_bytes'], 0)
+
+    def test_analyzed(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        helper.create_airstrip(ident='DDDD')
+        airstrips = self.get_table(table_stats(exact=True, jobs=1), Airstrip._meta.db_table)
+        # The statistics are as of the last ANALYZE
+        self.assertEqual(airstrips['rows'], 3)
+        self.assertEqual(airstrips['exact'], 4)
+
+
+class ExactCountsTests(TransactionTestCase):
+    # Counted on connections of their own, which can only see what's committed
+
+    def test_parallel(self):
+        for ident in ('AAAA', 'BBBB', 'CCCC'):
+            helper.create_airstrip(ident=ident)
+        tables = connection.introspection.table_names()
+        counts = exact_counts(tables, jobs=3)
+        self.assertEqual(counts, exact_counts(tables, jobs=1))
+        self.assertEqual(counts[Airstrip._meta.db_table], 3)
@@ -0,0 +1,116 @@
+import io
+import json
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase
+
+from checkouts.dedupe import (
+    FixtureDeduplicator,
+    delete_duplicate_checkouts,
+    duplicate_checkout_pks,
+    iter_json_array,
+    write_json_array,
+)
+from checkouts.models import Checkout, Deletion
+import checkouts.tests.helper as helper
+
+
+def checkout(pk, pilot, airstrip, aircraft_type):
+    return {
+        'model': 'checkouts.checkout',
+        'pk': pk,
+        'fields': {'pilot': pilot, 'airstrip': airstrip, 'aircraft_type': aircraft_type, 'date': '2019-08-01'},
+    }
+
+
+OBJECTS = [
+    {'model': 'checkouts.airstrip', 'pk': 1, 'fields': {'ident': 'KATL', 'name': 'Atlanta "Hartsfield" ]}'}},
+    checkout(1, 1, 1, 1),
+    checkout(2, 1, 1, 2),
+    checkout(3, 1, 1, 1),
+    checkout(5, 2, 1, 1),
+    checkout(8, 1, 1, 1),
+    checkout(9, ['kim'], 1, 1),
+    checkout(10, ['kim'], 1, 1),
+]
+
+
+class IterJsonArrayTests(TestCase):
+
+    def test_iter(self):
+        text = json.dumps(OBJECTS, indent=4)
+        # However the reads fall, every element is decoded whole
+        for read_size in (1, 7, 100, 100000):
+            self.assertEqual(list(iter_json_array(io.StringIO(text), read_size)), OBJECTS)
+        self.assertEqual(list(iter_json_array(io.StringIO(' [ ] '))), [])
+        self.assertEqual(list(iter_json_array(io.StringIO('[1, "two", [3]]'), 2)), [1, 'two', [3]])
+
+    def test_malformed(self):
+        for text in ('', '{"pk": 1}', '[] x', '[{"pk": 1}', '[{"pk": 1},', '[{"pk": 1}, {"pk": }]'):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                list(iter_json_array(io.StringIO(text), 3))
+
+    def test_write(self):
+        output = io.StringIO()
+        self.assertEqual(write_json_array(output, iter(OBJECTS)), len(OBJECTS))
+        self.assertEqual(json.loads(output.getvalue()), OBJECTS)
+        output = io.StringIO()
+        write_json_array(output, iter([]))
+        self.assertEqual(json.loads(output.getvalue()), [])
+
+
+class FixtureDeduplicatorTests(TestCase):
+
+    def test_filter(self):
+        deduplicator = FixtureDeduplicator()
+        kept = list(deduplicator.filter(json.loads(json.dumps(OBJECTS))))
+        self.assertEqual([obj['pk'] for obj in kept], [1, 1, 2, 5, 9])
+        self.assertEqual(deduplicator.checkouts, 4)
+        self.assertEqual(deduplicator.duplicates, 3)
+        self.assertIn((('kim',), 1, 1), deduplicator.seen)
+
+    def test_renumber(self):
+        kept = list(FixtureDeduplicator(renumber=True).filter(json.loads(json.dumps(OBJECTS))))
+        # Only checkouts are renumbered
+        self.assertEqual([obj['pk'] for obj in kept], [1, 1, 2, 3, 4])
+
+
+class DeleteDuplicateCheckoutsTests(TestCase):
+
+    def test_no_duplicates(self):
+        helper.create_checkout()
+        self.assertEqual(delete_duplicate_checkouts(), 0)
+        self.assertEqual(Checkout.objects.count(), 1)
+
+    def create_duplicates(self):
+        """Returns the oldest checkout, another of the same pilot and the
+        primary keys of three duplicates of the oldest."""
+        # Duplicates can only be added without the unique constraint (which
+        # comes back when the test's transaction is rolled back)
+        with connection.schema_editor() as editor:
+            editor.alter_unique_together(Checkout, Checkout._meta.unique_together, ())
+        first = helper.create_checkout()
+        other = helper.create_checkout(
+            pilot=first.pilot, airstrip=helper.create_airstrip(ident='WXYZ'), aircraft_type=first.aircraft_type)
+        duplicates = [
+            Checkout.objects.create(pilot=first.pilot, airstrip=first.airstrip, aircraft_type=first.aircraft_type).pk
+            for _ in range(3)
+        ]
+        return first, other, duplicates
+
+    def test_without_window_functions(self):
+        first, other, duplicates = self.create_duplicates()
+        with mock.patch('checkouts.dedupe.supports_window_functions', return_value=False):
+            self.assertEqual(duplicate_checkout_pks(), duplicates)
+
+    def test_delete(self):
+        first, other, duplicates = self.create_duplicates()
+        self.assertEqual(duplicate_checkout_pks(), duplicates)
+        self.assertEqual(delete_duplicate_checkouts(), 3)
+        self.assertEqual(sorted(Checkout.objects.values_list('pk', flat=True)), sorted([first.pk, other.pk]))
+        # Recorded, so that incremental backups carry the deletions
+        self.assertEqual(
+            sorted(Deletion.objects.filter(model='checkouts.Checkout').values_list('object_id', flat=True)),
+            duplicates,
+        )
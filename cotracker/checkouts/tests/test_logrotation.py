@@ -0,0 +1,133 @@
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import SimpleTestCase
+
+from checkouts import logrotation
+from checkouts.analytics import open_log
+
+
+class RotatingFileHandlerTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'analytics.log')
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler.close()
+        logrotation.compressor.join()
+        shutil.rmtree(self.path)
+
+    def make_handler(self, **kwargs):
+        handler = logrotation.RotatingFileHandler(self.filename, **kwargs)
+        self.handlers.append(handler)
+        return handler
+
+    def log(self, handler, message, created=None):
+        record = logging.LogRecord('analytics', logging.INFO, __file__, 1, message, None, None)
+        if created is not None:
+            record.created = created
+        handler.emit(record)
+
+    def read_all(self):
+        lines = []
+        for name in logrotation.segment_names(self.filename) + [self.filename]:
+            with open_log(name) as f:
+                lines.extend(line.rstrip('\n') for line in f)
+        return lines
+
+    def test_rotates_by_size(self):
+        handler = self.make_handler(max_bytes=100)
+        messages = ['request %02d %s' % (i, 'x' * 30) for i in range(10)]
+        for message in messages:
+            self.log(handler, message)
+        logrotation.compressor.join()
+
+        segments = logrotation.segment_names(self.filename)
+        self.assertEqual(len(segments), 4)
+        # All but the newest segment are compressed
+        self.assertTrue(all(name.endswith('.gz') for name in segments[:-1]))
+        self.assertFalse(segments[-1].endswith('.gz'))
+        self.assertEqual(self.read_all(), messages)
+        self.assertLessEqual(os.path.getsize(self.filename), 100)
+
+    def test_rotates_by_time(self):
+        handler = self.make_handler(when='midnight')
+        yesterday = time.time() - 86400
+        self.log(handler, 'yesterday', created=yesterday)
+        os.utime(self.filename, (yesterday, yesterday))
+        self.log(handler, 'today')
+
+        self.assertEqual(len(logrotation.segment_names(self.filename)), 1)
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'today\n')
+
+    def test_follows_rotation_by_other_process(self):
+        first = self.make_handler(max_bytes=20)
+        second = self.make_handler(max_bytes=20)
+        self.log(first, 'one' * 5)
+        self.log(second, 'two' * 5)  # Rotates the file 'first' has open
+        self.log(first, 'x')
+
+        self.assertEqual(len(logrotation.segment_names(self.filename)), 1)
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'twotwotwotwotwo\nx\n')
+
+    def test_backup_count(self):
+        handler = self.make_handler(max_bytes=10, backup_count=2)
+        for i in range(6):
+            self.log(handler, 'message %d' % i)
+        logrotation.compressor.join()
+
+        self.assertEqual(len(logrotation.segment_names(self.filename)), 2)
+        self.assertEqual(self.read_all(), ['message 3', 'message 4', 'message 5'])
+
+    def test_segment_order(self):
+        for name in ['analytics.log.20191018T221300-10', 'analytics.log.20191018T221300-2.gz',
+                     'analytics.log.20191018T221300.gz', 'analytics.log.20191017T000000',
+                     'analytics.log.lock', 'analytics.log.20191018T221300-3.gz.tmp']:
+            open(os.path.join(self.path, name), 'w').close()
+        self.assertEqual([os.path.basename(name) for name in logrotation.segment_names(self.filename)], [
+            'analytics.log.20191017T000000',
+            'analytics.log.20191018T221300.gz',
+            'analytics.log.20191018T221300-2.gz',
+            'analytics.log.20191018T221300-10',
+        ])
+
+    def write_segment(self, name, text):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(text)
+
+    def test_interrupted_compression(self):
+        # A worker died part way through compressing the oldest segment
+        self.write_segment('analytics.log.20191017T000000', 'one\n')
+        self.write_segment('analytics.log.20191017T000000.gz.tmp', 'partial')
+        self.write_segment('analytics.log.20191018T000000', 'two\n')
+        self.write_segment('analytics.log', 'three\n')
+        logrotation.tidy_segments(self.filename, backup_count=0)
+
+        self.assertEqual(sorted(os.listdir(self.path)), [
+            'analytics.log', 'analytics.log.20191017T000000.gz', 'analytics.log.20191018T000000',
+        ])
+        self.assertEqual(self.read_all(), ['one', 'two', 'three'])
+
+    def test_compression_in_progress(self):
+        segment = os.path.join(self.path, 'analytics.log.20191017T000000')
+        self.write_segment(segment, 'one\n')
+        with open(segment, 'rb') as f:
+            # Locked as another process compressing it would have it
+            fcntl.flock(f, fcntl.LOCK_EX)
+            logrotation.compress(segment)
+        self.assertEqual(os.listdir(self.path), ['analytics.log.20191017T000000'])
+
+    def test_next_segment_name(self):
+        stamp = '20191018T221300'
+        self.assertEqual(logrotation.next_segment_name(self.filename, stamp), '%s.%s' % (self.filename, stamp))
+        # The first segments of the second have been pruned already
+        self.write_segment('analytics.log.%s-3.gz' % stamp, '')
+        self.assertEqual(logrotation.next_segment_name(self.filename, stamp), '%s.%s-4' % (self.filename, stamp))
@@ -0,0 +1,303 @@
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.template import engines
+from django.template.response import TemplateResponse
+from django.test import TestCase, RequestFactory, override_settings
+
+from checkouts import analytics, profiling, util
+from checkouts.middleware import (
+    Analytics,
+    HealthCheck,
+    LoadShedder,
+    Profiler,
+    SlowQueries,
+)
+from checkouts.models import SlowQuery
+
+
+class HealthCheckTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def view(self, request):
+        raise AssertionError("Health checks should not reach the application")
+
+    def test_short_circuit(self):
+        response = self.client.get('/healthz', HTTP_USER_AGENT='UptimeRobot/2.0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'ok\n')
+        self.assertEqual(response.cookies, {})
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_other_paths(self):
+        middleware = HealthCheck(lambda request: HttpResponse('app'))
+        response = middleware(self.factory.get('/healthz/extra'))
+        self.assertEqual(response.content, b'app')
+
+    def test_rate_limited_ping(self):
+        middleware = HealthCheck(self.view)
+        with self.assertNumQueries(1):
+            middleware(self.factory.get('/healthz'))
+            middleware(self.factory.get('/healthz'))
+        middleware.last_ping -= middleware.interval
+        with self.assertNumQueries(1):
+            middleware(self.factory.get('/healthz'))
+
+    def test_database_unavailable(self):
+        middleware = HealthCheck(self.view)
+        with mock.patch.object(middleware, 'ping_database', return_value=False):
+            response = middleware(self.factory.get('/healthz'))
+        self.assertEqual(response.status_code, 503)
+
+
+class LoadShedderTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.config = {
+            'retry_after': 7,
+            'routes': {
+                'checkout_filter': {
+                    'methods': ('POST',),
+                    'data': {'checkout_status': 'belum'},
+                    'threshold_ms': 1000,
+                },
+            },
+        }
+
+    def view(self, request):
+        return HttpResponse('ok')
+
+    def queued(self, seconds):
+        return {'HTTP_X_REQUEST_START': 't=%f' % (time.time() - seconds)}
+
+    def run_middleware(self, request):
+        with override_settings(LOAD_SHEDDING=self.config):
+            middleware = LoadShedder(self.view)
+        return middleware, middleware(request)
+
+    @override_settings(LOAD_SHEDDING=None)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            LoadShedder(self.view)
+
+    def test_shed(self):
+        request = self.factory.post('/checkouts/', {'checkout_status': 'belum'}, **self.queued(2))
+        _, response = self.run_middleware(request)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+
+    def test_short_queue(self):
+        request = self.factory.post('/checkouts/', {'checkout_status': 'belum'}, **self.queued(0.5))
+        _, response = self.run_middleware(request)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cheap_requests(self):
+        # Sudah reports are cheap
+        request = self.factory.post('/checkouts/', {'checkout_status': 'sudah'}, **self.queued(2))
+        self.assertEqual(self.run_middleware(request)[1].status_code, 200)
+        # Showing the form is cheap
+        request = self.factory.get('/checkouts/', **self.queued(2))
+        self.assertEqual(self.run_middleware(request)[1].status_code, 200)
+        # Other routes are not configured
+        request = self.factory.post('/pilots/', **self.queued(2))
+        self.assertEqual(self.run_middleware(request)[1].status_code, 200)
+        # Without a queue time, nothing is shed
+        request = self.factory.post('/checkouts/', {'checkout_status': 'belum'})
+        self.assertEqual(self.run_middleware(request)[1].status_code, 200)
+
+
+class AnalyticsServerTimingTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def run_middleware(self, view, request):
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            response = view(request)
+            if hasattr(response, 'render'):
+                response = middleware.process_template_response(request, response)
+                response.render()
+            return response
+        middleware = Analytics(get_response)
+        return middleware(request)
+
+    def get_durations(self, response):
+        durations = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, _, duration = entry.split(';')
+            durations[name] = float(duration.split('=')[1])
+        return durations
+
+    def test_phases(self):
+        def view(request):
+            User.objects.count()
+            template = engines['django'].from_string('{{ users|length }}')
+            return TemplateResponse(request, template, {'users': User.objects.all()})
+        request = self.factory.get('/')
+        request.user = AnonymousUser()
+
+        response = self.run_middleware(view, request)
+        durations = self.get_durations(response)
+        self.assertEqual(
+            sorted(durations.keys()),
+            sorted(['mw', 'view', 'db', 'tpl', 'total'])
+        )
+        # One query in the view, one more while rendering
+        self.assertEqual(request._timing['queries'], 2)
+        self.assertGreater(durations['db'], 0)
+
+    def test_queue(self):
+        def view(request):
+            return HttpResponse('ok')
+        start = time.time() - 0.25
+        request = self.factory.get('/', HTTP_X_REQUEST_START='t=%f' % start)
+        request.user = AnonymousUser()
+
+        response = self.run_middleware(view, request)
+        durations = self.get_durations(response)
+        self.assertGreaterEqual(durations['queue'], 250)
+        self.assertEqual(durations['tpl'], 0)
+
+    @override_settings(ANALYTICS_LOG_FORMAT='json')
+    def test_json_log(self):
+        def view(request):
+            return HttpResponse('ok')
+        request = self.factory.get('/pilots/', HTTP_USER_AGENT='Mozilla "quoted" 5.0')
+        request.user = AnonymousUser()
+
+        with self.assertLogs('analytics') as logs:
+            self.run_middleware(view, request)
+        record = analytics.parse_line(logs.records[0].getMessage())
+        self.assertEqual(record['path'], '/pilots/')
+        self.assertEqual(record['username'], 'anonymous')
+        self.assertEqual(record['status'], '200')
+        self.assertEqual(record['bytes'], 2)
+        self.assertEqual(record['useragent'], 'Mozilla "quoted" 5.0')
+
+    def test_monitor_agent(self):
+        def view(request):
+            return HttpResponse('ok')
+        request = self.factory.get('/', HTTP_USER_AGENT='UptimeRobot/2.0')
+
+        response = self.run_middleware(view, request)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class ProfilerTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.path = tempfile.mkdtemp()
+        self.config = {
+            'sample_rate': 0.0,
+            'threshold_ms': None,
+            'capacity': 5,
+            'path': self.path,
+        }
+        self.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def view(self, request):
+        return HttpResponse('ok')
+
+    @override_settings(PROFILER_CONFIG=None)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            Profiler(self.view)
+
+    def test_forced_by_superuser(self):
+        request = self.factory.get('/checkouts/?profile')
+        request.user = self.superuser
+        with override_settings(PROFILER_CONFIG=self.config):
+            response = Profiler(self.view)(request)
+        self.assertEqual(response.status_code, 200)
+        captures = profiling.list_captures(self.path)
+        self.assertEqual(len(captures), 1)
+        self.assertEqual(captures[0]['path'], '/checkouts/?profile')
+        self.assertEqual(captures[0]['user'], 'admin')
+
+    def test_not_forced_by_others(self):
+        request = self.factory.get('/checkouts/?profile')
+        request.user = AnonymousUser()
+        with override_settings(PROFILER_CONFIG=self.config):
+            Profiler(self.view)(request)
+        self.assertEqual(profiling.list_captures(self.path), [])
+
+    def test_not_sampled(self):
+        request = self.factory.get('/checkouts/')
+        request.user = AnonymousUser()
+        with override_settings(PROFILER_CONFIG=self.config), mock.patch('cProfile.Profile') as profile:
+            Profiler(self.view)(request)
+        # Without a threshold, requests which aren't sampled aren't profiled
+        profile.assert_not_called()
+        self.assertEqual(profiling.list_captures(self.path), [])
+
+    def test_sampled(self):
+        # Saved however fast they are
+        self.config.update(sample_rate=1.0, threshold_ms=60000.0)
+        request = self.factory.get('/checkouts/')
+        request.user = AnonymousUser()
+        with override_settings(PROFILER_CONFIG=self.config):
+            Profiler(self.view)(request)
+        self.assertEqual(len(profiling.list_captures(self.path)), 1)
+
+    def test_threshold(self):
+        request = self.factory.get('/checkouts/')
+        request.user = AnonymousUser()
+        with override_settings(PROFILER_CONFIG=self.config):
+            # Not sampled, and faster than the threshold
+            self.config['threshold_ms'] = 60000.0
+            Profiler(self.view)(request)
+            self.assertEqual(profiling.list_captures(self.path), [])
+            # Not sampled, but slower than the threshold
+            self.config['threshold_ms'] = 0.0
+            Profiler(self.view)(request)
+            self.assertEqual(len(profiling.list_captures(self.path)), 1)
+
+
+class SlowQueriesTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.config = {'threshold_ms': 0.0, 'explain': True, 'capacity': 3}
+
+    def view(self, request):
+        util.get_aircrafttype_names()
+        return HttpResponse('ok')
+
+    @override_settings(SLOW_QUERY_CONFIG=None)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            SlowQueries(self.view)
+
+    def test_records(self):
+        request = self.factory.get('/checkouts/')
+        with override_settings(SLOW_QUERY_CONFIG=self.config):
+            SlowQueries(self.view)(request)
+        record = SlowQuery.objects.get()
+        self.assertEqual(record.path, '/checkouts/')
+        self.assertIn('checkouts_aircrafttype', record.sql)
+        self.assertTrue(record.stack.startswith('checkouts/util.py'))
+        # EXPLAIN is only available on PostgreSQL
+        self.assertEqual(record.plan, '')
+
+    def test_threshold(self):
+        self.config['threshold_ms'] = 60000.0
+        request = self.factory.get('/checkouts/')
+        with override_settings(SLOW_QUERY_CONFIG=self.config):
+            SlowQueries(self.view)(request)
+        self.assertEqual(SlowQuery.objects.count(), 0)
+
+    def test_capacity(self):
+        request = self.factory.get('/checkouts/')
+        with override_settings(SLOW_QUERY_CONFIG=self.config):
+            middleware = SlowQueries(self.view)
+            for _ in range(5):
+                middleware(request)
+        self.assertEqual(SlowQuery.objects.count(), 3)
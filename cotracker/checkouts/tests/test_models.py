@@ -2,10 +2,15 @@ from django.contrib.auth.models import User
 from django.test import TestCase
 
 from checkouts.models import (
+    AircraftType,
     Checkout,
+    DailyUsage,
+    Deletion,
+    SlowQuery,
     user_full_name,
     user_is_pilot,
     user_is_flight_scheduler,
+    deletions_untracked,
 )
 
 import checkouts.tests.helper as helper
@@ -162,3 +167,40 @@ class VerifyPatchedUserModelTests(TestCase):
     def test_unicode(self):
         expected = '%s, %s' % (self.pilot.last_name, self.pilot.first_name)
         self.assertEqual(str(self.pilot), expected)
+
+
+class DeletionTests(TestCase):
+
+    def test_records_deletions(self):
+        checkout = helper.create_checkout()
+        checkout_id, airstrip_id = checkout.pk, checkout.airstrip_id
+        checkout.airstrip.delete()
+        # The checkout goes with its airstrip, and is recorded too
+        self.assertEqual(
+            set(Deletion.objects.values_list('model', 'object_id')),
+            {('checkouts.Airstrip', airstrip_id), ('checkouts.Checkout', checkout_id)}
+        )
+
+    def test_records_bulk_deletions(self):
+        helper.create_aircrafttype('A')
+        helper.create_aircrafttype('B')
+        AircraftType.objects.all().delete()
+        self.assertEqual(Deletion.objects.filter(model='checkouts.AircraftType').count(), 2)
+
+    def test_ignores_untracked_models(self):
+        SlowQuery.objects.create(view='v', path='/', duration=1, sql='SELECT 1')
+        SlowQuery.objects.all().delete()
+        # Rollups are only carried by full backups
+        DailyUsage.objects.create(date='2019-08-01', route=DailyUsage.ALL_ROUTES, requests=1,
+            users=1, ips=1, client_errors=0, server_errors=0, slowest=1, latency='{}')
+        DailyUsage.objects.all().delete()
+        self.assertFalse(Deletion.objects.exists())
+
+    def test_deletions_untracked(self):
+        helper.create_aircrafttype('A')
+        with deletions_untracked():
+            AircraftType.objects.all().delete()
+        self.assertFalse(Deletion.objects.exists())
+        # And tracked again afterwards
+        helper.create_aircrafttype('B').delete()
+        self.assertEqual(Deletion.objects.count(), 1)
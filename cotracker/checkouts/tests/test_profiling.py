@@ -0,0 +1,45 @@
+import cProfile
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from checkouts import profiling
+
+
+class ProfilingRingBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config = {'path': self.path, 'capacity': 2}
+        self.details = {'method': 'GET', 'path': '/checkouts/', 'elapsed': 12.5}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_profile(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        sorted(range(1000), reverse=True)
+        profile.disable()
+        return profile
+
+    def test_empty(self):
+        self.assertEqual(profiling.list_captures(self.path), [])
+        self.assertEqual(profiling.list_captures(self.path + '/missing'), [])
+
+    def test_capacity(self):
+        names = [profiling.save_capture(self.make_profile(), self.config, self.details) for _ in range(3)]
+        captures = profiling.list_captures(self.path)
+        # Newest first, oldest one pruned
+        self.assertEqual([c['name'] for c in captures], [names[2], names[1]])
+        self.assertIsNone(profiling.load_capture(self.path, names[0]))
+
+    def test_load_capture(self):
+        name = profiling.save_capture(self.make_profile(), self.config, self.details)
+        capture = profiling.load_capture(self.path, name)
+        self.assertEqual(capture['path'], '/checkouts/')
+        functions = [row['function'] for row in capture['functions']]
+        self.assertTrue(any('sorted' in f for f in functions))
+
+    def test_load_capture_rejects_paths(self):
+        self.assertIsNone(profiling.load_capture(self.path, '../../etc/passwd'))
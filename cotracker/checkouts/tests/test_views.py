@@ -1,11 +1,16 @@
+import datetime
+
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.urlresolvers import reverse
 from django.http import Http404
 from django.test import TestCase, RequestFactory
 
+from checkouts.models import DailyUsage
 from checkouts.views import (
     PilotList,
     PilotDetail,
+    UsageDashboard,
+    DatabaseStats,
 )
 
 import checkouts.tests.helper as helper
@@ -63,3 +68,73 @@ class PilotViewsTest(TestCase):
         self.assertIsNotNone(response.context_data['pilot'])
         self.assertIsNotNone(response.context_data['checkouts'])
 
+
+
+class UsageDashboardTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.regular_user = User.objects.create_user('user', 'user@example.com', 'pass')
+        self.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+
+    def create_usage(self, date, route, requests, latency):
+        return DailyUsage.objects.create(
+            date=date, route=route, requests=requests, users=1, ips=1,
+            client_errors=0, server_errors=1, slowest=max(int(b) for b in latency),
+            latency='{%s}' % ', '.join('"%s": 1' % b for b in latency),
+        )
+
+    def test_UsageDashboard(self):
+        request = self.factory.get(reverse('usage_dashboard'))
+
+        # Only superusers may see it
+        request.user = self.regular_user
+        response = UsageDashboard.as_view()(request)
+        self.assertEqual(response.status_code, 302)
+
+        today = datetime.date.today()
+        yesterday = today - datetime.timedelta(days=1)
+        long_ago = today - datetime.timedelta(days=100)
+        for date in (today, yesterday, long_ago):
+            self.create_usage(date, DailyUsage.ALL_ROUTES, 2, ['10', '30'])
+            self.create_usage(date, 'GET PilotDetail', 1, ['10'])
+            self.create_usage(date, 'POST FilterFormView', 1, ['30'])
+
+        request.user = self.superuser
+        response = UsageDashboard.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([day.date for day in response.context_data['daily']], [today, yesterday])
+        routes = {route['route']: route for route in response.context_data['routes']}
+        self.assertEqual(routes['GET PilotDetail']['requests'], 2)
+        self.assertEqual(routes['GET PilotDetail']['server_errors'], 2)
+        self.assertEqual(routes['POST FilterFormView']['latency_percentiles'], [30, 30, 30])
+        with self.settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'):
+            self.assertContains(response.render(), 'POST FilterFormView')
+
+
+class DatabaseStatsTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.regular_user = User.objects.create_user('user', 'user@example.com', 'pass')
+        self.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+
+    def test_DatabaseStats(self):
+        request = self.factory.get(reverse('database_stats'))
+
+        # Only superusers may see it
+        request.user = self.regular_user
+        response = DatabaseStats.as_view()(request)
+        self.assertEqual(response.status_code, 302)
+
+        request.user = self.superuser
+        response = DatabaseStats.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context_data['exact'])
+        tables = {table['table']: table for table in response.context_data['tables']}
+        self.assertEqual(tables[User._meta.db_table]['rows'], 2)
+        with self.settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'):
+            self.assertContains(response.render(), User._meta.db_table)
+
+
+        # Linked from the admin's navigation
+        with self.settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage'):
+            self.assertContains(response.render(), 'href="%s"' % reverse('database_stats'))
@@ -1,17 +1,24 @@
 """View definitions for the Checkouts app"""
+import collections
+import datetime
 import logging
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Count
+from django.http import Http404
 from django.shortcuts import redirect, render
 from django.views.generic import DetailView, ListView, TemplateView
 
-from braces.views import LoginRequiredMixin
+from braces.views import LoginRequiredMixin, SuperuserRequiredMixin
 
 from .forms import FilterForm, CheckoutEditForm
-from .models import AircraftType, Airstrip, Checkout, PilotWeight
+from .analytics import LatencySketch
+from .dbstats import table_stats
+from .models import AircraftType, Airstrip, Checkout, DailyUsage, PilotWeight
+import checkouts.profiling as profiling
 import checkouts.util as util
 
 
@@ -565,3 +572,106 @@ class WeightEdit(LoginRequiredMixin, DetailView):
         if weight_changed:
             util.notify_pilotweight_update(pilotweight)
         return redirect('weight_list')
+
+
+class ProfileList(LoginRequiredMixin, SuperuserRequiredMixin, TemplateView):
+    """Lists the request profiles captured by the Profiler middleware"""
+    template_name = 'checkouts/profile_list.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(ProfileList, self).get_context_data(**kwargs)
+        config = settings.PROFILER_CONFIG
+        context['enabled'] = config is not None
+        if config is None:
+            context['captures'] = []
+        else:
+            context['captures'] = profiling.list_captures(config['path'])
+        return context
+
+
+class ProfileDetail(LoginRequiredMixin, SuperuserRequiredMixin, TemplateView):
+    """Shows the functions with the greatest cumulative time in a profile"""
+    template_name = 'checkouts/profile_detail.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(ProfileDetail, self).get_context_data(**kwargs)
+        config = settings.PROFILER_CONFIG
+        if config is None:
+            raise Http404("Request profiling is disabled")
+        capture = profiling.load_capture(config['path'], kwargs['name'])
+        if capture is None:
+            raise Http404("No profile named '%s'" % kwargs['name'])
+        context['capture'] = capture
+        return context
+
+
+class UsageDashboard(LoginRequiredMixin, SuperuserRequiredMixin, TemplateView):
+    """Requests, users, errors and latency over recent days, from the rollups
+    made by the rollup_analytics command (never from the logs themselves)"""
+    template_name = 'checkouts/usage_dashboard.html'
+    default_days = 30
+    percentiles = (50, 95, 99)
+
+    def get_days(self):
+        try:
+            days = int(self.request.GET.get('days', self.default_days))
+        except ValueError:
+            days = self.default_days
+        return min(max(days, 1), 3660)
+
+    def get_context_data(self, **kwargs):
+        context = super(UsageDashboard, self).get_context_data(**kwargs)
+        days = self.get_days()
+        earliest = datetime.date.today() - datetime.timedelta(days=days)
+        rollups = DailyUsage.objects.filter(date__gt=earliest)
+
+        daily = []
+        routes = collections.OrderedDict()
+        for rollup in rollups.order_by('-date', 'route'):
+            sketch = rollup.sketch()
+            if rollup.route == DailyUsage.ALL_ROUTES:
+                rollup.latency_percentiles = [sketch.percentile(p) for p in self.percentiles]
+                daily.append(rollup)
+                continue
+            if rollup.route not in routes:
+                routes[rollup.route] = {
+                    'route': rollup.route,
+                    'requests': 0,
+                    'client_errors': 0,
+                    'server_errors': 0,
+                    'shed': 0,
+                    'sketch': LatencySketch(),
+                }
+            totals = routes[rollup.route]
+            totals['requests'] += rollup.requests
+            totals['client_errors'] += rollup.client_errors
+            totals['server_errors'] += rollup.server_errors
+            totals['shed'] += rollup.shed
+            totals['sketch'].merge(sketch)
+
+        for totals in routes.values():
+            sketch = totals.pop('sketch')
+            totals['latency_percentiles'] = [sketch.percentile(p) for p in self.percentiles]
+            totals['slowest'] = sketch.maximum
+
+        context['days'] = days
+        context['percentiles'] = self.percentiles
+        context['daily'] = daily
+        context['routes'] = sorted(routes.values(), key=lambda totals: -totals['requests'])
+        return context
+
+
+class DatabaseStats(LoginRequiredMixin, SuperuserRequiredMixin, TemplateView):
+    """The size and estimated rows of each table, from the database's own
+    statistics; ?exact=1 counts every table as well"""
+    template_name = 'checkouts/database_stats.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(DatabaseStats, self).get_context_data(**kwargs)
+        exact = bool(self.request.GET.get('exact'))
+        tables = table_stats(exact=exact)
+        context['exact'] = exact
+        context['tables'] = tables
+        context['total_rows'] = sum(table['exact' if exact else 'rows'] or 0 for table in tables)
+        context['total_bytes'] = sum(table['total_bytes'] or 0 for table in tables)
+        return context
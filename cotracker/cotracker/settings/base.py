@@ -55,6 +55,51 @@ if 'MAILGUN_SENDER' in os.environ:
 else:
     MAILGUN_CONFIG = None
 
+# Profiling requests is opt-in. When enabled, the given fraction of requests is
+# run under cProfile and kept in a ring buffer of captures which superusers can
+# browse from the admin. With a threshold, every request is run under cProfile
+# and those slower than it are kept too.
+if 'PROFILE_SAMPLE_RATE' in os.environ:
+    PROFILER_CONFIG = {
+        'sample_rate':  float(get_env_var('PROFILE_SAMPLE_RATE')),
+        'threshold_ms': float(os.environ['PROFILE_THRESHOLD_MS'])
+                        if 'PROFILE_THRESHOLD_MS' in os.environ else None,
+        'capacity':     int(os.getenv('PROFILE_CAPACITY', 50)),
+        'path':         os.getenv('PROFILE_PATH', os.path.join(LOGS_PATH, 'profiles')),
+    }
+else:
+    PROFILER_CONFIG = None
+
+# Recording slow database statements is opt-in. When enabled, statements which
+# take longer than the threshold are logged and kept in the SlowQuery table.
+if 'SLOW_QUERY_THRESHOLD_MS' in os.environ:
+    SLOW_QUERY_CONFIG = {
+        'threshold_ms': float(get_env_var('SLOW_QUERY_THRESHOLD_MS')),
+        'explain':      bool(os.environ.get('SLOW_QUERY_EXPLAIN')),
+        'capacity':     int(os.getenv('SLOW_QUERY_CAPACITY', 500)),
+    }
+else:
+    SLOW_QUERY_CONFIG = None
+
+# The analytics log is written as key=value text by default. Set to 'json' to
+# write one JSON object per request instead (see checkouts.analytics for the
+# schema); the scripts in scripts/utilities read either format.
+ANALYTICS_LOG_FORMAT = os.getenv('ANALYTICS_LOG_FORMAT', 'text')
+if ANALYTICS_LOG_FORMAT not in ('text', 'json'):
+    raise ImproperlyConfigured("ANALYTICS_LOG_FORMAT must be 'text' or 'json'")
+
+# Every log under LOGS_PATH is rotated once it grows beyond LOG_MAX_BYTES and
+# at the end of each LOG_ROTATE_WHEN period ('midnight', 'hourly' or 'never').
+# Older segments are gzipped and only the most recent LOG_BACKUP_COUNT are
+# kept (0 keeps them all).
+LOG_ROTATION = {
+    'max_bytes':    int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024)),
+    'when':         os.getenv('LOG_ROTATE_WHEN', 'midnight'),
+    'backup_count': int(os.getenv('LOG_BACKUP_COUNT', 30)),
+}
+if LOG_ROTATION['when'] == 'never':
+    LOG_ROTATION['when'] = None
+
 LOGIN_URL = '/login/'
 # Default 'successful login' URL redirect if an alternative is not specified
 LOGIN_REDIRECT_URL = '/checkouts/'
@@ -121,15 +166,47 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = get_env_var('SECRET_KEY')
 
+# Uptime monitors are answered by the HealthCheck middleware, which pings the
+# database at most once per interval (in seconds)
+HEALTH_CHECK_PATH = '/healthz'
+HEALTH_CHECK_INTERVAL = 10
+
+# Expensive requests which have already waited in nginx's queue for longer than
+# their route's threshold (in milliseconds) are turned away with a 503 so that
+# the workers can catch up. Routes are identified by their URL names. Set to
+# None to disable load shedding.
+LOAD_SHEDDING = {
+    'retry_after': 10,
+    'routes': {
+        'checkout_filter': {
+            'methods': ('POST',),
+            'data': {'checkout_status': 'belum'},
+            'threshold_ms': 1500,
+        },
+        'checkout_edit': {
+            'methods': ('POST',),
+            'threshold_ms': 3000,
+        },
+        'base_edit': {
+            'methods': ('POST',),
+            'threshold_ms': 3000,
+        },
+    },
+}
+
 MIDDLEWARE = (
+    'checkouts.middleware.HealthCheck',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'checkouts.middleware.Analytics',
+    'checkouts.middleware.SlowQueries',
+    'checkouts.middleware.LoadShedder',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'checkouts.middleware.Analytics',
+    'checkouts.middleware.Profiler',
 )
 
 ROOT_URLCONF = 'cotracker.urls'
@@ -189,18 +266,27 @@ LOGGING = {
             'format': '%(asctime)s [%(process)s]: at=%(levelname)s %(message)s',
             'datefmt': "%Y-%m-%dT%H:%M:%S%z",
         },
+        'analytics_json': {
+            'format': '%(message)s',
+        },
     },
     'handlers': {
         'logfile_requests': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'checkouts.logrotation.RotatingFileHandler',
             'filename': os.path.join(LOGS_PATH, 'requests.log'),
+            'max_bytes': LOG_ROTATION['max_bytes'],
+            'when': LOG_ROTATION['when'],
+            'backup_count': LOG_ROTATION['backup_count'],
             'formatter': 'verbose_request',
         },
         'logfile_checkouts': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            'class': 'checkouts.logrotation.RotatingFileHandler',
             'filename': os.path.join(LOGS_PATH, 'checkouts.log'),
+            'max_bytes': LOG_ROTATION['max_bytes'],
+            'when': LOG_ROTATION['when'],
+            'backup_count': LOG_ROTATION['backup_count'],
             'formatter': 'checkouts_log',
         },
         'console_checkouts': {
@@ -215,9 +301,21 @@ LOGGING = {
         },
         'logfile_analytics': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'checkouts.logrotation.RotatingFileHandler',
             'filename': os.path.join(LOGS_PATH, 'analytics.log'),
-            'formatter': 'analytics_log',
+            'max_bytes': LOG_ROTATION['max_bytes'],
+            'when': LOG_ROTATION['when'],
+            'backup_count': LOG_ROTATION['backup_count'],
+            'formatter': 'analytics_json' if ANALYTICS_LOG_FORMAT == 'json' else 'analytics_log',
+        },
+        'logfile_slowqueries': {
+            'level': 'INFO',
+            'class': 'checkouts.logrotation.RotatingFileHandler',
+            'filename': os.path.join(LOGS_PATH, 'slowqueries.log'),
+            'max_bytes': LOG_ROTATION['max_bytes'],
+            'when': LOG_ROTATION['when'],
+            'backup_count': LOG_ROTATION['backup_count'],
+            'formatter': 'checkouts_log',
         },
     },
     'loggers': {
@@ -236,5 +334,10 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'slowqueries': {
+            'handlers': ['logfile_slowqueries',],
+            'level': 'INFO',
+            'propagate': True,
+        },
     },
 }
@@ -1,3 +1,7 @@
+import atexit
+import shutil
+import tempfile
+
 from .base import *
 
 # Test Settings
@@ -13,3 +17,12 @@ DATABASES = {
         "NAME": ":memory:",
     },
 }
+
+# Logs written while testing go to a temporary directory rather than the tree
+LOGS_PATH = tempfile.mkdtemp(prefix='cotracker-test-logs-')
+atexit.register(shutil.rmtree, LOGS_PATH, ignore_errors=True)
+for handler in LOGGING['handlers'].values():
+    if 'filename' in handler:
+        handler['filename'] = os.path.join(LOGS_PATH, os.path.basename(handler['filename']))
+if PROFILER_CONFIG:
+    PROFILER_CONFIG['path'] = os.path.join(LOGS_PATH, 'profiles')
@@ -15,6 +15,10 @@ from checkouts.views import (
     CheckoutEditFormView,
     WeightList,
     WeightEdit,
+    ProfileList,
+    ProfileDetail,
+    UsageDashboard,
+    DatabaseStats,
 )
 
 admin.autodiscover()
@@ -24,6 +28,10 @@ urlpatterns = [
     url(r'^logout/$', auth.views.logout_then_login, name='logout'),
     url(r'^password_change/$', auth.views.password_change, {'template_name': 'checkouts/password_change_form.html',}, name='password_change'),
     url(r'^password_change/done/$', auth.views.password_change_done, {'template_name': 'checkouts/password_change_done.html',}, name='password_change_done'),
+    url(r'^emerald/profiles/$', ProfileList.as_view(), name='profile_list'),
+    url(r'^emerald/profiles/(?P<name>[\w-]+)/$', ProfileDetail.as_view(), name='profile_detail'),
+    url(r'^emerald/usage/$', UsageDashboard.as_view(), name='usage_dashboard'),
+    url(r'^emerald/dbstats/$', DatabaseStats.as_view(), name='database_stats'),
     url(r'^emerald/', include(admin.site.urls)),
     # Checkouts app views
     url(
@@ -0,0 +1,81 @@
+"""
+Compares the compression codecs on a sample of backup data (e.g. an SQL dump
+or a fixture taken from an archive):
+
+    python benchmark_compression.py FILE [--level LEVEL ...] [--jobs N ...]
+
+The file is compressed with each codec at each level, on each number of
+threads, and decompressed again. Everything is done in memory, so the disk
+isn't what's measured. The first line is gzip.compress at level 9, which is
+what tarfile's 'w|gz' (how archives used to be compressed) amounts to.
+"""
+
+import argparse
+import gzip
+import io
+import os
+import time
+
+import compression
+
+
+DEFAULT_LEVELS = {'gzip': [1, 6, 9], 'zstd': [1, 3, 9]}
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def compress(codec, data, level, jobs):
+    output = io.BytesIO()
+    writer = compression.open_writer(codec, output, level, jobs)
+    # Written in pieces, as tarfile does
+    for offset in range(0, len(data), 64 * 1024):
+        writer.write(data[offset:offset + 64 * 1024])
+    writer.close()
+    return output.getvalue()
+
+
+def decompress(codec, compressed):
+    return compression.open_reader(codec, io.BytesIO(compressed)).read()
+
+
+def report(name, level, jobs, size, compressed, seconds, decompress_seconds):
+    megabytes = size / 1024 / 1024
+    print("%-6s %5s %4s %10d %7.2f%% %9.1f %9.1f" % (
+        name, level, jobs, compressed, 100.0 * compressed / size,
+        megabytes / seconds, megabytes / decompress_seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the compression codecs on a sample file.")
+    parser.add_argument('file')
+    parser.add_argument('--level', type=int, action='append', dest='levels',
+        help="level to try (repeatable; default: a few per codec)")
+    parser.add_argument('--jobs', type=int, action='append',
+        help="number of threads to try (repeatable; default: 1 and every core)")
+    options = parser.parse_args()
+    jobs = options.jobs or sorted({1, os.cpu_count() or 1})
+
+    with open(options.file, 'rb') as f:
+        data = f.read()
+    print("%s: %d bytes, %d cores" % (options.file, len(data), os.cpu_count() or 1))
+    print("%-6s %5s %4s %10s %8s %9s %9s" % ('codec', 'level', 'jobs', 'bytes', 'ratio', 'MB/s', 'unpack'))
+
+    seconds, compressed = measure(gzip.compress, data, 9)
+    decompress_seconds, _ = measure(gzip.decompress, compressed)
+    report('tar', 9, 1, len(data), len(compressed), seconds, decompress_seconds)
+    for codec in compression.available_codecs():
+        for level in options.levels or DEFAULT_LEVELS[codec.name]:
+            for count in jobs:
+                seconds, compressed = measure(compress, codec, data, level, count)
+                decompress_seconds, restored = measure(decompress, codec, compressed)
+                if restored != data:
+                    raise SystemExit("%s at level %d didn't round-trip" % (codec.name, level))
+                report(codec.name, level, count, len(data), len(compressed), seconds, decompress_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Deduplicating storage of backup snapshots, as content-defined chunks
+
+Successive snapshots of the database are nearly identical, so rather than
+archiving each one whole, its files (the fixtures and the SQL dump) can be
+split into chunks which are stored once each, under the SHA1 of their
+contents. A snapshot is then just its manifest, listing the chunks of each
+file in order:
+
+    store/
+        chunks/3f/3f786850e387550fdab836ed7e6dc881de23001b.gz.gpg
+        ...
+        snapshots/2019-08-01T11:50:00.chunks.json
+        uploaded
+
+Chunk boundaries are chosen by the content, not by offsets, so that a change
+to a few rows only changes the chunks around it: the rest of the file still
+splits at the same places and its chunks are already stored. The dumps are
+text, one row to a line, so boundaries are only placed at the ends of lines:
+each line is hashed (CRC32), and the chunk ends after a line whose hash falls
+below a threshold proportional to the line's length, giving chunks of about
+AVERAGE_CHUNK bytes (within MIN_CHUNK and MAX_CHUNK). Hashing whole lines is
+a rolling hash with a window of a line, which Python can compute at the speed
+of reading them rather than a byte at a time.
+
+Each chunk is gzipped, and encrypted with gpg if a recipient is configured,
+on its own. Chunks are named by the SHA1 of their plaintext, which reveals
+which chunks snapshots share, but nothing of what's in them.
+
+'uploaded' lists the chunks and snapshots (by their paths in the store)
+which have been copied to S3, under the same paths beneath db/. Old snapshots
+are retired with `python chunks.py gc`: the chunks which no snapshot kept
+refers to any more are deleted, from S3 as well with --remote.
+"""
+
+import argparse
+import collections
+import gzip
+import hashlib
+import logging
+import os
+import subprocess
+import time
+import zlib
+
+from boto.s3.connection import S3Connection
+
+import manifest
+
+
+FORMAT = 'chunks'
+# The store's directory, unless configured otherwise (and the one chunks are
+# downloaded into, beside the snapshots' manifests)
+STORE = 'store'
+
+AVERAGE_CHUNK = 256 * 1024
+MIN_CHUNK = AVERAGE_CHUNK // 4
+MAX_CHUNK = AVERAGE_CHUNK * 4
+# A line of n bytes ends a chunk if its CRC32 is below n times this
+BOUNDARY_SCALE = 2 ** 32 // AVERAGE_CHUNK
+
+# Snapshots kept by gc, newest first
+KEEP_SNAPSHOTS = 30
+# Unreferenced chunks younger than this (in seconds) may belong to a snapshot
+# being written, so gc leaves them
+GRACE_PERIOD = 6 * 60 * 60
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_boundary(line):
+    return zlib.crc32(line) < len(line) * BOUNDARY_SCALE
+
+
+def split(stream):
+    """Yields the content-defined chunks of the stream (a binary file)."""
+    lines = []
+    size = 0
+    # A line which would take the chunk past MAX_CHUNK is split
+    for line in iter(lambda: stream.readline(MAX_CHUNK - size), b''):
+        lines.append(line)
+        size += len(line)
+        if size >= MAX_CHUNK or (size >= MIN_CHUNK and is_boundary(line)):
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+
+def snapshot_name(created):
+    return '%s.%s' % (created, FORMAT)
+
+
+class ChunkStore():
+    """Chunks and snapshots kept in a local directory"""
+    def __init__(self, directory, recipient=None):
+        self.directory = directory
+        self.recipient = recipient
+
+    def chunk_path(self, digest, encrypted=None):
+        """Returns the chunk's path within the store."""
+        if encrypted is None:
+            encrypted = bool(self.recipient)
+        suffix = '.gz.gpg' if encrypted else '.gz'
+        return os.path.join('chunks', digest[:2], digest + suffix)
+
+    def snapshot_path(self, name):
+        return os.path.join('snapshots', name + '.json')
+
+    def full_path(self, path):
+        return os.path.join(self.directory, path)
+
+    def find_chunk(self, digest):
+        """Returns the path of the stored chunk, encrypted or not, or None."""
+        for encrypted in (True, False):
+            path = self.chunk_path(digest, encrypted)
+            if os.path.exists(self.full_path(path)):
+                return path
+        return None
+
+    def put(self, data):
+        """Stores the chunk unless it's stored already. Returns its digest,
+        and its path within the store if it was new (otherwise None)."""
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.chunk_path(digest)
+        target = self.full_path(path)
+        if os.path.exists(target):
+            return digest, None
+        data = gzip.compress(data)
+        if self.recipient:
+            data = subprocess.run(
+                ['gpg', '--batch', '--yes', '--encrypt', '--recipient', self.recipient],
+                input=data, stdout=subprocess.PIPE, check=True,
+            ).stdout
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + '.partial', 'wb') as f:
+            f.write(data)
+        os.replace(target + '.partial', target)
+        return digest, path
+
+    def get(self, digest):
+        """Returns the chunk's contents, checking them against its digest."""
+        path = self.find_chunk(digest)
+        if path is None:
+            raise RuntimeError("Chunk %s is missing from '%s'" % (digest, self.directory))
+        with open(self.full_path(path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.gpg'):
+            data = subprocess.run(
+                ['gpg', '--quiet', '--decrypt'], input=data, stdout=subprocess.PIPE, check=True,
+            ).stdout
+        data = gzip.decompress(data)
+        if hashlib.sha1(data).hexdigest() != digest:
+            raise RuntimeError("Chunk %s doesn't match its digest" % digest)
+        return data
+
+    def add(self, stream):
+        """Stores the stream's chunks. Returns the list of its chunks (each
+        [digest, size]), the Digest of the whole stream, and the paths of
+        the chunks which were new."""
+        chunks = []
+        digest = manifest.Digest()
+        new = []
+        for data in split(stream):
+            digest.update(data)
+            chunk, path = self.put(data)
+            chunks.append([chunk, len(data)])
+            if path is not None:
+                new.append(path)
+        return chunks, digest, new
+
+    def open(self, chunks):
+        return ChunkReader(self, chunks)
+
+    def save_snapshot(self, details):
+        path = self.full_path(self.snapshot_path(details['archive']))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        manifest.write(path, details)
+
+    def snapshots(self):
+        """Returns the names of the stored snapshots, oldest first."""
+        try:
+            names = os.listdir(self.full_path('snapshots'))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len('.json')] for name in names if name.endswith('.json'))
+
+    def read_snapshot(self, name):
+        return manifest.read(self.full_path(self.snapshot_path(name)))
+
+    def references(self, names):
+        """Returns how many times the snapshots refer to each chunk."""
+        counts = collections.Counter()
+        for name in names:
+            for entry in self.read_snapshot(name)['files'].values():
+                counts.update(digest for digest, size in entry['chunks'])
+        return counts
+
+    def uploaded(self):
+        try:
+            with open(self.full_path('uploaded'), 'r') as f:
+                return set(f.read().split())
+        except FileNotFoundError:
+            return set()
+
+    def mark_uploaded(self, paths):
+        with open(self.full_path('uploaded'), 'a') as f:
+            f.writelines('%s\n' % path for path in paths)
+
+    def unmark_uploaded(self, paths):
+        remaining = self.uploaded() - set(paths)
+        with open(self.full_path('uploaded.tmp'), 'w') as f:
+            f.writelines('%s\n' % path for path in sorted(remaining))
+        os.replace(self.full_path('uploaded.tmp'), self.full_path('uploaded'))
+
+    def gc(self, keep=KEEP_SNAPSHOTS, grace_period=GRACE_PERIOD):
+        """Forgets all but the newest snapshots, and deletes the chunks which
+        the rest don't refer to. Returns the paths of what was deleted."""
+        names = self.snapshots()
+        retired = names[:-keep] if keep else names
+        kept = self.references(names[len(retired):])
+        deleted = []
+        for name in retired:
+            os.remove(self.full_path(self.snapshot_path(name)))
+            deleted.append(self.snapshot_path(name))
+        cutoff = time.time() - grace_period
+        for directory, _, filenames in os.walk(self.full_path('chunks')):
+            for filename in filenames:
+                digest = filename.split('.')[0]
+                path = os.path.join(directory, filename)
+                if digest not in kept and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    deleted.append(os.path.relpath(path, self.directory))
+        logger.info("Retired %d snapshots and %d chunks" % (len(retired), len(deleted) - len(retired)))
+        return deleted
+
+
+class ChunkReader():
+    """Reads a file back from its chunks, fetching one at a time"""
+    def __init__(self, store, chunks):
+        self.store = store
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += self.store.get(chunk[0])
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def get_s3_bucket():
+    connection = S3Connection(os.environ['S3_ACCESS_KEY'], os.environ['S3_SECRET_KEY'])
+    return connection.get_bucket(os.environ['S3_BUCKET_NAME'], validate=False)
+
+
+def remote_name(path, key_prefix='db'):
+    """Returns the key of the store's chunk or snapshot on S3."""
+    if path.startswith('snapshots' + os.sep):
+        # A snapshot is uploaded as its manifest
+        return '/'.join([key_prefix, manifest.manifest_name(os.path.basename(path)[:-len('.json')])])
+    return '/'.join([key_prefix] + path.split(os.sep))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    parser = argparse.ArgumentParser(description="Retires old snapshots from a chunk store.")
+    parser.add_argument('command', choices=['gc'])
+    parser.add_argument('--store', default=os.environ.get('BACKUPS_CHUNK_STORE', STORE),
+        help="the store's directory (default: $BACKUPS_CHUNK_STORE or '%s')" % STORE)
+    parser.add_argument('--keep', type=int, default=KEEP_SNAPSHOTS,
+        help="number of snapshots to keep (default: %d)" % KEEP_SNAPSHOTS)
+    parser.add_argument('--remote', action='store_true',
+        help="also delete what's retired from the S3 bucket in S3_BUCKET_NAME")
+    options = parser.parse_args()
+
+    store = ChunkStore(options.store)
+    deleted = store.gc(options.keep)
+    uploaded = store.uploaded()
+    remote = [path for path in deleted if path in uploaded]
+    if options.remote and remote:
+        bucket = get_s3_bucket()
+        for path in remote:
+            bucket.delete_key(remote_name(path))
+        store.unmark_uploaded(remote)
+        logger.info("Deleted %d keys from '%s'" % (len(remote), bucket.name))
+    elif remote:
+        logger.warning("%d of the deleted files remain on S3 (see --remote)" % len(remote))
+
+
+if __name__ == '__main__':
+    main()
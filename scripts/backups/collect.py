@@ -1,32 +1,80 @@
+import collections
+import concurrent.futures
 import datetime
 import hashlib
+import io
+import itertools
+import json
 import logging
 import os
+import shutil
+import subprocess
 import tarfile
+import tempfile
+import threading
+import time
 
+from boto.exception import S3ResponseError
 from boto.s3.connection import S3Connection
-from boto.s3.bucket import Bucket
-from boto.s3.key import Key
 import dj_database_url
 import django # Provides django.setup()
 from django.apps import apps as django_apps
-import envoy
+from django.core import serializers
+from django.db import DEFAULT_DB_ALIAS, connection, router
+
+import chunks
+import compression
+import manifest
+import transfer
 
 
 # ISO 8601 YYYY-MM-DDTHH:MM:SS
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 
-# Would be '[]' without the '--indent=4' argument to dumpdata
-EMPTY_FIXTURE = '[\n]\n'
+# Apps are exported to fixtures concurrently, each on its own thread (and so
+# its own database connection)
+FIXTURE_JOBS = 4
+
+
+# The archive is streamed straight from pg_dump through gzip and gpg to disk,
+# so nothing is buffered beyond this much of the SQL dump at a time. Tar
+# headers need each member's size up front, so the dump is stored as a series
+# of members (checkniner.sql.000, checkniner.sql.001, ...) of at most this
+# size, which concatenate back into the full dump.
+SQL_PART_SIZE = 8 * 1024 * 1024
+
+
+# Symlink to the newest archive (whose manifest is manifest.LATEST)
+LATEST = 'latest'
+COMPARED_FIXTURES = ('auth.json', 'checkouts.json')
+
+
+# Diagnostic records aren't worth keeping, and deletions are carried by
+# incremental archives in their own form, so neither is exported.
+EXCLUDED_MODELS = ('checkouts.SlowQuery', 'checkouts.Deletion')
+# Usage rollups are exported with full archives, since the logs they're made
+# from are pruned, but they change daily and aren't business data, so they
+# shouldn't cause a new archive to be made (and incremental archives don't
+# carry them).
+UNWATCHED_MODELS = EXCLUDED_MODELS + ('checkouts.DailyUsage',)
+
+
+# Kinds of archive. A full archive holds every fixture and the SQL dump; an
+# incremental one holds only the rows changed since the archive before it
+# (its base), in changes.json, and the rows deleted, in deleted.json. A chain
+# of incremental archives leads back to the full archive which anchors it.
+FULL = 'full'
+INCREMENTAL = 'incremental'
+
+
+# Incremental archives carry rows modified (and deletions recorded) since a
+# little before the previous archive was started, so that rows saved by a
+# transaction which was still open at the time aren't missed. The overlap is
+# harmless, since loading a row again just overwrites it.
+CHANGE_MARGIN = datetime.timedelta(minutes=10)
 
 
-logging.basicConfig(
-    filename='backup.log',
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s]: %(message)s",
-    datefmt=DATE_FORMAT,
-)
 logger = logging.getLogger(__name__)
 
 
@@ -40,31 +88,6 @@ def instrument(function):
     return wrapper
 
 
-def capture_command(function):
-    def wrapper(*args, **kwargs):
-        if args:
-            command = args[0]
-        elif 'command' in kwargs:
-            command = kwargs['command']
-        else:
-            logger.warning("What's the command?.\n\targs: %r\n\tkwargs: %r" % (args, kwargs))
-            command = '?'
-        
-        # Being much too clever: Dynamically decorate the given function with
-        # the 'instrument' function so that we can capture timing data. Once
-        # the function is decorated, we'll call it with the original
-        # parameters.
-        milliseconds, r = instrument(function)(*args, **kwargs)
-        bytes = len(r.std_out)
-        logger.info("cmd=\"%s\" real=%dms bytes=%d" % (command, milliseconds, bytes))
-        if hasattr(r, 'std_err'):
-            # Print each non-blank line separately
-            lines = [line for line in r.std_err.split('\n') if line]
-            map(logger.error, lines)
-        return r
-    return wrapper
-
-
 def capture_function(function):
     def wrapper(*args, **kwargs):
         milliseconds, r = instrument(function)(*args, **kwargs)
@@ -73,23 +96,54 @@ def capture_function(function):
     return wrapper
 
 
-# Keep a log of the calls through envoy
-envoy.run = capture_command(envoy.run)
-
-
 def get_database_name(env='DATABASE_URL'):
     db_config = dj_database_url.config(env)
     return db_config['NAME']
 
 
-def get_installed_app_names():
+def rows_digest(queryset, *fields):
+    """SHA1 of the given fields of every row, in primary key order"""
+    digest = hashlib.sha1()
+    for row in queryset.order_by('pk').values_list(*fields):
+        digest.update(repr(row).encode('utf-8'))
+    return digest.hexdigest()
+
+
+@capture_function
+def get_watermark():
+    """Cheaply summarizes the business data, such that the summary changes
+    whenever any of it is created, modified or deleted. Compared with the
+    watermark of the latest archive, this avoids dumping unchanged data.
+
+    The checkouts models record their last modification (TimeStampedModel)
+    and row counts catch deletions. Links between airstrips and bases don't
+    touch 'modified', and neither do most changes to users and groups, so
+    those small tables are digested instead.
+    """
     django.setup()
-    apps = django_apps.get_app_configs()
-    # Labels default to the last component of the app name, but not guaranteed:
-    # - Default: 'django.contrib.auth' -> 'auth'
-    # - Changed: 'raven.contrib.django.raven_compat' -> 'raven_contrib_django'
-    labels = [appconfig.label for appconfig in apps]
-    return labels
+    from django.contrib.auth.models import Group, Permission, User
+    from django.db.models import Count, Max
+
+    watermark = {}
+    for model in django_apps.get_app_config('checkouts').get_models():
+        label = model._meta.label
+        if label in UNWATCHED_MODELS or not hasattr(model, 'modified'):
+            continue
+        stats = model.objects.aggregate(count=Count('pk'), modified=Max('modified'))
+        modified = stats['modified'].isoformat() if stats['modified'] else None
+        watermark[label] = [stats['count'], modified]
+    Bases = django_apps.get_model('checkouts', 'Airstrip').bases.through
+    watermark['checkouts.Airstrip.bases'] = rows_digest(Bases.objects, 'from_airstrip_id', 'to_airstrip_id')
+    watermark['auth.User'] = rows_digest(
+        User.objects, 'pk', 'username', 'password', 'first_name', 'last_name', 'email',
+        'is_active', 'is_staff', 'is_superuser', 'last_login', 'date_joined')
+    watermark['auth.User.groups'] = rows_digest(User.groups.through.objects, 'user_id', 'group_id')
+    watermark['auth.User.user_permissions'] = rows_digest(
+        User.user_permissions.through.objects, 'user_id', 'permission_id')
+    watermark['auth.Group'] = rows_digest(Group.objects, 'pk', 'name')
+    watermark['auth.Group.permissions'] = rows_digest(Group.permissions.through.objects, 'group_id', 'permission_id')
+    watermark['auth.Permission'] = Permission.objects.count()
+    return watermark
 
 
 def get_s3_credentials():
@@ -102,110 +156,560 @@ def get_s3_bucket_name():
     return os.environ['S3_BUCKET_NAME']
 
 
-def dump_postgres():
-    database = get_database_name()
-    r = envoy.run("pg_dump %s" % database)
-    filename = "%s.sql" % database
-    with open(filename, 'w') as f:
-        f.write(r.std_out)
-    return filename
+def get_gpg_recipient():
+    return os.environ.get('BACKUPS_GPG_RECIPIENT')
 
 
-def dump_django_fixtures():
-    filenames = []
-    for name in get_installed_app_names():
-        r = envoy.run('django-admin.py dumpdata %s --indent=4' % name)
-        if r.std_out != EMPTY_FIXTURE:
-            filename = "%s.json" % name
-            with open(filename, 'w') as f:
-                f.write(r.std_out)
-            filenames.append(filename)
-        else:
-            logger.warning("Skipping empty fixture for '%s'" % name)
-    return filenames
+def get_compression():
+    """Returns the codec, level and number of threads to compress archives
+    with (by default, gzip at its default level on every core)."""
+    codec = compression.get_codec(os.environ.get('BACKUPS_COMPRESSION') or 'gzip')
+    level = int(os.environ.get('BACKUPS_COMPRESSION_LEVEL') or codec.default_level)
+    jobs = int(os.environ.get('BACKUPS_COMPRESSION_JOBS') or 0) or os.cpu_count() or 1
+    return codec, level, jobs
+
+
+def get_chunk_store():
+    """Returns the ChunkStore which snapshots are kept in, or None if they
+    should be archived instead."""
+    directory = os.environ.get('BACKUPS_CHUNK_STORE')
+    if not directory:
+        return None
+    return chunks.ChunkStore(directory, get_gpg_recipient())
+
+
+def get_full_interval():
+    """Returns how long incremental archives may follow a full one, or None
+    if every archive should be full."""
+    hours = float(os.environ.get('BACKUPS_FULL_INTERVAL_HOURS') or 0)
+    if not hours:
+        return None
+    return datetime.timedelta(hours=hours)
+
+
+def format_time(value):
+    return value.astimezone(datetime.timezone.utc).strftime(DATE_FORMAT)
+
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, DATE_FORMAT).replace(tzinfo=datetime.timezone.utc)
 
 
-def sha1sum(file):
-    m = hashlib.sha1()
+# A fixture file written to disk, with the digest of its contents and the
+# number of rows of each model in it
+Fixture = collections.namedtuple('Fixture', ['name', 'path', 'digest', 'rows'])
+
+
+def fixture_models(app_config):
+    """Returns the app's models in the order dumpdata would export them."""
+    excluded = [django_apps.get_model(label) for label in EXCLUDED_MODELS]
+    return [
+        model for model in serializers.sort_dependencies([(app_config, None)])
+        if model not in excluded and not model._meta.proxy
+        and router.allow_migrate_model(DEFAULT_DB_ALIAS, model)
+    ]
+
+
+def export_fixture(app_config, directory):
+    """Streams the app's objects into '<label>.json' in the directory, exactly
+    as `dumpdata <label> --indent=4` would print them. Returns the Fixture,
+    or None if the app has no objects."""
     try:
-        logger.debug("Treating '%s' as an open file" % file)
-        m.update(file.read())
-    except AttributeError:
-        logger.debug("Now trying '%s' as a file path" % file)
-        with open(file, 'rb') as f:
-            m.update(f.read())
-    return m.hexdigest()
+        start = datetime.datetime.now()
+        models = fixture_models(app_config)
+        if not sum(model._default_manager.count() for model in models):
+            logger.warning("Skipping empty fixture for '%s'" % app_config.label)
+            return None
+
+        rows = collections.Counter()
+
+        def get_objects():
+            for model in models:
+                # iterator() reads the rows in chunks rather than all at once
+                for obj in model._default_manager.order_by(model._meta.pk.name).iterator():
+                    rows[model._meta.label] += 1
+                    yield obj
+
+        # Labels default to the last component of the app name, but not guaranteed:
+        # - Default: 'django.contrib.auth' -> 'auth'
+        # - Changed: 'raven.contrib.django.raven_compat' -> 'raven_contrib_django'
+        name = "%s.json" % app_config.label
+        path = os.path.join(directory, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            serializers.serialize('json', get_objects(), indent=4, stream=f)
+        digest = manifest.file_digest(path)
+        milliseconds = (datetime.datetime.now() - start).total_seconds() * 1000
+        logger.info("fixture=\"%s\" real=%dms bytes=%d" % (name, milliseconds, digest.size))
+        return Fixture(name, path, digest, dict(rows))
+    finally:
+        # Each thread has its own connection, which would otherwise be left open
+        connection.close()
+
+
+@capture_function
+def dump_django_fixtures(directory):
+    """Exports a fixture for each app with data into the directory. Returns
+    the list of Fixtures, in app order."""
+    django.setup()
+    app_configs = [app_config for app_config in django_apps.get_app_configs()
+                   if app_config.models_module is not None]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FIXTURE_JOBS) as pool:
+        fixtures = pool.map(export_fixture, app_configs, [directory] * len(app_configs))
+        return [fixture for fixture in fixtures if fixture is not None]
+
+
+def changed_objects(model, since, watermark, previous):
+    """Returns a queryset of the model's rows to be carried by an incremental
+    archive, given the current and previous watermarks."""
+    label = model._meta.label
+    queryset = model._default_manager.order_by(model._meta.pk.name)
+    # Many-to-many links (and models without a modified time) are only
+    # covered by digests in the watermark, so those (small) tables are
+    # carried whole whenever their digests change
+    timestamped = hasattr(model, 'modified')
+    keys = [key for key in watermark if key.startswith(label + '.') or (key == label and not timestamped)]
+    if any(watermark[key] != previous.get(key) for key in keys):
+        return queryset
+    if not timestamped:
+        return queryset.none()
+    return queryset.filter(modified__gte=since)
 
 
 @capture_function
-def update_necessary():
-    latest = 'latest.tar.gz'
+def dump_changes(directory, since, watermark, previous):
+    """Exports the tracked rows changed since the time into changes.json, and
+    the deletions recorded since then into deleted.json. Returns the list of
+    Fixtures, which is empty if nothing has changed."""
+    from checkouts.models import Deletion
+    models = [django_apps.get_model(label) for label in Deletion.TRACKED_MODELS]
+    querysets = [changed_objects(model, since, watermark, previous) for model in models]
+    deletions = [
+        {'model': model, 'pk': object_id}
+        for model, object_id in Deletion.objects.filter(created__gte=since).values_list('model', 'object_id')
+    ]
+    counts = {model._meta.label: queryset.count() for model, queryset in zip(models, querysets)}
+    logger.info("Changes: %s, deletions: %d" % (counts, len(deletions)))
+    if not deletions and not any(counts.values()):
+        return []
+
+    fixtures = []
+    path = os.path.join(directory, 'changes.json')
+    rows = collections.Counter()
+
+    def get_objects():
+        for obj in itertools.chain.from_iterable(queryset.iterator() for queryset in querysets):
+            rows[obj._meta.label] += 1
+            yield obj
+
+    with open(path, 'w', encoding='utf-8') as f:
+        serializers.serialize('json', get_objects(), indent=4, stream=f)
+    fixtures.append(Fixture('changes.json', path, manifest.file_digest(path), dict(rows)))
+    path = os.path.join(directory, 'deleted.json')
+    with open(path, 'w') as f:
+        json.dump(deletions, f, indent=4)
+    fixtures.append(Fixture('deleted.json', path, manifest.file_digest(path), {}))
+    return fixtures
+
+
+def prune_deletions(started):
+    """Forgets the deletions which a full archive started at the time covers."""
+    from checkouts.models import Deletion
+    count, _ = Deletion.objects.filter(created__lt=started - CHANGE_MARGIN).delete()
+    logger.info("Pruned %d recorded deletions" % count)
+
+
+@capture_function
+def update_necessary(fixtures):
+    latest = manifest.read(manifest.LATEST)
     # Shortcut if we have nothing to compare against (e.g. the first run)
-    if not os.path.exists(latest):
-        logger.debug("Could not access '%s', assuming first run" % latest)
+    if latest is None:
+        logger.debug("Could not access '%s', assuming first run" % manifest.LATEST)
         return True
-    to_compare = ('auth.json', 'checkouts.json')
-    for name in to_compare:
-        proposed = sha1sum(name)
-        with tarfile.open(latest, 'r:gz') as tar:
-            for tarinfo in tar:
-                if tarinfo.name == name:
-                    original = sha1sum(tar.extractfile(tarinfo))
-                    logger.debug("Original: %s" % original)
-                    logger.debug("Proposed: %s" % proposed)
-                    if proposed != original:
-                        logger.debug("Digests differ for '%s'" % name)
-                        return True
+    for fixture in fixtures:
+        if fixture.name not in COMPARED_FIXTURES:
+            continue
+        original = latest['files'].get(fixture.name)
+        logger.debug("Original: %s" % original)
+        logger.debug("Proposed: %s" % fixture.digest.to_dict())
+        if not manifest.matches(fixture.digest, original):
+            logger.debug("Digests differ for '%s'" % fixture.name)
+            return True
     return False
 
 
+def add_member(archive, name, fileobj, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    archive.addfile(info, fileobj)
+
+
+def add_postgres_dump(archive, database):
+    """Streams pg_dump's output into the archive in SQL_PART_SIZE members.
+    Returns the digest of the whole dump and the number of parts."""
+    dump = subprocess.Popen(['pg_dump', database], stdout=subprocess.PIPE)
+    digest = manifest.Digest()
+    part = 0
+    try:
+        while True:
+            data = dump.stdout.read(SQL_PART_SIZE)
+            if not data and part > 0:
+                break
+            add_member(archive, '%s.sql.%03d' % (database, part), io.BytesIO(data), len(data))
+            digest.update(data)
+            part += 1
+            if len(data) < SQL_PART_SIZE:
+                break
+    finally:
+        dump.stdout.close()
+        returncode = dump.wait()
+    if returncode != 0:
+        raise RuntimeError("pg_dump exited with status %d" % returncode)
+    logger.info("cmd=\"pg_dump %s\" bytes=%d parts=%d" % (database, digest.size, part))
+    return digest, part
+
+
+class DigestingWriter():
+    """Writes to the file while digesting everything written"""
+    def __init__(self, f):
+        self.f = f
+        self.digest = manifest.Digest()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+
+class ArchiveSink():
+    """The end of the pipeline: gpg encrypting to the archive file, or just
+    the file when no recipient is configured. Written to a temporary name
+    and only renamed into place once everything has succeeded. The archive
+    is digested on its way to disk (gpg's output is copied by a thread)."""
+    def __init__(self, filename, recipient):
+        self.filename = filename
+        self.partial = filename + '.partial'
+        self.writer = DigestingWriter(open(self.partial, 'wb'))
+        self.gpg = None
+        if recipient:
+            self.gpg = subprocess.Popen(
+                ['gpg', '--batch', '--yes', '--encrypt', '--recipient', recipient],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            self.copier = threading.Thread(target=shutil.copyfileobj, args=(self.gpg.stdout, self.writer))
+            self.copier.start()
+            self.stream = self.gpg.stdin
+        else:
+            self.stream = self.writer
+
+    @property
+    def digest(self):
+        return self.writer.digest
+
+    def close(self, succeeded):
+        self.stream.close()
+        if self.gpg is not None:
+            self.copier.join()
+            self.writer.close()
+            if self.gpg.wait() != 0:
+                succeeded = False
+                logger.error("gpg exited with status %d" % self.gpg.returncode)
+        if succeeded:
+            os.replace(self.partial, self.filename)
+        elif os.path.exists(self.partial):
+            os.remove(self.partial)
+        return succeeded
+
+
 @capture_function
-def package(filenames):
-    latest = 'latest.tar.gz'
-    logger.info("Packaging archive")
-    logger.debug("Contents: %s" % filenames)
+def package(fixtures, details):
+    """Streams the fixtures (and, into a full archive, the SQL dump) into a
+    new archive. The details, which include its kind, are added to its
+    manifest."""
+    logger.info("Packaging %s archive" % details['kind'])
+    logger.debug("Contents: %s" % [fixture.name for fixture in fixtures])
+    recipient = get_gpg_recipient()
+    codec, level, jobs = get_compression()
     date = datetime.datetime.utcnow().strftime(DATE_FORMAT)
-    filename = "%s.tar.gz" % date
-    with tarfile.open(filename, 'w:gz') as archive:
-        [archive.add(name) for name in filenames]
-    if os.path.lexists(latest):
-        os.unlink(latest)
-    os.symlink(filename, latest)
+    if details['kind'] == FULL:
+        filename = "%s.tar.%s" % (date, codec.extension)
+    else:
+        filename = "%s.changes.tar.%s" % (date, codec.extension)
+    if recipient:
+        filename += '.gpg'
+    else:
+        logger.warning("BACKUPS_GPG_RECIPIENT is not set, so the archive will not be encrypted")
+
+    files = {}
+    sink = ArchiveSink(filename, recipient)
+    succeeded = False
+    try:
+        # 'w|' writes the tar stream without seeking, so the archive flows
+        # through the compressor straight into gpg
+        compressor = compression.open_writer(codec, sink.stream, level, jobs)
+        with tarfile.open(fileobj=compressor, mode='w|') as archive:
+            for fixture in fixtures:
+                with open(fixture.path, 'rb') as f:
+                    add_member(archive, fixture.name, f, fixture.digest.size)
+                files[fixture.name] = dict(fixture.digest.to_dict(), rows=fixture.rows)
+            if details['kind'] == FULL:
+                database = get_database_name()
+                digest, parts = add_postgres_dump(archive, database)
+                files['%s.sql' % database] = dict(digest.to_dict(), parts=parts)
+        compressor.close()
+        succeeded = True
+    finally:
+        written = sink.close(succeeded)
+    if not written:
+        raise RuntimeError("Failed to write '%s'" % filename)
+
+    details = dict(details, **sink.digest.to_dict())
+    details.update({
+        'version': manifest.VERSION,
+        'archive': filename,
+        'created': date,
+        'encrypted': bool(recipient),
+        'compression': codec.name,
+        'files': files,
+    })
+    manifest.write(manifest.manifest_name(filename), details)
+    manifest.write(manifest.LATEST, details)
+    if os.path.lexists(LATEST):
+        os.unlink(LATEST)
+    os.symlink(filename, LATEST)
     return filename
 
 
 @capture_function
-def encrypt(filename):
-    encrypted_filename = '%s.gpg' % filename
-    if os.path.isfile(encrypted_filename):
-        os.path.remove(encrypted_filename)
-    r = envoy.run("./encrypt.sh %s" % filename)
-    return encrypted_filename
+def package_chunks(store, fixtures, details):
+    """Stores the fixtures and the SQL dump in the chunk store as a new
+    snapshot, whose manifest lists their chunks. Returns its name."""
+    date = datetime.datetime.utcnow().strftime(DATE_FORMAT)
+    name = chunks.snapshot_name(date)
+    files = {}
+    new = []
+    for fixture in fixtures:
+        with open(fixture.path, 'rb') as f:
+            entries, digest, added = store.add(f)
+        files[fixture.name] = dict(digest.to_dict(), rows=fixture.rows, chunks=entries)
+        new.extend(added)
+    database = get_database_name()
+    dump = subprocess.Popen(['pg_dump', database], stdout=subprocess.PIPE)
+    try:
+        entries, digest, added = store.add(dump.stdout)
+    finally:
+        dump.stdout.close()
+        returncode = dump.wait()
+    if returncode != 0:
+        raise RuntimeError("pg_dump exited with status %d" % returncode)
+    files['%s.sql' % database] = dict(digest.to_dict(), chunks=entries)
+    new.extend(added)
+    logger.info("cmd=\"pg_dump %s\" bytes=%d chunks=%d" % (database, digest.size, len(entries)))
+
+    details = dict(details, **{
+        'version': manifest.VERSION,
+        'format': chunks.FORMAT,
+        'archive': name,
+        'created': date,
+        'encrypted': bool(store.recipient),
+        'files': files,
+    })
+    store.save_snapshot(details)
+    manifest.write(manifest.manifest_name(name), details)
+    manifest.write(manifest.LATEST, details)
+    logger.info("Stored snapshot '%s' with %d new chunks" % (name, len(new)))
+    return name
+
+
+def get_uploader():
+    access, secret = get_s3_credentials()
+    return transfer.Uploader(lambda: S3Connection(access, secret), get_s3_bucket_name())
 
 
 @capture_function
 def upload(filename):
-    if not filename.endswith('.gpg'):
+    if not filename.endswith(('.gpg', '.manifest.json')):
         logger.warning("Upload requested for '%s' which appears to be plaintext (not encrypted)" % filename)
-    access, secret = get_s3_credentials()
-    bucket_name = get_s3_bucket_name()
+    uploader = get_uploader()
     key_name = 'db/%s' % filename
-    connection = S3Connection(access, secret)
-    bucket = Bucket(connection, bucket_name)
-    key = Key(bucket)
-    key.key = key_name
-    key.set_contents_from_filename(filename)
-    logger.info("Uploaded '%s' to '%s:%s'" % (filename, bucket_name, key_name))
-    return os.path.getsize(filename)
-
-
-filenames = [dump_postgres(),]
-filenames.extend(dump_django_fixtures())
-if update_necessary():
-    archive = package(filenames)
-    secured = encrypt(archive)
-    filesize = upload(secured)
-    logger.info("---- Uploading complete ---- bytes=%d --------------------" % filesize)
-else:
-    logger.info("---- Digests match, ceasing activity ---------------------")
-map(os.remove, filenames)
+    size = uploader.upload(filename, key_name)
+    logger.info("Uploaded '%s' to '%s:%s'" % (filename, uploader.bucket_name, key_name))
+    return size
+
+
+@capture_function
+def upload_chunks(store, name):
+    """Uploads the chunks of the snapshot which aren't on S3 yet. Returns
+    the number of bytes uploaded."""
+    details = store.read_snapshot(name)
+    digests = {digest for entry in details['files'].values() for digest, size in entry['chunks']}
+    paths = []
+    for digest in sorted(digests):
+        path = store.find_chunk(digest)
+        if path is None:
+            raise RuntimeError("Chunk %s of '%s' is missing from the store" % (digest, name))
+        paths.append(path)
+    paths = sorted(set(paths) - store.uploaded())
+    uploader = get_uploader()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=uploader.jobs) as pool:
+        sizes = list(pool.map(
+            lambda path: uploader.upload(store.full_path(path), chunks.remote_name(path)), paths))
+    store.mark_uploaded(paths)
+    logger.info("Uploaded %d of the %d chunks of '%s'" % (len(paths), len(digests), name))
+    return sum(sizes)
+
+
+def add_to_month_index(uploader, details):
+    key = uploader.bucket().new_key('db/%s' % manifest.month_index_name(details['created']))
+    try:
+        index = json.loads(key.get_contents_as_string().decode('utf-8'))
+    except S3ResponseError as e:
+        if e.status != 404:
+            raise
+        index = {'version': manifest.VERSION, 'archives': []}
+    entries = {entry['archive']: entry for entry in index['archives']}
+    entries[details['archive']] = manifest.index_entry(details)
+    index['archives'] = [entries[name] for name in sorted(entries)]
+    key.set_contents_from_string(json.dumps(index, indent=4, sort_keys=True))
+
+
+@capture_function
+def publish(archive):
+    """Adds the uploaded archive to its month's index and, if it's the newest
+    archive, makes its manifest db/LATEST. This comes after the archive and
+    its manifest are uploaded, so the indexes never point at missing keys."""
+    uploader = get_uploader()
+    details = manifest.read(manifest.manifest_name(archive))
+    uploader.attempt("Updating the index of %s" % details['created'][:7], add_to_month_index, uploader, details)
+    latest = manifest.read(manifest.LATEST)
+    if latest is not None and latest['archive'] == archive:
+        uploader.upload(manifest.manifest_name(archive), 'db/%s' % manifest.INDEX)
+    logger.info("Published '%s'" % archive)
+
+
+def upload_archive(archive):
+    """Uploads the archive (or the new chunks of the snapshot) and then its
+    manifest, and publishes it. Returns the number of bytes uploaded."""
+    store = get_chunk_store()
+    if archive.endswith('.' + chunks.FORMAT):
+        filesize = upload_chunks(store, archive)
+    else:
+        filesize = upload(archive)
+    upload(manifest.manifest_name(archive))
+    publish(archive)
+    if archive.endswith('.' + chunks.FORMAT):
+        store.mark_uploaded([store.snapshot_path(archive)])
+    return filesize
+
+
+def resume_uploads():
+    """Finishes uploading archives (and then their manifests) whose uploads
+    were interrupted by an earlier run, and snapshots which weren't
+    uploaded."""
+    for filename in transfer.pending_uploads():
+        filename = os.path.basename(filename)
+        logger.info("Resuming the upload of '%s'" % filename)
+        upload(filename)
+        if os.path.exists(manifest.manifest_name(filename)):
+            upload(manifest.manifest_name(filename))
+            publish(filename)
+    store = get_chunk_store()
+    if store is not None:
+        uploaded = store.uploaded()
+        for name in store.snapshots():
+            if store.snapshot_path(name) not in uploaded:
+                logger.info("Uploading snapshot '%s', left by an earlier run" % name)
+                upload_archive(name)
+
+
+def incremental_possible(latest, started):
+    """Returns True if the next archive may be an incremental one, following
+    the latest archive."""
+    interval = get_full_interval()
+    # Snapshots in a chunk store share their unchanged chunks already
+    if interval is None or get_chunk_store() is not None:
+        return False
+    # Archives from before incremental backups can't anchor a chain
+    if latest is None or 'anchor_started' not in latest:
+        return False
+    return started - parse_time(latest['anchor_started']) < interval
+
+
+def package_snapshot(directory, latest, watermark, started):
+    """Makes a full archive if the data differs from the latest archive's.
+    Returns its name, or None if it wasn't needed."""
+    fixtures = dump_django_fixtures(directory)
+    if not update_necessary(fixtures):
+        return None
+    details = {
+        'kind': FULL,
+        'started': format_time(started),
+        'anchor_started': format_time(started),
+        'watermark': watermark,
+    }
+    store = get_chunk_store()
+    if store is not None:
+        archive = package_chunks(store, fixtures, details)
+    else:
+        archive = package(fixtures, details)
+    prune_deletions(started)
+    return archive
+
+
+def package_changes(directory, latest, watermark, started):
+    """Makes an incremental archive following the latest archive, if
+    anything has changed since. Returns its name, or None."""
+    since = parse_time(latest['started']) - CHANGE_MARGIN
+    fixtures = dump_changes(directory, since, watermark, latest['watermark'])
+    if not fixtures:
+        return None
+    return package(fixtures, {
+        'kind': INCREMENTAL,
+        'started': format_time(started),
+        'base': latest['archive'],
+        'anchor': latest.get('anchor', latest['archive']),
+        'anchor_started': latest['anchor_started'],
+        'watermark': watermark,
+    })
+
+
+def main():
+    started = datetime.datetime.now(datetime.timezone.utc)
+    resume_uploads()
+    watermark = get_watermark()
+    latest = manifest.read(manifest.LATEST)
+    if latest is not None and latest.get('watermark') == watermark:
+        logger.info("---- Watermark unchanged, ceasing activity ---------------")
+        return
+
+    directory = tempfile.mkdtemp(prefix='fixtures-', dir='.')
+    try:
+        if incremental_possible(latest, started):
+            archive = package_changes(directory, latest, watermark, started)
+        else:
+            archive = package_snapshot(directory, latest, watermark, started)
+    finally:
+        shutil.rmtree(directory)
+
+    if archive is not None:
+        filesize = upload_archive(archive)
+        logger.info("---- Uploading complete ---- bytes=%d --------------------" % filesize)
+    else:
+        # The data is the same as in the latest archive (or chain), so the
+        # watermark is just as good a description of it
+        latest['watermark'] = watermark
+        manifest.write(manifest.LATEST, latest)
+        logger.info("---- Digests match, ceasing activity ---------------------")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        filename='backup.log',
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s]: %(message)s",
+        datefmt=DATE_FORMAT,
+    )
+    main()
@@ -0,0 +1,148 @@
+"""
+Compression of backup archives, with a choice of codec
+
+    gzip  Readable by gzip (and tarfile). The stream is cut into blocks which
+          are compressed on a pool of threads, as pigz does.
+    zstd  Faster and smaller, using the library's own threads. Needs the
+          zstandard package, which is only imported if it's installed.
+
+Writers compress what's written to them into another file object and never
+close it; close() just finishes the compressed stream. Readers decompress a
+file object as it's read, which needn't be seekable (e.g. gpg's output).
+
+A gzip block is compressed on its own, so zlib (which releases the GIL while
+it works) can compress several at once, but each is primed with the 32KB
+before it, so back-references still reach across blocks and the output is
+nearly as small as gzip's. Each block ends with a full flush, which leaves it
+on a byte boundary, so the blocks simply concatenate into one deflate stream
+within a single gzip member. The CRC is computed over the blocks in order.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BLOCK_SIZE = 128 * 1024
+# The most deflate can refer back
+DICTIONARY_SIZE = 32 * 1024
+
+# Gzip header: magic, deflate, no flags, no mtime (so equal input gives equal
+# output), no extra flags, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def compress_block(block, dictionary, level):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+class GzipWriter():
+    """Writes a gzip stream of what's written to it, compressing BLOCK_SIZE
+    blocks on a pool of threads"""
+    def __init__(self, f, level, jobs):
+        self.f = f
+        self.level = level
+        self.jobs = jobs
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        # Blocks being compressed, in order
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        self.f.write(GZIP_HEADER)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            block = bytes(self.buffer[:BLOCK_SIZE])
+            del self.buffer[:BLOCK_SIZE]
+            self.submit(block)
+        return len(data)
+
+    def submit(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.pool.submit(compress_block, block, self.dictionary, self.level))
+        self.dictionary = block[-DICTIONARY_SIZE:]
+        # Write out the blocks which are done, and wait for the oldest rather
+        # than letting blocks pile up in memory
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.jobs):
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        # An empty final block ends the deflate stream
+        self.f.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+        self.f.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+
+
+class ZstdWriter():
+    """Writes a zstd frame of what's written to it"""
+    def __init__(self, f, level, jobs):
+        self.writer = zstandard.ZstdCompressor(level=level, threads=jobs).stream_writer(f)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def close(self):
+        # Ends the frame without closing the file
+        self.writer.flush(zstandard.FLUSH_FRAME)
+
+
+def gzip_reader(f):
+    return gzip.GzipFile(fileobj=f, mode='rb')
+
+
+def zstd_reader(f):
+    return zstandard.ZstdDecompressor().stream_reader(f)
+
+
+Codec = collections.namedtuple('Codec', ['name', 'extension', 'default_level', 'writer', 'reader'])
+
+CODECS = collections.OrderedDict([
+    ('gzip', Codec('gzip', 'gz', 6, GzipWriter, gzip_reader)),
+    ('zstd', Codec('zstd', 'zst', 3, ZstdWriter, zstd_reader)),
+])
+
+
+def get_codec(name):
+    """Returns the named Codec, if it can be used."""
+    if name not in CODECS:
+        raise ValueError("Unknown compression '%s' (expected one of %s)" % (name, ', '.join(CODECS)))
+    if name == 'zstd' and zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package")
+    return CODECS[name]
+
+
+def available_codecs():
+    return [codec for codec in CODECS.values() if codec.name != 'zstd' or zstandard is not None]
+
+
+def open_writer(codec, f, level=None, jobs=None):
+    """Returns a writer compressing into the file with the codec."""
+    if level is None:
+        level = codec.default_level
+    return codec.writer(f, level, jobs or os.cpu_count() or 1)
+
+
+def open_reader(codec, f):
+    """Returns a file object decompressing the file with the codec."""
+    return codec.reader(f)
@@ -1,22 +1,25 @@
 import datetime
+import json
 import logging
 import os
 
+from boto.exception import S3ResponseError
 from boto.s3.connection import S3Connection
 from boto.s3.bucket import Bucket
-from boto.s3.key import Key
+
+import chunks
+import manifest
+import transfer
 
 
 # ISO 8601 YYYY-MM-DDTHH:MM:SS
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 
-logging.basicConfig(
-    filename='retrieve.log',
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s]: %(message)s",
-    datefmt=DATE_FORMAT,
-)
+# Manifests are stored beside the archives, and mustn't be taken for them
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tar.gz.gpg', '.tar.zst', '.tar.zst.gpg')
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -66,7 +69,8 @@ def get_latest_key(bucket, key_prefix, delimiter='/', past_days=7, future_days=1
         # as we come across it, assuming the keys are ordered, then the last
         # key we save will be the latest.
         for key in matched:
-            latest_key = key
+            if key.name.endswith(ARCHIVE_EXTENSIONS):
+                latest_key = key
         
         if latest_key is not None:
             logger.info("Found a match with '%s'" % (latest_key.key))
@@ -78,6 +82,78 @@ def get_latest_key(bucket, key_prefix, delimiter='/', past_days=7, future_days=1
     return None
 
 
+def read_json(bucket, key_name):
+    """Returns the JSON object stored in the key, or None if there's no such
+    key. Takes a single GET."""
+    try:
+        data = bucket.new_key(key_name).get_contents_as_string()
+    except S3ResponseError as e:
+        if e.status != 404:
+            raise
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+@capture_function
+def find_latest(bucket, key_prefix, delimiter='/'):
+    """Returns the manifest (or index entry) of the latest archive. The LATEST
+    index is tried first, then the monthly indexes for this month and the
+    last, and only then is the bucket listed, in which case just the name and
+    size of the archive are known."""
+    latest = read_json(bucket, delimiter.join([key_prefix, manifest.INDEX]))
+    if latest is not None:
+        return latest
+    logger.warning("No '%s' index found, trying the monthly indexes" % manifest.INDEX)
+    this_month = datetime.date.today().replace(day=1)
+    last_month = (this_month - datetime.timedelta(days=1)).replace(day=1)
+    for month in (this_month, last_month):
+        index = read_json(bucket, delimiter.join([key_prefix, manifest.month_index_name(month.isoformat())]))
+        if index and index['archives']:
+            return index['archives'][-1]
+    logger.warning("No monthly index found, listing the bucket")
+    key = get_latest_key(bucket, key_prefix, delimiter)
+    if key is None:
+        return None
+    return {'archive': key.name.split(delimiter)[-1], 'size': key.size, 'sha1': None}
+
+
+@capture_function
+def download_chain(bucket, downloader, key_prefix, archive, delimiter='/'):
+    """Downloads the incremental archive, and each archive before it back to
+    the full one anchoring its chain, along with their manifests. They keep
+    their own names so that restore_chain.py can find them."""
+    while archive:
+        details = read_json(bucket, delimiter.join([key_prefix, manifest.manifest_name(archive)]))
+        if details is None:
+            raise SystemExit("The manifest of '%s' is missing, so its chain can't be followed" % archive)
+        manifest.write(manifest.manifest_name(archive), details)
+        logger.info("Downloading '%s'" % archive)
+        downloader.download(delimiter.join([key_prefix, archive]), archive, details['size'], details['sha1'])
+        archive = details.get('base')
+
+
+@capture_function
+def download_snapshot(bucket, downloader, key_prefix, archive, delimiter='/'):
+    """Downloads the manifest of the snapshot, and those of its chunks which
+    aren't in the local chunk store already. The chunks are checked against
+    their digests as they're read back."""
+    details = read_json(bucket, delimiter.join([key_prefix, manifest.manifest_name(archive)]))
+    if details is None:
+        raise SystemExit("The manifest of '%s' is missing" % archive)
+    manifest.write(manifest.manifest_name(archive), details)
+    store = chunks.ChunkStore(chunks.STORE)
+    digests = {digest for entry in details['files'].values() for digest, size in entry['chunks']}
+    paths = [store.chunk_path(digest, details['encrypted'])
+             for digest in sorted(digests) if store.find_chunk(digest) is None]
+    logger.info("Downloading %d of the %d chunks of '%s'" % (len(paths), len(digests), archive))
+
+    def fetch(path):
+        os.makedirs(os.path.dirname(store.full_path(path)), exist_ok=True)
+        downloader.fetch(chunks.remote_name(path, key_prefix), store.full_path(path))
+
+    downloader.for_each_part(paths, fetch)
+
+
 @capture_function
 def download():
     access, secret = get_s3_credentials()
@@ -85,17 +161,38 @@ def download():
     
     bucket_name = get_s3_bucket_name()
     bucket = Bucket(connection, bucket_name)
+    downloader = transfer.Downloader(lambda: S3Connection(access, secret), bucket_name)
     
     key_prefix = 'db'
-    key = get_latest_key(bucket, key_prefix)
-    if key is None:
+    latest = find_latest(bucket, key_prefix)
+    if latest is None:
         logger.warning("Unable to locate latest archive on S3")
+    elif latest.get('format') == chunks.FORMAT:
+        logger.info("Latest snapshot is kept as chunks, downloading those not already here")
+        download_snapshot(bucket, downloader, key_prefix, latest['archive'])
+    elif latest.get('base') or '.changes.' in latest['archive']:
+        logger.info("Latest archive is incremental, downloading its chain")
+        download_chain(bucket, downloader, key_prefix, latest['archive'])
     else:
-        latest = 'latest.tar.gz'
-        if key.name.endswith('.gpg'):
+        # Keeping the archive's extensions, e.g. latest.tar.gz.gpg
+        filename = 'latest%s' % latest['archive'][latest['archive'].index('.tar.'):]
+        if latest['archive'].endswith('.gpg'):
             logger.info("Key's contents are probably encrypted, saving with .gpg extension")
-            latest = '%s.gpg' % latest
-        key.get_contents_to_filename(latest)
-
-
-download()
+        if latest.get('sha1') is None:
+            logger.warning("'%s' has no manifest, so it can't be verified" % latest['archive'])
+        downloader.download('/'.join([key_prefix, latest['archive']]), filename, latest['size'], latest.get('sha1'))
+        # restore.py needs the full manifest (not just an index entry) beside the archive
+        details = latest if 'files' in latest else read_json(
+            bucket, '/'.join([key_prefix, manifest.manifest_name(latest['archive'])]))
+        if details is not None:
+            manifest.write(manifest.manifest_name(filename), details)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        filename='retrieve.log',
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s]: %(message)s",
+        datefmt=DATE_FORMAT,
+    )
+    download()
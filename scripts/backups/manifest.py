@@ -0,0 +1,135 @@
+"""Sidecar manifests describing backup archives
+
+Each archive is accompanied by '<archive>.manifest.json', written by
+collect.py as the archive is streamed out:
+
+    {
+        "version": 1,
+        "archive": "2019-08-01T11:50:00.tar.gz.gpg",
+        "created": "2019-08-01T11:50:00",
+        "encrypted": true,
+        "compression": "gzip",      # or "zstd" (see compression.py)
+        "sha1": "...",              # of the archive file itself
+        "size": 123456,
+        "files": {
+            "auth.json": {"sha1": "...", "size": 2048, "rows": {"auth.User": 12, ...}},
+            "checkniner.sql": {"sha1": "...", "size": 17777780, "parts": 3}
+        },
+        "watermark": {...},         # see collect.get_watermark()
+        "kind": "full",             # or "incremental"
+        "started": "2019-08-01T11:49:58",
+        "anchor_started": "2019-08-01T11:49:58"
+    }
+
+A snapshot kept in a chunk store (see chunks.py) has no archive: its
+manifest has "format": "chunks", and each of its files lists its chunks.
+
+An incremental archive holds changes.json and deleted.json rather than every
+fixture, and its manifest also names the archive it follows ("base") and the
+full archive its chain leads back to ("anchor"), which was started at
+"anchor_started".
+
+The digests in "files" are of the plaintext members (the SQL dump's is of
+its parts concatenated), so they can be compared with a fresh dump without
+decrypting anything. Fixtures also record how many rows of each model they
+hold, against which a restored database can be checked.
+
+The manifest of the newest archive is also kept as latest.manifest.json.
+
+Once an archive has been uploaded, its manifest is also uploaded as db/LATEST,
+so the latest archive can be found with a single GET, and a summary of it is
+added to the index of its month, db/index/YYYY-MM.json:
+
+    {
+        "version": 1,
+        "archives": [
+            {"archive": "...", "created": "...", "kind": "full", "base": null,
+             "format": null, "sha1": "...", "size": 123456, "encrypted": true},
+            ...
+        ]
+    }
+"""
+
+import hashlib
+import json
+import os
+
+
+VERSION = 1
+LATEST = 'latest.manifest.json'
+# The key (under db/) of the copy of the newest archive's manifest
+INDEX = 'LATEST'
+CHUNK_SIZE = 1024 * 1024
+
+
+class Digest():
+    """Running SHA1 digest and size of a stream of data"""
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def update(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def to_dict(self):
+        return {'sha1': self.hexdigest(), 'size': self.size}
+
+
+def digest_of(data):
+    digest = Digest()
+    digest.update(data)
+    return digest
+
+
+def file_digest(filename):
+    """Digests the file a chunk at a time."""
+    digest = Digest()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def matches(digest, entry):
+    """Returns True if the digest is the one recorded in the manifest's entry
+    for a file (which may hold more than the digest, e.g. row counts)."""
+    return entry is not None and digest.to_dict() == {'sha1': entry.get('sha1'), 'size': entry.get('size')}
+
+
+def manifest_name(archive):
+    return '%s.manifest.json' % archive
+
+
+def month_index_name(created):
+    """Returns the key (under db/) of the index of the month of the time,
+    formatted as in 'created'."""
+    return 'index/%s.json' % created[:7]
+
+
+def index_entry(details):
+    """Returns the summary of the archive kept in the monthly indexes."""
+    return {name: details.get(name)
+            for name in ('archive', 'created', 'kind', 'format', 'base', 'sha1', 'size', 'encrypted')}
+
+
+def read(filename):
+    """Returns the manifest stored in the file, or None if there isn't one
+    (or it's from an incompatible version)."""
+    try:
+        with open(filename, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    if manifest.get('version') != VERSION:
+        return None
+    return manifest
+
+
+def write(filename, manifest):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
@@ -0,0 +1,286 @@
+"""
+Restores the database from a backup archive in a single pass, streaming it
+through gpg and gzip straight into the database. Nothing is written to disk
+along the way.
+
+    python restore.py [--psql] [--app LABEL ...] [--no-verify] [ARCHIVE]
+
+ARCHIVE is the archive to restore (default: latest.tar.gz.gpg, or whichever
+of latest.tar.gz, latest.tar.zst.gpg, etc. get_latest_archive.py downloaded).
+Its manifest, '<ARCHIVE>.manifest.json', must be beside it. A snapshot kept
+as chunks (ARCHIVE is then e.g. 2019-08-01T11:50:00.chunks) is read from the
+chunk store in the 'store' directory beside its manifest instead.
+
+By default the fixtures of the auth and checkouts apps (see --app) are loaded
+into the database in DATABASE_URL, as loaddata would, in one transaction.
+With --psql, the archive's SQL dump is piped into psql instead, as a single
+transaction which stops at the first error, so it should be restored into an
+empty database (e.g. one just made with createdb).
+
+Each file is checked against the digest in the manifest as it's streamed,
+and gpg's verdict on the archive is waited for, before anything is
+committed. Afterwards, the number of rows of each model of the restored apps
+is compared with the number the manifest says the archive holds.
+"""
+
+import argparse
+import collections
+import contextlib
+import logging
+import os
+import subprocess
+import sys
+import tarfile
+
+import django # Provides django.setup()
+from django.apps import apps as django_apps
+from django.core import serializers
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connection, router, transaction
+
+import chunks
+import compression
+import manifest
+
+
+RESTORED_APPS = ('auth', 'checkouts')
+
+
+logger = logging.getLogger(__name__)
+
+
+class DigestingReader():
+    """Reads from the file while digesting everything read"""
+    def __init__(self, f, digest=None):
+        self.f = f
+        self.digest = digest or manifest.Digest()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+    def drain(self):
+        """Reads (and digests) whatever hasn't been read yet."""
+        for chunk in iter(lambda: self.read(manifest.CHUNK_SIZE), b''):
+            pass
+
+
+@contextlib.contextmanager
+def open_archive(filename, encrypted, codec_name='gzip'):
+    """Yields the archive as a tarfile stream, decrypting it with gpg on the
+    way if need be. On leaving, the rest of the archive is read (which has
+    gzip check its CRC) and gpg's exit status checked, since it only reports
+    a damaged or tampered archive once it has read all of it."""
+    gpg = None
+    if encrypted:
+        gpg = subprocess.Popen(['gpg', '--quiet', '--decrypt', filename], stdout=subprocess.PIPE)
+        stream = gpg.stdout
+    else:
+        stream = open(filename, 'rb')
+    try:
+        decompressed = compression.open_reader(compression.get_codec(codec_name), stream)
+        with tarfile.open(fileobj=decompressed, mode='r|') as archive:
+            yield archive
+        for f in (decompressed, stream):
+            for chunk in iter(lambda: f.read(manifest.CHUNK_SIZE), b''):
+                pass
+    finally:
+        stream.close()
+        if gpg is not None and gpg.wait() != 0 and sys.exc_info()[0] is None:
+            raise SystemExit("gpg exited with status %d" % gpg.returncode)
+
+
+@contextlib.contextmanager
+def open_members(filename, details):
+    """Yields an iterator of the name and contents (a file object) of each
+    file in the archive, in the order they're stored. A snapshot's files are
+    read from the chunk store beside its manifest instead, each chunk being
+    fetched only when it's read."""
+    if details.get('format') == chunks.FORMAT:
+        store = chunks.ChunkStore(os.path.join(os.path.dirname(filename), chunks.STORE))
+        yield ((name, store.open(entry['chunks'])) for name, entry in details['files'].items())
+    else:
+        # Archives from before the choice of codec are gzipped
+        with open_archive(filename, details.get('encrypted'), details.get('compression', 'gzip')) as archive:
+            yield ((member.name, archive.extractfile(member)) for member in archive)
+
+
+def check_digest(details, name, digest):
+    if not manifest.matches(digest, details['files'].get(name)):
+        raise SystemExit("%s in %s doesn't match its manifest" % (name, details['archive']))
+
+
+def read_members(filename, details, names):
+    """Yields the name and contents (a file object) of each of the named
+    files in the archive, in the order they're stored. Each one is checked
+    against the manifest once the caller moves on to the next, so loading
+    them within a transaction keeps a damaged archive out of the database."""
+    found = set()
+    with open_members(filename, details) as members:
+        for name, f in members:
+            if name not in names:
+                continue
+            reader = DigestingReader(f)
+            yield name, reader
+            reader.drain()
+            check_digest(details, name, reader.digest)
+            found.add(name)
+    missing = set(names) - found
+    if missing:
+        raise SystemExit("%s is missing %s" % (details['archive'], ', '.join(sorted(missing))))
+
+
+def load_streams(streams):
+    """Loads the JSON fixtures read from the streams into the database, the
+    way loaddata would. Returns the number of rows loaded of each model.
+
+    Django's JSON deserializer reads a whole fixture into memory (though not
+    onto disk) before saving any of it, so this should be run within a
+    transaction.
+    """
+    rows = collections.Counter()
+    models = set()
+    with connection.constraint_checks_disabled():
+        for stream in streams:
+            for obj in serializers.deserialize('json', stream):
+                model = obj.object.__class__
+                if router.allow_migrate_model(DEFAULT_DB_ALIAS, model):
+                    obj.save(using=DEFAULT_DB_ALIAS)
+                    rows[model._meta.label] += 1
+                    models.add(model)
+    # Since constraint checks were disabled, look for any invalid keys now
+    connection.check_constraints(table_names=[model._meta.db_table for model in models])
+    if models:
+        with connection.cursor() as cursor:
+            for line in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(line)
+    return rows
+
+
+def load_fixtures(filename, details, names):
+    """Loads the named fixtures from the archive. Returns the number of rows
+    loaded of each model."""
+    return load_streams(reader for name, reader in read_members(filename, details, names))
+
+
+def is_sql_part(name, sql_name):
+    # Archives from before the dump was split hold a single member
+    return name == sql_name or (name.startswith(sql_name + '.') and name[len(sql_name) + 1:].isdigit())
+
+
+def restore_sql(filename, details, database_url):
+    """Pipes the archive's SQL dump into psql. psql runs it as a single
+    transaction, which is only committed (by closing psql's input) once the
+    whole dump has been checked against the manifest; otherwise psql is
+    killed, which rolls it back."""
+    sql_names = [name for name in details['files'] if name.endswith('.sql')]
+    if len(sql_names) != 1:
+        raise SystemExit("%s doesn't hold an SQL dump" % details['archive'])
+    sql_name = sql_names[0]
+    psql = subprocess.Popen(
+        ['psql', '--quiet', '--no-psqlrc', '--single-transaction', '--set', 'ON_ERROR_STOP=1',
+         '--dbname', database_url],
+        stdin=subprocess.PIPE,
+    )
+    digest = manifest.Digest()
+    try:
+        with open_members(filename, details) as members:
+            for name, f in members:
+                if not is_sql_part(name, sql_name):
+                    continue
+                source = DigestingReader(f, digest)
+                for chunk in iter(lambda: source.read(manifest.CHUNK_SIZE), b''):
+                    psql.stdin.write(chunk)
+        check_digest(details, sql_name, digest)
+        psql.stdin.close()
+    except BrokenPipeError:
+        raise SystemExit("psql exited with status %d" % psql.wait())
+    except BaseException:
+        psql.kill()
+        psql.wait()
+        raise
+    if psql.wait() != 0:
+        raise SystemExit("psql exited with status %d" % psql.returncode)
+    logger.info("Restored %s (%d bytes) with psql" % (sql_name, digest.size))
+
+
+def expected_rows(details, apps):
+    """Returns the number of rows of each of the apps' models which the
+    manifest says the archive holds, or None if it doesn't say."""
+    rows = {}
+    for app in apps:
+        entry = details['files'].get('%s.json' % app)
+        if entry is None:
+            continue
+        if 'rows' not in entry:
+            return None
+        rows.update(entry['rows'])
+    return rows
+
+
+def verify_rows(details, apps):
+    """Compares the number of rows of each of the apps' models in the
+    database with the manifest. Returns True if they all match."""
+    expected = expected_rows(details, apps)
+    if expected is None:
+        logger.warning("%s's manifest has no row counts, so the restore can't be verified" % details['archive'])
+        return True
+    mismatched = 0
+    for app in apps:
+        for model in django_apps.get_app_config(app).get_models():
+            label = model._meta.label
+            if label not in expected:
+                continue
+            count = model._default_manager.count()
+            if count != expected[label]:
+                logger.error("%s has %d rows rather than %d" % (label, count, expected[label]))
+                mismatched += 1
+    logger.info("Verified the row counts of %d models (%d mismatched)" % (len(expected), mismatched))
+    return not mismatched
+
+
+def default_archive():
+    for codec in compression.CODECS.values():
+        for filename in ('latest.tar.%s.gpg' % codec.extension, 'latest.tar.%s' % codec.extension):
+            if os.path.exists(filename):
+                return filename
+    return 'latest.tar.gz.gpg'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restores the database from a backup archive.")
+    parser.add_argument('archive', nargs='?', default=default_archive(),
+        help="archive to restore (default: the latest.tar.* downloaded)")
+    parser.add_argument('--psql', action='store_true',
+        help="restore the SQL dump with psql rather than loading the fixtures")
+    parser.add_argument('--app', action='append', dest='apps', metavar='LABEL',
+        help="app whose fixture to load (repeatable; default: %s)" % ', '.join(RESTORED_APPS))
+    parser.add_argument('--no-verify', action='store_false', dest='verify',
+        help="don't compare the row counts with the manifest's afterwards")
+    options = parser.parse_args()
+    if options.psql and options.apps:
+        parser.error("the SQL dump can only be restored whole, so --app can't be used with --psql")
+
+    details = manifest.read(manifest.manifest_name(options.archive))
+    if details is None:
+        raise SystemExit("Can't read the manifest '%s'" % manifest.manifest_name(options.archive))
+    if details.get('kind', 'full') != 'full':
+        raise SystemExit("%s is incremental, so restore its chain with restore_chain.py" % details['archive'])
+    apps = options.apps or RESTORED_APPS
+
+    django.setup()
+    if options.psql:
+        restore_sql(options.archive, details, os.environ['DATABASE_URL'])
+    else:
+        names = ['%s.json' % app for app in apps]
+        with transaction.atomic():
+            rows = load_fixtures(options.archive, details, names)
+        logger.info("Loaded %d rows from %s" % (sum(rows.values()), ', '.join(names)))
+    if options.verify and not verify_rows(details, apps):
+        raise SystemExit("The restored database doesn't match %s's manifest" % details['archive'])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    main()
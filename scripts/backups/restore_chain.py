@@ -0,0 +1,109 @@
+"""
+Restores the database from a chain of backup archives: the full archive which
+anchors the chain, followed by each incremental archive in turn.
+
+    python restore_chain.py [--skip-full] [--fixture NAME ...] [MANIFEST]
+
+MANIFEST is the manifest of the last archive to restore (default:
+latest.manifest.json). The other archives of its chain, and their manifests,
+must be in the same directory. Like restore.py, each archive is streamed
+through gpg and gzip straight into the database, and each file taken from it
+is checked against the digest in its manifest before anything is committed.
+
+The auth and checkouts fixtures are loaded from the full archive (see
+--fixture). With --skip-full, the full archive is assumed to have been
+restored already, e.g. from its SQL dump with psql. Then each incremental
+archive's changed rows are loaded and its deleted rows deleted, in one
+transaction per archive. Like collect.py, this works on the database in
+DATABASE_URL, with the Django settings of the environment.
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import django # Provides django.setup()
+from django.apps import apps as django_apps
+from django.db import transaction
+
+import manifest
+import restore
+
+
+RESTORED_FIXTURES = tuple('%s.json' % app for app in restore.RESTORED_APPS)
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_chain(filename):
+    """Returns the manifests of the archive's chain, starting with the full
+    archive."""
+    directory = os.path.dirname(filename)
+    details = manifest.read(filename)
+    if details is None:
+        raise SystemExit("Can't read the manifest '%s'" % filename)
+    chain = [details]
+    while details.get('base'):
+        name = os.path.join(directory, manifest.manifest_name(details['base']))
+        details = manifest.read(name)
+        if details is None:
+            raise SystemExit("Can't read the manifest '%s', which the chain needs" % name)
+        chain.append(details)
+    chain.reverse()
+    return chain
+
+
+def restore_full(directory, details, fixtures):
+    names = [name for name in fixtures if name in details['files']]
+    with transaction.atomic():
+        restore.load_fixtures(os.path.join(directory, details['archive']), details, names)
+    logger.info("Loaded %s from %s" % (', '.join(names), details['archive']))
+
+
+def replay_changes(directory, details):
+    from checkouts.models import deletions_untracked
+    filename = os.path.join(directory, details['archive'])
+    deletions = []
+    with transaction.atomic():
+        for name, reader in restore.read_members(filename, details, ['changes.json', 'deleted.json']):
+            if name == 'changes.json':
+                restore.load_streams([reader])
+            else:
+                deletions = json.loads(reader.read().decode('utf-8'))
+        by_model = {}
+        for deletion in deletions:
+            by_model.setdefault(deletion['model'], []).append(deletion['pk'])
+        # The deletions were recorded where they were made; recording them
+        # again would only make the next backup of this database carry them
+        with deletions_untracked():
+            for label, pks in by_model.items():
+                django_apps.get_model(label).objects.filter(pk__in=pks).delete()
+    logger.info("Replayed %s (%d deletions)" % (details['archive'], len(deletions)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restores the database from a chain of backup archives.")
+    parser.add_argument('manifest', nargs='?', default=manifest.LATEST,
+        help="manifest of the last archive to restore (default: %s)" % manifest.LATEST)
+    parser.add_argument('--skip-full', action='store_true',
+        help="only replay the incremental archives, as the full one has been restored already")
+    parser.add_argument('--fixture', action='append', dest='fixtures', metavar='NAME',
+        help="fixture to load from the full archive (repeatable; default: %s)" % ', '.join(RESTORED_FIXTURES))
+    options = parser.parse_args()
+
+    chain = load_chain(options.manifest)
+    directory = os.path.dirname(options.manifest)
+    logger.info("Chain: %s" % ' -> '.join(details['archive'] for details in chain))
+
+    django.setup()
+    if not options.skip_full:
+        restore_full(directory, chain[0], options.fixtures or RESTORED_FIXTURES)
+    for details in chain[1:]:
+        replay_changes(directory, details)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]: %(message)s")
+    main()
@@ -0,0 +1,121 @@
+"""Tests for chunks.py
+
+Run from this directory with `python -m unittest`.
+"""
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import chunks
+
+
+def make_dump(rows, seed=0):
+    """Returns something like pg_dump's output: a line per row."""
+    generator = random.Random(seed)
+    return b''.join(
+        b'%d\tpilot %d\t%s\t2019-08-01 11:50:00+00\n' % (i, generator.randrange(1000), b'x' * generator.randrange(60))
+        for i in range(rows))
+
+
+class SplitTests(unittest.TestCase):
+
+    def test_chunks_make_up_the_stream(self):
+        data = make_dump(50000)
+        pieces = list(chunks.split(io.BytesIO(data)))
+        self.assertEqual(b''.join(pieces), data)
+        self.assertGreater(len(pieces), 4)
+        for piece in pieces[:-1]:
+            self.assertGreaterEqual(len(piece), chunks.MIN_CHUNK)
+            self.assertLessEqual(len(piece), chunks.MAX_CHUNK)
+
+    def test_long_lines_are_split(self):
+        data = b'x' * (chunks.MAX_CHUNK * 2 + 10)
+        pieces = list(chunks.split(io.BytesIO(data)))
+        self.assertEqual([len(piece) for piece in pieces], [chunks.MAX_CHUNK, chunks.MAX_CHUNK, 10])
+
+    def test_boundaries_follow_the_content(self):
+        data = make_dump(50000)
+        lines = data.splitlines(keepends=True)
+        # A row inserted near the start shifts everything after it
+        changed = b''.join(lines[:100] + [b'inserted\trow\n'] + lines[100:])
+        before = set(chunks.split(io.BytesIO(data)))
+        after = list(chunks.split(io.BytesIO(changed)))
+        self.assertLessEqual(len([piece for piece in after if piece not in before]), 2)
+
+
+class ChunkStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = chunks.ChunkStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def snapshot(self, name, data):
+        entries, digest, new = self.store.add(io.BytesIO(data))
+        self.store.save_snapshot({
+            'version': chunks.manifest.VERSION,
+            'archive': name,
+            'files': {'dump.sql': dict(digest.to_dict(), chunks=entries)},
+        })
+        return entries, new
+
+    def test_stores_each_chunk_once(self):
+        data = make_dump(50000)
+        entries, new = self.snapshot('1.chunks', data)
+        self.assertEqual(len(new), len(entries))
+        entries, new = self.snapshot('2.chunks', data)
+        self.assertEqual(new, [])
+        changed = data.replace(b'\n', b'\nchanged\n', 1)
+        entries, new = self.snapshot('3.chunks', changed)
+        self.assertEqual(len(new), 1)
+        self.assertEqual(self.store.open(entries).read(), changed)
+
+    def test_reads_back_in_pieces(self):
+        data = make_dump(20000)
+        entries, new = self.snapshot('1.chunks', data)
+        reader = self.store.open(entries)
+        pieces = list(iter(lambda: reader.read(100000), b''))
+        self.assertEqual(b''.join(pieces), data)
+
+    def test_detects_damaged_chunk(self):
+        entries, new = self.snapshot('1.chunks', b'some rows\n')
+        with open(self.store.full_path(new[0]), 'wb') as f:
+            f.write(chunks.gzip.compress(b'other rows\n'))
+        with self.assertRaises(RuntimeError):
+            self.store.get(entries[0][0])
+
+    def test_gc(self):
+        data = make_dump(50000)
+        old, old_new = self.snapshot('1.chunks', data)
+        current, current_new = self.snapshot('2.chunks', data.replace(b'\n', b'\nchanged\n', 1))
+        deleted = self.store.gc(keep=1, grace_period=0)
+        self.assertEqual(self.store.snapshots(), ['2.chunks'])
+        # Only the chunk the new snapshot replaced goes
+        replaced = [path for path in old_new if os.path.basename(path).split('.')[0] not in
+                    {digest for digest, size in current}]
+        self.assertEqual(len(replaced), 1)
+        self.assertEqual(sorted(deleted), sorted([self.store.snapshot_path('1.chunks')] + replaced))
+        self.assertEqual(self.store.open(current).read(), data.replace(b'\n', b'\nchanged\n', 1))
+
+    def test_gc_spares_recent_chunks(self):
+        entries, new = self.snapshot('1.chunks', make_dump(1000))
+        deleted = self.store.gc(keep=0)
+        self.assertEqual(deleted, [self.store.snapshot_path('1.chunks')])
+        self.assertTrue(os.path.exists(self.store.full_path(new[0])))
+
+    def test_uploaded(self):
+        self.store.mark_uploaded(['chunks/ab/abc.gz', 'snapshots/1.chunks.json'])
+        self.store.unmark_uploaded(['chunks/ab/abc.gz'])
+        self.assertEqual(self.store.uploaded(), {'snapshots/1.chunks.json'})
+        self.assertEqual(chunks.remote_name('snapshots/1.chunks.json'), 'db/1.chunks.manifest.json')
+        self.assertEqual(chunks.remote_name('chunks/ab/abc.gz'), 'db/chunks/ab/abc.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
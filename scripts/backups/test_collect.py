@@ -0,0 +1,226 @@
+"""Tests for collect.py against the site's test database
+
+Run from this directory with `python -m unittest`, with the site's
+environment variables set (as bin/activate does). pg_dump is stood in for by
+a script.
+"""
+
+import io
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SITE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(SITE_ROOT, 'cotracker'))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'cotracker.settings.test'
+# Nothing raised while testing should be reported
+os.environ['SENTRY_DSN'] = ''
+
+import django
+django.setup()
+
+from django.apps import apps as django_apps
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from checkouts.models import Checkout, DailyUsage, SlowQuery
+import checkouts.tests.helper as helper
+
+import collect
+import manifest
+import restore
+
+
+DATABASE = 'checkniner'
+# Enough for several parts of a smaller SQL_PART_SIZE
+DUMP = b''.join(b'%d\tpilot %d\t2019-08-01 11:50:00+00\n' % (i, i % 7) for i in range(100))
+PART_SIZE = 1000
+
+
+def setUpModule():
+    global old_config
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+
+
+def tearDownModule():
+    teardown_databases(old_config, verbosity=0)
+    teardown_test_environment()
+
+
+class WorkingDirectoryMixin():
+    """Runs each test in an empty directory of its own, as collect.py works
+    in the current directory, with a pg_dump on the PATH which prints DUMP
+    (or fails, with dump_status set) and none of the backups' settings."""
+    dump_status = 0
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory)
+
+        bin_directory = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_directory)
+        with open(os.path.join(bin_directory, 'dump.sql'), 'wb') as f:
+            f.write(DUMP)
+        pg_dump = os.path.join(bin_directory, 'pg_dump')
+        with open(pg_dump, 'w') as f:
+            f.write('#!/bin/sh\n[ "$1" = %s ] || exit 2\n' % DATABASE)
+            if self.dump_status:
+                f.write('exit %d\n' % self.dump_status)
+            f.write('cat "%s"\n' % os.path.join(bin_directory, 'dump.sql'))
+        os.chmod(pg_dump, os.stat(pg_dump).st_mode | stat.S_IXUSR)
+
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        for name in list(os.environ):
+            if name.startswith('BACKUPS_'):
+                del os.environ[name]
+        os.environ['DATABASE_URL'] = 'postgres://localhost/%s' % DATABASE
+        os.environ['PATH'] = bin_directory + os.pathsep + os.environ['PATH']
+
+        part_size = mock.patch.object(collect, 'SQL_PART_SIZE', PART_SIZE)
+        part_size.start()
+        self.addCleanup(part_size.stop)
+
+    def export(self, *labels):
+        return [collect.export_fixture(django_apps.get_app_config(label), self.directory) for label in labels]
+
+    def full_details(self):
+        return {'kind': collect.FULL, 'started': '2019-08-01T11:49:58', 'anchor_started': '2019-08-01T11:49:58',
+                'watermark': {}}
+
+    def latest(self, watermark):
+        return dict(self.full_details(), version=manifest.VERSION, archive='x.tar.gz', watermark=watermark)
+
+
+def create_usage():
+    return DailyUsage.objects.create(date='2019-08-01', route=DailyUsage.ALL_ROUTES, requests=1, users=1, ips=1,
+                                     client_errors=0, server_errors=0, slowest=1, latency='{}')
+
+
+def create_checkouts():
+    pilot = helper.create_pilot()
+    base = helper.create_airstrip(ident='WXYZ', name='Base', is_base=True)
+    airstrip = helper.create_airstrip()
+    airstrip.bases.add(base)
+    aircraft_type = helper.create_aircrafttype()
+    for checked_out in (airstrip, base):
+        helper.create_checkout(pilot=pilot, airstrip=checked_out, aircraft_type=aircraft_type)
+
+
+class ExportFixtureTests(WorkingDirectoryMixin, TestCase):
+
+    def test_matches_dumpdata(self):
+        create_checkouts()
+        SlowQuery.objects.create(sql='SELECT 1', duration=5000)
+        create_usage()
+        for label in ('auth', 'checkouts'):
+            with self.subTest(label=label):
+                fixture, = self.export(label)
+                dumped = io.StringIO()
+                call_command('dumpdata', label, indent=4, exclude=list(collect.EXCLUDED_MODELS), stdout=dumped)
+                with open(fixture.path, encoding='utf-8') as f:
+                    self.assertEqual(f.read(), dumped.getvalue())
+                self.assertEqual(fixture.digest.to_dict(), manifest.file_digest(fixture.path).to_dict())
+        self.assertEqual(fixture.rows, {'checkouts.Airstrip': 2, 'checkouts.AircraftType': 1, 'checkouts.Checkout': 2,
+                                        'checkouts.DailyUsage': 1})
+
+    def test_empty(self):
+        self.assertEqual(self.export('sessions'), [None])
+
+
+class PackageTests(WorkingDirectoryMixin, TestCase):
+
+    def test_round_trip(self):
+        create_checkouts()
+        fixtures = self.export('auth', 'checkouts')
+        archive = collect.package(fixtures, self.full_details())
+
+        details = manifest.read(manifest.manifest_name(archive))
+        self.assertEqual(manifest.read(manifest.LATEST), details)
+        self.assertEqual(os.readlink(collect.LATEST), archive)
+        self.assertFalse(details['encrypted'])
+        self.assertEqual(details['compression'], 'gzip')
+        self.assertEqual(manifest.file_digest(archive).to_dict(), {'sha1': details['sha1'], 'size': details['size']})
+        sql = details['files']['%s.sql' % DATABASE]
+        self.assertEqual(sql['size'], len(DUMP))
+        self.assertEqual(sql['parts'], -(-len(DUMP) // PART_SIZE))
+
+        # The dump's parts come back whole
+        with restore.open_members(archive, details) as members:
+            parts = [f.read() for name, f in members if restore.is_sql_part(name, '%s.sql' % DATABASE)]
+        self.assertEqual(b''.join(parts), DUMP)
+
+        # The fixtures load back in, and the restored rows match the manifest
+        Checkout.objects.all().delete()
+        self.assertFalse(restore.verify_rows(details, restore.RESTORED_APPS))
+        rows = restore.load_fixtures(archive, details, ['auth.json', 'checkouts.json'])
+        self.assertEqual(rows['checkouts.Checkout'], 2)
+        self.assertTrue(restore.verify_rows(details, restore.RESTORED_APPS))
+
+    def test_mismatched_digest(self):
+        create_checkouts()
+        archive = collect.package(self.export('checkouts'), self.full_details())
+        details = manifest.read(manifest.manifest_name(archive))
+        details['files']['checkouts.json']['sha1'] = '0' * 40
+        with self.assertRaises(SystemExit):
+            list(restore.read_members(archive, details, ['checkouts.json']))
+
+    def test_incremental_has_no_dump(self):
+        create_checkouts()
+        archive = collect.package(self.export('checkouts'), {'kind': collect.INCREMENTAL})
+        self.assertIn('.changes.', archive)
+        self.assertEqual(list(manifest.read(manifest.manifest_name(archive))['files']), ['checkouts.json'])
+
+
+class FailedDumpTests(WorkingDirectoryMixin, TestCase):
+    dump_status = 3
+
+    def test_nothing_is_left(self):
+        create_checkouts()
+        fixtures = self.export('checkouts')
+        with self.assertRaises(RuntimeError):
+            collect.package(fixtures, self.full_details())
+        self.assertEqual(sorted(os.listdir(self.directory)), ['bin', 'checkouts.json'])
+
+
+class WatermarkTests(WorkingDirectoryMixin, TestCase):
+
+    def test_changes(self):
+        create_checkouts()
+        watermark = collect.get_watermark()
+        self.assertEqual(collect.get_watermark(), watermark)
+        # Diagnostics and rollups aren't business data
+        SlowQuery.objects.create(sql='SELECT 1', duration=5000)
+        create_usage()
+        self.assertEqual(collect.get_watermark(), watermark)
+        # Links between airstrips and bases don't touch 'modified'
+        Checkout.objects.get(airstrip__ident='ABCD').airstrip.bases.clear()
+        self.assertNotEqual(collect.get_watermark(), watermark)
+
+    @mock.patch.object(collect, 'package_changes')
+    @mock.patch.object(collect, 'package_snapshot')
+    def test_unchanged_is_skipped(self, package_snapshot, package_changes):
+        create_checkouts()
+        manifest.write(manifest.LATEST, self.latest(collect.get_watermark()))
+        collect.main()
+        package_snapshot.assert_not_called()
+        package_changes.assert_not_called()
+
+    @mock.patch.object(collect, 'package_snapshot', return_value=None)
+    def test_changed_is_compared(self, package_snapshot):
+        create_checkouts()
+        manifest.write(manifest.LATEST, self.latest({}))
+        collect.main()
+        self.assertEqual(package_snapshot.call_count, 1)
+        # Nothing differed from the latest archive, which now has the watermark
+        self.assertEqual(manifest.read(manifest.LATEST)['watermark'], collect.get_watermark())
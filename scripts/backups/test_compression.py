@@ -0,0 +1,95 @@
+"""Tests for compression.py
+
+Run from this directory with `python -m unittest`.
+"""
+
+import gzip
+import io
+import os
+import tarfile
+import unittest
+
+import compression
+
+
+class Unseekable(io.RawIOBase):
+    """A file which can only be read in order, like a pipe"""
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.data.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def sample(size):
+    lines = (b'%d\tpilot %d\tairstrip %d\n' % (i, i % 97, i % 13) for i in range(size // 20))
+    return b''.join(lines)[:size] + os.urandom(1000)
+
+
+class CodecTests(unittest.TestCase):
+
+    def compress(self, codec, data, **kwargs):
+        output = io.BytesIO()
+        writer = compression.open_writer(codec, output, **kwargs)
+        for offset in range(0, len(data), 10000):
+            writer.write(data[offset:offset + 10000])
+        writer.close()
+        return output.getvalue()
+
+    def check_codec(self, codec):
+        data = sample(compression.BLOCK_SIZE * 5 + 123)
+        compressed = self.compress(codec, data, jobs=3)
+        reader = compression.open_reader(codec, Unseekable(compressed))
+        self.assertEqual(reader.read(), data)
+        self.assertLess(len(compressed), len(data) / 2)
+        # The number of threads doesn't change the output
+        self.assertEqual(self.compress(codec, data, jobs=1), compressed)
+
+    def test_gzip(self):
+        self.check_codec(compression.get_codec('gzip'))
+
+    def test_gzip_is_gzip(self):
+        codec = compression.get_codec('gzip')
+        data = sample(compression.BLOCK_SIZE * 3)
+        self.assertEqual(gzip.decompress(self.compress(codec, data, level=9, jobs=2)), data)
+        self.assertEqual(gzip.decompress(self.compress(codec, b'')), b'')
+
+    def test_gzip_blocks_share_history(self):
+        codec = compression.get_codec('gzip')
+        # Every 16KB is the same, so only the first is costly, provided that
+        # each block can refer back to the one before
+        piece = os.urandom(16 * 1024)
+        compressed = self.compress(codec, piece * (compression.BLOCK_SIZE // len(piece) * 4), jobs=4)
+        self.assertLess(len(compressed), len(piece) * 1.5)
+
+    @unittest.skipIf(compression.zstandard is None, "zstandard isn't installed")
+    def test_zstd(self):
+        self.check_codec(compression.get_codec('zstd'))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            compression.get_codec('lzma')
+
+    def test_tar_round_trip(self):
+        codec = compression.get_codec('gzip')
+        output = io.BytesIO()
+        writer = compression.open_writer(codec, output, jobs=2)
+        data = sample(compression.BLOCK_SIZE * 2)
+        with tarfile.open(fileobj=writer, mode='w|') as archive:
+            info = tarfile.TarInfo('dump.sql')
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+        writer.close()
+        reader = compression.open_reader(codec, Unseekable(output.getvalue()))
+        with tarfile.open(fileobj=reader, mode='r|') as archive:
+            member = archive.next()
+            self.assertEqual(archive.extractfile(member).read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,368 @@
+"""Integration tests for transfer.py against a local stand-in for S3
+
+Run from this directory with `python -m unittest`.
+"""
+
+import datetime
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.parse
+import uuid
+
+import boto
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+
+import get_latest_archive
+import manifest
+import transfer
+
+
+class FakeS3Handler(http.server.BaseHTTPRequestHandler):
+    """Serves the S3 requests which boto makes for uploads and downloads,
+    for path-style URLs (/bucket/key), ignoring authentication."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        return bucket, urllib.parse.unquote(key), query
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        body = '<?xml version="1.0"?><Error><Code>%s</Code><Message>%s</Message></Error>' % (code, code)
+        # boto doesn't pool the connection of a failed request, so it's
+        # closed with the response rather than left open
+        self.close_connection = True
+        self.reply(status, body.encode('utf-8'), {'Content-Type': 'application/xml', 'Connection': 'close'})
+
+    def xml(self, body):
+        self.reply(200, ('<?xml version="1.0"?>' + body).encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        data = self.body()
+        s3 = self.server.s3
+        etag = hashlib.md5(data).hexdigest()
+        with s3.lock:
+            s3.requests.append(('PUT', key, query.get('partNumber')))
+            if 'partNumber' in query:
+                if s3.should_fail(('PUT', int(query['partNumber']))):
+                    return self.error(500, 'InternalError')
+                upload = s3.uploads.get(query['uploadId'])
+                if upload is None:
+                    return self.error(404, 'NoSuchUpload')
+                upload[int(query['partNumber'])] = data
+            else:
+                s3.objects[key] = (data, etag)
+        self.reply(200, headers={'ETag': '"%s"' % etag})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        data = self.body()
+        s3 = self.server.s3
+        with s3.lock:
+            s3.requests.append(('POST', key, None))
+            if 'uploads' in query:
+                upload_id = uuid.uuid4().hex
+                s3.uploads[upload_id] = {}
+                return self.xml(
+                    '<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>'
+                    '<UploadId>%s</UploadId></InitiateMultipartUploadResult>' % (bucket, key, upload_id))
+            upload = s3.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)</PartNumber>', data.decode('utf-8'))]
+            parts = [upload[n] for n in numbers]
+            etag = transfer.multipart_etag([hashlib.md5(part).hexdigest() for part in parts])
+            s3.objects[key] = (b''.join(parts), etag)
+        self.xml(
+            '<CompleteMultipartUploadResult><Location>/%s/%s</Location><Bucket>%s</Bucket>'
+            '<Key>%s</Key><ETag>"%s"</ETag></CompleteMultipartUploadResult>' % (bucket, key, bucket, key, etag))
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        s3 = self.server.s3
+        with s3.lock:
+            s3.requests.append(('GET', key, None))
+            if 'uploadId' in query:
+                upload = s3.uploads.get(query['uploadId'])
+                if upload is None:
+                    return self.error(404, 'NoSuchUpload')
+                parts = ''.join(
+                    '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag><Size>%d</Size></Part>'
+                    % (number, hashlib.md5(data).hexdigest(), len(data))
+                    for number, data in sorted(upload.items()))
+                return self.xml('<ListPartsResult><IsTruncated>false</IsTruncated>%s</ListPartsResult>' % parts)
+            if not key:
+                return self.list_bucket(bucket, query.get('prefix', ''))
+            if key not in s3.objects:
+                return self.error(404, 'NoSuchKey')
+            data, etag = s3.objects[key]
+        headers = {'ETag': '"%s"' % etag}
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            with s3.lock:
+                if s3.should_fail(('GET', start)):
+                    return self.error(500, 'InternalError')
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+            return self.reply(206, data[start:end + 1], headers)
+        self.reply(200, data, headers)
+
+    do_HEAD = do_GET
+
+    def list_bucket(self, bucket, prefix):
+        """Lists the keys starting with the prefix (ignoring delimiters)."""
+        contents = ''.join(
+            '<Contents><Key>%s</Key><Size>%d</Size><ETag>"%s"</ETag>'
+            '<LastModified>2019-08-01T00:00:00.000Z</LastModified></Contents>' % (key, len(data), etag)
+            for key, (data, etag) in sorted(self.server.s3.objects.items()) if key.startswith(prefix))
+        self.xml('<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><IsTruncated>false</IsTruncated>'
+                 '%s</ListBucketResult>' % (bucket, prefix, contents))
+
+
+class FakeS3():
+    """A stand-in for S3 on a local port, which can be told to fail uploads
+    and ranged downloads of particular parts."""
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.failures = {}
+        self.connections = []
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+        self.server.s3 = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # boto's close() only forgets the connections it pools, so their
+        # sockets are closed here
+        for connection in self.connections:
+            for pool in connection._pool.host_to_pool.values():
+                for http_connection, _ in pool.queue:
+                    http_connection.close()
+                pool.queue[:] = []
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, number, times):
+        """Fails the next uploads of the numbered part (times=None: always)."""
+        self.failures['PUT', number] = times
+
+    def fail_range(self, start, times):
+        """Fails the next ranged downloads from the offset (times=None: always)."""
+        self.failures['GET', start] = times
+
+    def should_fail(self, request):
+        times = self.failures.get(request, 0)
+        if times is None:
+            return True
+        if times:
+            self.failures[request] = times - 1
+        return bool(times)
+
+    def part_puts(self, number):
+        return len([r for r in self.requests if r[0] == 'PUT' and r[2] == str(number)])
+
+    def gets(self, key):
+        return len([r for r in self.requests if r[0] == 'GET' and r[1] == key])
+
+    def connect(self):
+        connection = S3Connection(
+            'access', 'secret', host='127.0.0.1', port=self.server.server_address[1],
+            is_secure=False, calling_format=OrdinaryCallingFormat())
+        # Leave retrying to the code under test
+        connection.num_retries = 0
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+
+class FakeS3TestCase(unittest.TestCase):
+
+    PART_SIZE = 64 * 1024
+
+    def setUp(self):
+        self.s3 = FakeS3()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'archive.tar.gz.gpg')
+        self.data = os.urandom(self.PART_SIZE * 5 + 1234)
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        if not boto.config.has_section('Boto'):
+            boto.config.add_section('Boto')
+        boto.config.set('Boto', 'num_retries', '0')
+
+    def tearDown(self):
+        self.s3.stop()
+        shutil.rmtree(self.directory)
+        boto.config.remove_option('Boto', 'num_retries')
+
+
+class UploaderTests(FakeS3TestCase):
+
+    def uploader(self, **kwargs):
+        options = dict(part_size=self.PART_SIZE, jobs=3, retry_delay=0)
+        options.update(kwargs)
+        return transfer.Uploader(self.s3.connect, 'bucket', **options)
+
+    def test_small_file(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'{}')
+        self.assertEqual(self.uploader().upload(self.filename, 'db/small'), 2)
+        self.assertEqual(self.s3.objects['db/small'][0], b'{}')
+
+    def test_multipart(self):
+        size = self.uploader().upload(self.filename, 'db/archive')
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(self.s3.objects['db/archive'][0], self.data)
+        self.assertEqual([self.s3.part_puts(n) for n in range(1, 7)], [1] * 6)
+        self.assertFalse(os.path.exists(transfer.state_name(self.filename)))
+
+    def test_retries_failed_part(self):
+        self.s3.fail(3, times=2)
+        self.uploader().upload(self.filename, 'db/archive')
+        self.assertEqual(self.s3.objects['db/archive'][0], self.data)
+        self.assertEqual(self.s3.part_puts(3), 3)
+        self.assertEqual(self.s3.part_puts(2), 1)
+
+    def test_resumes_interrupted_upload(self):
+        self.s3.fail(4, times=None)
+        with self.assertRaises(boto.exception.BotoServerError):
+            self.uploader(attempts=2).upload(self.filename, 'db/archive')
+        self.assertNotIn('db/archive', self.s3.objects)
+        self.assertEqual(transfer.pending_uploads(self.directory), [self.filename])
+        with open(transfer.state_name(self.filename)) as f:
+            self.assertEqual(sorted(json.load(f)['parts']), ['1', '2', '3', '5', '6'])
+
+        self.s3.fail(4, times=0)
+        self.uploader().upload(self.filename, 'db/archive')
+        self.assertEqual(self.s3.objects['db/archive'][0], self.data)
+        # Only the missing part was sent again
+        self.assertEqual([self.s3.part_puts(n) for n in range(1, 7)], [1, 1, 1, 3, 1, 1])
+        self.assertEqual(transfer.pending_uploads(self.directory), [])
+
+    def test_restarts_vanished_upload(self):
+        self.s3.fail(4, times=None)
+        with self.assertRaises(boto.exception.BotoServerError):
+            self.uploader(attempts=1).upload(self.filename, 'db/archive')
+        # e.g. aborted by a lifecycle rule
+        self.s3.uploads.clear()
+        self.s3.fail(4, times=0)
+        self.uploader().upload(self.filename, 'db/archive')
+        self.assertEqual(self.s3.objects['db/archive'][0], self.data)
+        self.assertEqual(self.s3.part_puts(1), 2)
+
+    def test_ignores_state_for_other_part_size(self):
+        self.s3.fail(4, times=None)
+        with self.assertRaises(boto.exception.BotoServerError):
+            self.uploader(attempts=1).upload(self.filename, 'db/archive')
+        self.s3.fail(4, times=0)
+        self.uploader(part_size=self.PART_SIZE * 2).upload(self.filename, 'db/archive')
+        self.assertEqual(self.s3.objects['db/archive'][0], self.data)
+
+
+class DownloaderTests(FakeS3TestCase):
+
+    def setUp(self):
+        super(DownloaderTests, self).setUp()
+        self.s3.objects['db/archive'] = (self.data, 'etag')
+        self.sha1 = manifest.digest_of(self.data).hexdigest()
+        self.target = os.path.join(self.directory, 'latest.tar.gz.gpg')
+
+    def downloader(self, **kwargs):
+        options = dict(part_size=self.PART_SIZE, jobs=3, retry_delay=0)
+        options.update(kwargs)
+        return transfer.Downloader(self.s3.connect, 'bucket', **options)
+
+    def read_target(self):
+        with open(self.target, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        self.downloader().download('db/archive', self.target, len(self.data), self.sha1)
+        self.assertEqual(self.read_target(), self.data)
+        self.assertEqual(self.s3.gets('db/archive'), 6)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['archive.tar.gz.gpg', 'latest.tar.gz.gpg'])
+
+    def test_retries_failed_range(self):
+        self.s3.fail_range(self.PART_SIZE * 2, times=1)
+        self.downloader().download('db/archive', self.target, len(self.data), self.sha1)
+        self.assertEqual(self.read_target(), self.data)
+        self.assertEqual(self.s3.gets('db/archive'), 7)
+
+    def test_resumes_interrupted_download(self):
+        self.s3.fail_range(self.PART_SIZE * 2, times=None)
+        with self.assertRaises(boto.exception.BotoServerError):
+            self.downloader(attempts=1).download('db/archive', self.target, len(self.data), self.sha1)
+        self.assertFalse(os.path.exists(self.target))
+        self.s3.fail_range(self.PART_SIZE * 2, times=0)
+        self.downloader().download('db/archive', self.target, len(self.data), self.sha1)
+        self.assertEqual(self.read_target(), self.data)
+        # Six parts, one of them twice
+        self.assertEqual(self.s3.gets('db/archive'), 7)
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(RuntimeError):
+            self.downloader().download('db/archive', self.target, len(self.data), 'f' * 40)
+        self.assertEqual(os.listdir(self.directory), ['archive.tar.gz.gpg'])
+
+
+class FindLatestTests(FakeS3TestCase):
+
+    def setUp(self):
+        super(FindLatestTests, self).setUp()
+        self.bucket = self.s3.connect().get_bucket('bucket', validate=False)
+        self.details = {'archive': '%s.tar.gz.gpg' % datetime.datetime.utcnow().strftime(get_latest_archive.DATE_FORMAT),
+                        'created': datetime.datetime.utcnow().strftime(get_latest_archive.DATE_FORMAT),
+                        'sha1': 'abc', 'size': 3, 'kind': 'full'}
+        self.s3.objects['db/' + self.details['archive']] = (b'abc', 'etag')
+
+    def store(self, key, value):
+        data = json.dumps(value).encode('utf-8')
+        self.s3.objects[key] = (data, 'etag')
+
+    def test_latest_index(self):
+        self.store('db/LATEST', self.details)
+        self.assertEqual(get_latest_archive.find_latest(self.bucket, 'db'), self.details)
+        # A single request
+        self.assertEqual(len(self.s3.requests), 1)
+
+    def test_month_index(self):
+        entry = manifest.index_entry(self.details)
+        self.store('db/' + manifest.month_index_name(self.details['created']), {'version': 1, 'archives': [entry]})
+        self.assertEqual(get_latest_archive.find_latest(self.bucket, 'db'), entry)
+
+    def test_listing(self):
+        self.store('db/%s.manifest.json' % self.details['archive'], self.details)
+        latest = get_latest_archive.find_latest(self.bucket, 'db')
+        self.assertEqual(latest, {'archive': self.details['archive'], 'size': 3, 'sha1': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+"""Parallel, resumable transfers of backup archives to and from S3
+
+Files larger than a part are sent as S3 multipart uploads: the file is split
+into parts of PART_SIZE bytes which are uploaded several at a time, each
+thread with its own connection (boto's connections aren't thread-safe), so a
+transfer is limited by bandwidth rather than by round trips. A part which
+fails is retried on its own, with a growing delay, rather than restarting the
+whole file.
+
+While a multipart upload is in progress, its id and the ETags of the parts
+sent so far are kept in '<file>.upload.json'. If the run dies, the next
+upload of the same file picks the upload up again: the parts S3 still holds
+with matching ETags are kept and only the rest are sent. Once S3 has put the
+parts together, the object's ETag is checked against the parts' before the
+state file is removed.
+
+Downloads work the same way in reverse: parts are fetched several at a time
+with ranged GETs into '<file>.partial', and the parts fetched so far are kept
+in '<file>.download.json'. The file is only moved into place once its size
+and SHA1 match the ones it's expected to have (from the backup's manifest).
+"""
+
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from boto.exception import BotoClientError, BotoServerError
+from boto.s3.multipart import MultiPartUpload
+
+import manifest
+
+
+# S3 requires parts (other than the last) to be at least 5MB
+PART_SIZE = 8 * 1024 * 1024
+JOBS = 4
+ATTEMPTS = 5
+# Seconds to wait before retrying, doubled after each further failure
+RETRY_DELAY = 1
+
+
+logger = logging.getLogger(__name__)
+
+
+def state_name(filename, action='upload'):
+    return '%s.%s.json' % (filename, action)
+
+
+def pending_uploads(directory='.'):
+    """Returns the files in the directory whose uploads were interrupted."""
+    suffix = state_name('')
+    names = [name[:-len(suffix)] for name in os.listdir(directory) if name.endswith(suffix)]
+    return sorted(os.path.join(directory, name) for name in names
+                  if os.path.exists(os.path.join(directory, name)))
+
+
+def multipart_etag(etags):
+    """Returns the ETag S3 gives an object put together from parts with the
+    given ETags: the MD5 of their MD5s, and the number of parts."""
+    md5 = hashlib.md5(b''.join(bytes.fromhex(etag) for etag in etags))
+    return '%s-%d' % (md5.hexdigest(), len(etags))
+
+
+class Transfer():
+    """Moves files between the disk and the bucket, a part at a time on a pool
+    of threads. connect is called (with no arguments) for a new S3Connection
+    whenever a thread needs one."""
+    action = None
+
+    def __init__(self, connect, bucket_name, part_size=PART_SIZE, jobs=JOBS,
+                 attempts=ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.connect = connect
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+        self.jobs = jobs
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.local = threading.local()
+
+    def bucket(self):
+        """Returns the bucket, through this thread's connection."""
+        if getattr(self.local, 'bucket', None) is None:
+            self.local.bucket = self.connect().get_bucket(self.bucket_name, validate=False)
+        return self.local.bucket
+
+    def attempt(self, description, function, *args):
+        """Calls the function, retrying it after failures."""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return function(*args)
+            except (BotoClientError, BotoServerError, OSError, http.client.HTTPException) as e:
+                if attempt == self.attempts:
+                    logger.error("%s failed after %d attempts: %s" % (description, attempt, e))
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning("%s failed (%s), retrying in %ds" % (description, e, delay))
+                # The connection may be what's broken
+                self.local.bucket = None
+                time.sleep(delay)
+
+    def part_count(self, size):
+        return math.ceil(size / self.part_size)
+
+    def for_each_part(self, numbers, function):
+        """Calls the function with each part number on the pool of threads.
+        Every part is attempted even if one fails, so that as many as possible
+        are kept for the next run, and then the first failure is raised."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(function, number) for number in numbers]
+        for future in futures:
+            future.result()
+
+    def read_state(self, filename):
+        try:
+            with open(state_name(filename, self.action), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_state(self, filename, state):
+        name = state_name(filename, self.action)
+        with open(name + '.tmp', 'w') as f:
+            json.dump(state, f, indent=4, sort_keys=True)
+        os.replace(name + '.tmp', name)
+
+    def remove_state(self, filename):
+        os.remove(state_name(filename, self.action))
+
+
+class Uploader(Transfer):
+    """Uploads files to the bucket"""
+    action = 'upload'
+
+    def upload(self, filename, key_name):
+        """Uploads the file to the key. Returns its size."""
+        size = os.path.getsize(filename)
+        if size <= self.part_size:
+            self.attempt("Uploading '%s'" % key_name, self.put, filename, key_name)
+        else:
+            self.upload_parts(filename, key_name, size)
+        return size
+
+    def put(self, filename, key_name):
+        key = self.bucket().new_key(key_name)
+        key.set_contents_from_filename(filename)
+
+    def multipart(self, state):
+        upload = MultiPartUpload(self.bucket())
+        upload.key_name = state['key']
+        upload.id = state['upload_id']
+        return upload
+
+    def load_state(self, filename, key_name, size):
+        """Returns the state of an interrupted upload of the file to the key,
+        keeping only the parts S3 still has, or None if there isn't one."""
+        state = self.read_state(filename)
+        if state is None:
+            return None
+        if [state['key'], state['size'], state['part_size']] != [key_name, size, self.part_size]:
+            logger.warning("Ignoring the interrupted upload of '%s', which doesn't match" % filename)
+            return None
+        listed = self.list_parts(state)
+        if listed is None:
+            logger.warning("The interrupted upload of '%s' has gone, starting again" % filename)
+            return None
+        state['parts'] = {number: etag for number, etag in state['parts'].items()
+                          if listed.get(int(number)) == etag}
+        logger.info("Resuming the upload of '%s' with %d parts done" % (filename, len(state['parts'])))
+        return state
+
+    def list_parts(self, state):
+        """Returns the ETags of the parts S3 has, by number, or None if it
+        can't list them (e.g. the upload has expired)."""
+        upload = self.multipart(state)
+        parts = {}
+        marker = None
+        while True:
+            # boto returns None rather than raising for an error response
+            page = upload.get_all_parts(part_number_marker=marker)
+            if page is None:
+                return None
+            parts.update((part.part_number, part.etag.strip('"')) for part in page)
+            if not upload.is_truncated:
+                return parts
+            marker = upload.next_part_number_marker
+
+    def upload_parts(self, filename, key_name, size):
+        state = self.load_state(filename, key_name, size)
+        if state is None:
+            upload = self.attempt("Starting upload of '%s'" % key_name,
+                                  lambda: self.bucket().initiate_multipart_upload(key_name))
+            state = {'key': key_name, 'upload_id': upload.id, 'size': size,
+                     'part_size': self.part_size, 'parts': {}}
+            self.save_state(filename, state)
+
+        count = self.part_count(size)
+        remaining = [number for number in range(1, count + 1) if str(number) not in state['parts']]
+        lock = threading.Lock()
+
+        def upload_part(number):
+            etag = self.attempt("Uploading part %d of '%s'" % (number, key_name),
+                                self.put_part, filename, state, number)
+            with lock:
+                state['parts'][str(number)] = etag
+                self.save_state(filename, state)
+
+        self.for_each_part(remaining, upload_part)
+        self.attempt("Completing upload of '%s'" % key_name, self.complete, state)
+        self.remove_state(filename)
+
+    def put_part(self, filename, state, number):
+        """Uploads one part of the file. Returns its ETag."""
+        offset = (number - 1) * state['part_size']
+        size = min(state['part_size'], state['size'] - offset)
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            key = self.multipart(state).upload_part_from_file(f, number, size=size)
+        return key.etag.strip('"')
+
+    def complete(self, state):
+        parts = sorted((int(number), etag) for number, etag in state['parts'].items())
+        xml = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag></Part>' % part for part in parts)
+        result = self.bucket().complete_multipart_upload(state['key'], state['upload_id'], xml)
+        expected = multipart_etag([etag for _, etag in parts])
+        if result.etag.strip('"') != expected:
+            raise RuntimeError("'%s' has ETag %s rather than %s" % (state['key'], result.etag, expected))
+
+
+class Downloader(Transfer):
+    """Downloads keys from the bucket"""
+    action = 'download'
+
+    def download(self, key_name, filename, size, sha1=None):
+        """Downloads the key to the file, checking that it has the given size
+        and (if given) SHA1. Returns the size."""
+        partial = filename + '.partial'
+        state = self.read_state(filename)
+        expected = {'key': key_name, 'size': size, 'sha1': sha1, 'part_size': self.part_size}
+        if state is None or {k: state[k] for k in expected} != expected or not os.path.exists(partial):
+            state = dict(expected, parts=[])
+            with open(partial, 'wb') as f:
+                f.truncate(size)
+            self.save_state(filename, state)
+        else:
+            logger.info("Resuming the download of '%s' with %d parts done" % (filename, len(state['parts'])))
+
+        remaining = [number for number in range(1, self.part_count(size) + 1) if number not in state['parts']]
+        lock = threading.Lock()
+
+        def download_part(number):
+            self.attempt("Downloading part %d of '%s'" % (number, key_name),
+                         self.get_part, partial, state, number)
+            with lock:
+                state['parts'].append(number)
+                self.save_state(filename, state)
+
+        self.for_each_part(remaining, download_part)
+        digest = manifest.file_digest(partial)
+        if digest.size != size or (sha1 is not None and digest.hexdigest() != sha1):
+            # Start again from scratch next time
+            os.remove(partial)
+            self.remove_state(filename)
+            raise RuntimeError("'%s' doesn't match its manifest (sha1 %s, %d bytes)" % (
+                key_name, digest.hexdigest(), digest.size))
+        os.replace(partial, filename)
+        self.remove_state(filename)
+        return size
+
+    def fetch(self, key_name, filename):
+        """Downloads a small key (e.g. a chunk) whole, without checking it."""
+        self.attempt("Downloading '%s'" % key_name, self.get, key_name, filename)
+
+    def get(self, key_name, filename):
+        self.bucket().new_key(key_name).get_contents_to_filename(filename + '.partial')
+        os.replace(filename + '.partial', filename)
+
+    def get_part(self, partial, state, number):
+        offset = (number - 1) * state['part_size']
+        end = min(offset + state['part_size'], state['size'])
+        key = self.bucket().new_key(state['key'])
+        with open(partial, 'r+b') as f:
+            f.seek(offset)
+            key.get_contents_to_file(f, headers={'Range': 'bytes=%d-%d' % (offset, end - 1)})
+            if f.tell() != end:
+                raise OSError("Got %d bytes of part %d rather than %d" % (f.tell() - offset, number, end - offset))
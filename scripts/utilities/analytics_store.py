@@ -0,0 +1,381 @@
+"""
+Compact columnar store of analytics.log requests for fast ad-hoc questions.
+
+Ingesting parses the logs once and appends each request to a directory of
+column files. Numeric columns are raw arrays of fixed-width values (in the
+machine's byte order, as written by the array module), and string columns are
+dictionary-encoded: an array of integer codes plus a JSON list of the distinct
+values. Queries memory-map the column files, so only the pages actually
+touched are read. NumPy is used to filter and aggregate when it's installed;
+otherwise the same queries run (more slowly) in plain Python.
+
+    python analytics_store.py ingest STORE FILE [FILE ...]
+    python analytics_store.py query STORE [filters] [--group-by COLUMN]
+
+For example, the p95 real time for /checkouts/ over the last week:
+
+    python analytics_store.py query store/ --path /checkouts/ --since 7d -p 95
+
+String filters ending in '*' match by prefix (e.g. --path '/pilots/*'). Time
+ranges are found by binary search, so logs should be ingested oldest first.
+Requests logged by several workers can be a little out of order, so the store
+records the furthest any request lags behind the latest before it, and the
+search is widened by that much. The parser lives in checkouts.analytics, so the
+cotracker directory must be on the PYTHONPATH.
+"""
+
+import argparse
+import array
+import bisect
+import collections
+import datetime
+import json
+import math
+import mmap
+import os
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from checkouts.analytics import EpochParser, open_log, parse_line
+
+
+FORMAT_VERSION = 1
+
+# Column name -> array typecode
+NUMERIC_COLUMNS = collections.OrderedDict([
+    ('timestamp', 'd'),
+    ('queue',     'i'),
+    ('real',      'i'),
+    ('status',    'i'),
+    ('bytes',     'i'),
+])
+# Dictionary-encoded columns; each is stored as an array of 'i' codes
+STRING_COLUMNS = ('method', 'user', 'ip', 'path', 'useragent')
+# Record field which supplies each string column, when named differently
+SOURCE_FIELDS = {'user': 'username'}
+
+# Rows are buffered and written in chunks to keep memory use flat
+CHUNK_ROWS = 65536
+
+MISSING = -1
+
+
+class Store():
+    """A directory of column files holding analytics requests"""
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+            if self.meta['version'] != FORMAT_VERSION or self.meta['byteorder'] != sys.byteorder:
+                raise ValueError("Store at '%s' was written in an incompatible format" % path)
+        else:
+            self.meta = {'version': FORMAT_VERSION, 'byteorder': sys.byteorder, 'rows': 0}
+        self.dictionaries = {}
+        for name in STRING_COLUMNS:
+            filename = self.filename(name, 'json')
+            if os.path.exists(filename):
+                with open(filename, 'r') as f:
+                    self.dictionaries[name] = json.load(f)
+            else:
+                self.dictionaries[name] = []
+        self.maps = []
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    def filename(self, name, extension):
+        return os.path.join(self.path, '%s.%s' % (name, extension))
+
+    def typecode(self, name):
+        return NUMERIC_COLUMNS.get(name, 'i')
+
+    def column_filename(self, name):
+        return self.filename(name, self.typecode(name))
+
+    # -- Writing ---------------------------------------------------------------
+
+    def append(self, records):
+        """Appends the records to the store. Returns the number appended."""
+        os.makedirs(self.path, exist_ok=True)
+        names = list(NUMERIC_COLUMNS) + list(STRING_COLUMNS)
+        # Discard anything beyond the last committed row (e.g. left behind
+        # by an interrupted ingest) before appending
+        files = {}
+        for name in names:
+            filename = self.column_filename(name)
+            f = open(filename, 'ab')
+            f.truncate(self.rows * array.array(self.typecode(name)).itemsize)
+            files[name] = f
+        codes = {name: {v: i for i, v in enumerate(self.dictionaries[name])} for name in STRING_COLUMNS}
+        buffers = {name: array.array(self.typecode(name)) for name in names}
+        to_epoch = EpochParser()
+        latest = self.meta.get('latest')
+        skew = self.meta.get('skew', 0)
+        appended = 0
+        try:
+            for record in records:
+                timestamp = to_epoch(record['timestamp'])
+                buffers['timestamp'].append(timestamp)
+                if latest is None or timestamp > latest:
+                    latest = timestamp
+                elif latest - timestamp > skew:
+                    skew = latest - timestamp
+                for name in ('queue', 'real', 'bytes'):
+                    buffers[name].append(record.get(name, MISSING))
+                try:
+                    buffers['status'].append(int(record.get('status', MISSING)))
+                except ValueError:
+                    buffers['status'].append(MISSING)
+                for name in STRING_COLUMNS:
+                    value = record.get(SOURCE_FIELDS.get(name, name), '')
+                    code = codes[name].get(value)
+                    if code is None:
+                        code = codes[name][value] = len(self.dictionaries[name])
+                        self.dictionaries[name].append(value)
+                    buffers[name].append(code)
+                appended += 1
+                if appended % CHUNK_ROWS == 0:
+                    self.flush(buffers, files)
+            self.flush(buffers, files)
+        finally:
+            for f in files.values():
+                f.close()
+        self.meta.update(latest=latest, skew=skew)
+        self.commit(self.rows + appended)
+        return appended
+
+    def flush(self, buffers, files):
+        for name, buffer in buffers.items():
+            buffer.tofile(files[name])
+            del buffer[:]
+
+    def commit(self, rows):
+        """Records the new row count (and dictionaries) once the column data
+        is safely written."""
+        for name in STRING_COLUMNS:
+            self.write_json(self.filename(name, 'json'), self.dictionaries[name])
+        self.meta['rows'] = rows
+        self.write_json(self.meta_path, self.meta)
+
+    def write_json(self, filename, data):
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(filename + '.tmp', filename)
+
+    # -- Reading ---------------------------------------------------------------
+
+    def column(self, name):
+        """Returns the column's values (or codes) as a memory-mapped sequence:
+        a NumPy array if NumPy is available, otherwise a memoryview."""
+        typecode = self.typecode(name)
+        if self.rows == 0:
+            return numpy.array([], dtype=typecode) if numpy else memoryview(array.array(typecode))
+        size = self.rows * array.array(typecode).itemsize
+        with open(self.column_filename(name), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        if numpy is not None:
+            return numpy.frombuffer(mapped, dtype=typecode, count=self.rows)
+        return memoryview(mapped).cast(typecode)
+
+    def codes_matching(self, name, value):
+        """Returns the codes of the dictionary values which match the filter
+        value (a prefix match if it ends with '*')."""
+        values = self.dictionaries[name]
+        if value.endswith('*'):
+            prefix = value[:-1]
+            return set(i for i, v in enumerate(values) if v.startswith(prefix))
+        return set(i for i, v in enumerate(values) if v == value)
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted sequence"""
+    if not len(ordered):
+        return float('nan')
+    rank = max(int(math.ceil(p / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def group_label(store, group_by, key):
+    if group_by in STRING_COLUMNS:
+        return store.dictionaries[group_by][key]
+    if group_by == 'day':
+        return datetime.datetime.utcfromtimestamp(key * 86400).strftime('%Y-%m-%d')
+    if group_by == 'hour':
+        return datetime.datetime.utcfromtimestamp(key * 3600).strftime('%Y-%m-%dT%H:00')
+    return key
+
+
+def query(store, since=None, until=None, filters=None, group_by=None, column='real', percentiles=(50, 95, 99)):
+    """Returns a list of (group, count, [percentile values]) rows for the
+    requests which match the time range and filters.
+
+    Requests with no value in the measured column (logged before it was
+    recorded, or not recorded at all) are left out, so that the MISSING
+    sentinel doesn't drag the percentiles down.
+
+    filters maps column names to lists of acceptable values. The timestamp
+    column is mostly in time order (it's appended in log order), so the time
+    range is found by binary search. No request is more than the store's skew
+    behind one before it, so searching for the range widened by the skew finds
+    every request in it, and those outside it are then filtered out.
+    """
+    filters = filters or {}
+    timestamps = store.column('timestamp')
+    skew = store.meta.get('skew', 0)
+    lo = bisect.bisect_left(timestamps, since - skew) if since is not None else 0
+    hi = bisect.bisect_left(timestamps, until + skew) if until is not None else store.rows
+
+    accepted = {}
+    for name, values in filters.items():
+        if name in STRING_COLUMNS:
+            codes = set()
+            for value in values:
+                codes |= store.codes_matching(name, value)
+        else:
+            codes = set(int(v) for v in values)
+        accepted[name] = codes
+
+    if group_by in ('day', 'hour'):
+        width = 86400 if group_by == 'day' else 3600
+        keys_source = timestamps
+    elif group_by is not None:
+        keys_source = store.column(group_by)
+
+    measured = store.column(column)
+    if numpy is not None:
+        mask = measured[lo:hi] != MISSING
+        if since is not None:
+            mask &= timestamps[lo:hi] >= since
+        if until is not None:
+            mask &= timestamps[lo:hi] < until
+        for name, codes in accepted.items():
+            mask &= numpy.isin(store.column(name)[lo:hi], list(codes))
+        values = measured[lo:hi][mask]
+        if group_by is None:
+            groups = {None: values}
+        else:
+            keys = keys_source[lo:hi][mask]
+            if group_by in ('day', 'hour'):
+                keys = (keys // width).astype('int64')
+            unique, inverse, counts = numpy.unique(keys, return_inverse=True, return_counts=True)
+            split = numpy.split(values[numpy.argsort(inverse, kind='stable')], numpy.cumsum(counts)[:-1])
+            groups = dict(zip(unique.tolist(), split))
+        results = []
+        for key, group in groups.items():
+            ordered = numpy.sort(group)
+            results.append((group_label(store, group_by, key), len(ordered), [percentile(ordered, p) for p in percentiles]))
+    else:
+        columns = [(store.column(name), codes) for name, codes in accepted.items()]
+        groups = collections.defaultdict(list)
+        for i in range(lo, hi):
+            if measured[i] == MISSING or (since is not None and timestamps[i] < since):
+                continue
+            if until is not None and timestamps[i] >= until:
+                continue
+            if all(col[i] in codes for col, codes in columns):
+                if group_by is None:
+                    key = None
+                elif group_by in ('day', 'hour'):
+                    key = int(keys_source[i] // width)
+                else:
+                    key = keys_source[i]
+                groups[key].append(measured[i])
+        if group_by is None and not groups:
+            groups[None] = []
+        results = []
+        for key, group in groups.items():
+            group.sort()
+            results.append((group_label(store, group_by, key), len(group), [percentile(group, p) for p in percentiles]))
+
+    results.sort(key=lambda row: str(row[0]))
+    return results
+
+
+def parse_moment(value):
+    """Accepts '7d' / '12h' (relative to now) or an ISO date/time (UTC)."""
+    if value[-1] in 'dh' and value[:-1].isdigit():
+        seconds = int(value[:-1]) * (86400 if value[-1] == 'd' else 3600)
+        return time.time() - seconds
+    moment = datetime.datetime.strptime(value, '%Y-%m-%d' if len(value) == 10 else '%Y-%m-%dT%H:%M:%S')
+    return moment.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def ingest(options):
+    store = Store(options.store)
+
+    def records():
+        for name in options.files:
+            with open_log(name) as f:
+                for line in f:
+                    record = parse_line(line)
+                    if record is not None:
+                        yield record
+    start = time.time()
+    appended = store.append(records())
+    print("Appended %d requests in %.1fs; the store now holds %d" % (appended, time.time() - start, store.rows))
+
+
+def run_query(options):
+    store = Store(options.store)
+    filters = {}
+    for name in ('method', 'user', 'ip', 'path', 'useragent', 'status'):
+        values = getattr(options, name)
+        if values:
+            filters[name] = values
+    since = parse_moment(options.since) if options.since else None
+    until = parse_moment(options.until) if options.until else None
+    percentiles = options.percentiles or [50, 95, 99]
+
+    start = time.time()
+    results = query(store, since, until, filters, options.group_by, options.column, percentiles)
+    elapsed = (time.time() - start) * 1000.0
+
+    header = ['count'] + ['p%g' % p for p in percentiles]
+    if options.group_by:
+        header.insert(0, options.group_by)
+    print('\t'.join(header))
+    for label, count, values in results:
+        row = [str(count)] + ['%g' % v for v in values]
+        if options.group_by:
+            row.insert(0, str(label))
+        print('\t'.join(row))
+    print("(%s of %d requests in %.0fms)" % (options.column, store.rows, elapsed), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar store of analytics logs.")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    ingester = commands.add_parser('ingest', help="append logs to a store")
+    ingester.add_argument('store', help="store directory (created if needed)")
+    ingester.add_argument('files', nargs='+', metavar='FILE', help="analytics.log files (optionally gzipped)")
+    ingester.set_defaults(run=ingest)
+
+    querier = commands.add_parser('query', help="summarize the requests in a store")
+    querier.add_argument('store', help="store directory")
+    querier.add_argument('--since', help="e.g. 7d, 12h or 2019-08-01")
+    querier.add_argument('--until', help="e.g. 1d or 2019-08-08T12:00:00")
+    for name in ('method', 'user', 'ip', 'path', 'useragent', 'status'):
+        querier.add_argument('--%s' % name, action='append', help="only requests with this %s (repeatable)" % name)
+    querier.add_argument('--group-by', choices=list(STRING_COLUMNS) + ['status', 'day', 'hour'])
+    querier.add_argument('--column', default='real', choices=['queue', 'real', 'bytes'], help="value to summarize (default: real)")
+    querier.add_argument('-p', '--percentile', type=float, action='append', dest='percentiles',
+        help="percentile to report (repeatable; default: 50, 95, 99)")
+    querier.set_defaults(run=run_query)
+
+    options = parser.parse_args()
+    options.run(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,14 @@
 """
 Turns one or more analytics.log files into a single nicely formatted CSV file.
 
+Logs are read line by line and rows are written as they're parsed, so memory
+use doesn't grow with the size of the logs. Rotated logs may be gzipped. With
+--jobs, the files are parsed in parallel and the rows from all of them are
+merged into timestamp order. The parser lives in checkouts.analytics, so the
+cotracker directory must be on the PYTHONPATH.
+
+    python analytics_to_csv.py [-o cleaned.csv] [-j JOBS] FILE1 [FILE2 [...]]
+
 To enable SQL-based analysis of the resulting data, create a table in postgres
 such as this:
 
@@ -15,6 +23,11 @@ such as this:
       path varchar,
       queue int,
       real int,
+      mw int,
+      view int,
+      tpl int,
+      db int,
+      queries int,
       status char(3),
       bytes int,
       useragent varchar
@@ -25,57 +38,95 @@ Then load the CSV directly into the table:
     COPY co from '/tmp/cleaned.csv' DELIMITER ',' CSV HEADER;
 """
 
+import argparse
+import concurrent.futures
 import csv
-import datetime
+import heapq
+import os
 import sys
+import tempfile
 
-def parse(line):
-    meta, rest = line.strip().split(']: ')
-    ts, pid = meta.split(' [')
-    dt = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S+0000')
-    #print('date = %r' % dt)
-    #print('pid = %r' % pid)
-    pieces = rest.split(' ')
-    segments = [['date', dt.date().strftime('%Y-%m-%d')], ['time', dt.time().strftime('%H:%M:%S')], ['pid', pid]]
-    for piece in pieces:
-        if '=' in piece:
-            name, value = piece.split('=')
-            if name == 'at':
-                segments.append(['level', value])
-            elif name == 'client':
-                username, ip = value.split('@')
-                segments.append(['username', username])
-                segments.append(['ip', ip])
-            elif name in ['queue', 'real']:
-                segments.append([name, int(value.strip('ms'))])
-            elif name == 'bytes':
-                segments.append([name, int(value)])
-            elif name == 'useragent':
-                segments.append([name, value.strip('"').strip(',')])
-            else:
-                segments.append([name, value])
-        else:
-            segments[-1][1] += ' ' + piece.strip('"').strip(',')
-    #print('segments = %r' % segments)
-    return {k:v for k,v in segments}
-
-if len(sys.argv) == 1:
-    print("Usage: python %s FILE1 [FILE2 [...]]" % sys.argv[0])
-    sys.exit(1)
+from checkouts.analytics import FIELDS, EpochParser, open_log, parse_line
 
-files = sys.argv[1:]
-records = []
 
-for name in files:
-    with open(name, 'r') as f:
+def read_records(filename):
+    """Yields the parsed records from the log, skipping malformed lines."""
+    skipped = 0
+    with open_log(filename) as f:
         for line in f:
-            records.append(parse(line))
+            record = parse_line(line)
+            if record is None:
+                skipped += 1
+                continue
+            yield record
+    if skipped:
+        print("Skipped %d malformed lines in %s" % (skipped, filename), file=sys.stderr)
 
-headers = ['date', 'time', 'pid', 'level', 'username', 'ip', 'method', 'path', 'queue', 'real', 'status', 'bytes', 'useragent']
-with open('cleaned.csv', 'w') as f:
-    writer = csv.DictWriter(f, fieldnames=headers)
+
+def write_rows(filenames, f):
+    """Writes the records from each file in turn. Returns the row count."""
+    writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction='ignore')
     writer.writeheader()
-    for row in records:
-        writer.writerow(row)
+    count = 0
+    for name in filenames:
+        for record in read_records(name):
+            writer.writerow(record)
+            count += 1
+    return count
+
+
+def write_sortable_rows(filename):
+    """Parses one log into a temporary CSV whose first column is the epoch
+    time of each row, for merging. Returns the temporary file's name."""
+    to_epoch = EpochParser()
+    fd, tempname = tempfile.mkstemp(prefix='analytics-', suffix='.csv')
+    with os.fdopen(fd, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for record in read_records(filename):
+            row = [to_epoch(record['timestamp'])]
+            row.extend(record.get(field, '') for field in FIELDS)
+            writer.writerow(row)
+    return tempname
+
+
+def write_merged_rows(filenames, f, jobs):
+    """Parses the files on a process pool and then merges their rows into
+    timestamp order. Returns the row count."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        tempnames = list(pool.map(write_sortable_rows, filenames))
+    sources = [open(name, 'r', newline='') for name in tempnames]
+    try:
+        readers = [csv.reader(source) for source in sources]
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        count = 0
+        for row in heapq.merge(*readers, key=lambda row: float(row[0])):
+            writer.writerow(row[1:])
+            count += 1
+    finally:
+        for source in sources:
+            source.close()
+        for name in tempnames:
+            os.remove(name)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts analytics logs to CSV.")
+    parser.add_argument('files', nargs='+', metavar='FILE', help="analytics.log files (optionally gzipped)")
+    parser.add_argument('-o', '--output', default='cleaned.csv', help="CSV file to write (default: cleaned.csv)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="parse this many files at once and merge the rows in timestamp order")
+    args = parser.parse_args()
+
+    with open(args.output, 'w', newline='') as f:
+        if args.jobs > 1:
+            count = write_merged_rows(args.files, f, args.jobs)
+        else:
+            count = write_rows(args.files, f)
+
+    print('Done. Wrote %d records' % count)
+
 
-print('Done. Wrote %d records' % len(records))
+if __name__ == '__main__':
+    main()
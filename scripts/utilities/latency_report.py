@@ -0,0 +1,133 @@
+"""
+Reports latency percentiles per route from analytics.log files.
+
+Each request's time (real= by default; see --column) is added to a sketch for
+its route and hour. Routes are the views from cotracker/urls.py, so every
+/pilots/<username>/ request counts towards "GET PilotDetail". Sketches are
+small and mergeable: files can be scanned in parallel (--jobs), saved with
+--save and combined with the sketches of other days with --load, without the
+original logs. The parser lives in checkouts.analytics, so the cotracker
+directory must be on the PYTHONPATH.
+
+    python latency_report.py [-j JOBS] [--csv hourly.csv] [--save day.json] [--load old.json ...] [FILE ...]
+
+The table shows each route over the whole period; the CSV has a row per route
+and hour, for tracking regressions over time.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import json
+import sys
+
+from checkouts.analytics import LatencySketch, normalize_route, open_log, parse_line
+
+
+DEFAULT_PERCENTILES = [50, 95, 99]
+
+
+def scan(filename, column):
+    """Returns {(route, hour): sketch} for the requests in one log."""
+    sketches = collections.defaultdict(LatencySketch)
+    with open_log(filename) as f:
+        for line in f:
+            record = parse_line(line)
+            if record is None or column not in record:
+                continue
+            route = '%s %s' % (record.get('method'), normalize_route(record.get('path', '')))
+            hour = record['timestamp'][:13] + ':00'
+            sketches[route, hour].add(record[column])
+    return sketches
+
+
+def merge_into(sketches, more):
+    for key, sketch in more.items():
+        if key in sketches:
+            sketches[key].merge(sketch)
+        else:
+            sketches[key] = sketch
+
+
+def load(filename, column):
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    if data['column'] != column:
+        raise SystemExit("%s holds %s sketches, not %s" % (filename, data['column'], column))
+    return {(s['route'], s['hour']): LatencySketch(s['counts'], s['max']) for s in data['sketches']}
+
+
+def save(filename, column, sketches):
+    data = {
+        'column': column,
+        'sketches': [
+            {'route': route, 'hour': hour, 'counts': sketch.to_dict(), 'max': sketch.maximum}
+            for (route, hour), sketch in sorted(sketches.items())
+        ],
+    }
+    with open(filename, 'w') as f:
+        json.dump(data, f)
+
+
+def show_table(sketches, percentiles):
+    routes = collections.defaultdict(LatencySketch)
+    for (route, hour), sketch in sketches.items():
+        routes[route].merge(sketch)
+    header = ['%-32s' % 'route', '%8s' % 'count'] + ['%8s' % ('p%g' % p) for p in percentiles] + ['%8s' % 'max']
+    print(' '.join(header))
+    for route, sketch in sorted(routes.items(), key=lambda item: (-item[1].total, item[0])):
+        row = ['%-32s' % route, '%8d' % sketch.total]
+        row.extend('%8d' % sketch.percentile(p) for p in percentiles)
+        row.append('%8d' % sketch.maximum)
+        print(' '.join(row))
+
+
+def write_series(filename, sketches, percentiles):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['hour', 'route', 'count'] + ['p%g' % p for p in percentiles] + ['max'])
+        for (route, hour), sketch in sorted(sketches.items(), key=lambda item: (item[0][1], item[0][0])):
+            writer.writerow([hour, route, sketch.total] + [sketch.percentile(p) for p in percentiles] + [sketch.maximum])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports latency percentiles per route from analytics logs.")
+    parser.add_argument('files', nargs='*', metavar='FILE', help="analytics.log files (optionally gzipped)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="scan this many files at once")
+    parser.add_argument('--column', default='real', choices=['real', 'queue', 'mw', 'view', 'tpl', 'db'],
+        help="timing to report (default: real)")
+    parser.add_argument('-p', '--percentile', type=float, action='append', dest='percentiles',
+        help="percentile to report (repeatable; default: 50, 95, 99)")
+    parser.add_argument('--csv', help="write an hourly time series to this CSV file")
+    parser.add_argument('--save', help="save the sketches to this JSON file")
+    parser.add_argument('--load', action='append', default=[], metavar='JSON',
+        help="merge in sketches saved by an earlier run (repeatable)")
+    options = parser.parse_args()
+    if not options.files and not options.load:
+        parser.error("nothing to report without log files or --load")
+    percentiles = options.percentiles or DEFAULT_PERCENTILES
+
+    sketches = {}
+    for name in options.load:
+        merge_into(sketches, load(name, options.column))
+    if options.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as pool:
+            for more in pool.map(scan, options.files, [options.column] * len(options.files)):
+                merge_into(sketches, more)
+    else:
+        for name in options.files:
+            merge_into(sketches, scan(name, options.column))
+
+    if not sketches:
+        print("No requests with %s= timings found" % options.column, file=sys.stderr)
+        return
+    show_table(sketches, percentiles)
+    if options.csv:
+        write_series(options.csv, sketches, percentiles)
+    if options.save:
+        save(options.save, options.column, sketches)
+
+
+if __name__ == '__main__':
+    main()
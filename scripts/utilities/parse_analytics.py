@@ -1,136 +1,185 @@
+"""
+Reports on usage patterns found in analytics.log files.
+
+Every selected report is computed during a single streaming pass over the
+logs, so the time taken grows linearly with the size of the logs and memory
+only grows with the number of distinct users, clients, paths and so on.
+Rotated logs may be gzipped. The parser lives in checkouts.analytics, so the
+cotracker directory must be on the PYTHONPATH.
+
+    python parse_analytics.py [-r REPORT [-r REPORT ...]] [FILE [FILE ...]]
+
+Without any files, ./analytics.log is read. Without any reports, all of them
+are shown.
+"""
+
+import argparse
+import collections
 import datetime
 import pprint
+import sys
+
+from checkouts.analytics import TIMESTAMP_FORMAT, open_log, parse_line
+
+
+class Users():
+    """Distinct usernames"""
+    def __init__(self, options):
+        self.usernames = set()
+
+    def add(self, record):
+        self.usernames.add(record.get('username'))
+
+    def show(self):
+        usernames = sorted(u for u in self.usernames if u is not None)
+        print("%d usernames identified" % len(usernames))
+        pprint.pprint(usernames)
+
+
+class Clients():
+    """Request counts per user@ip"""
+    def __init__(self, options):
+        self.clients = collections.Counter()
+
+    def add(self, record):
+        self.clients['%s@%s' % (record.get('username'), record.get('ip'))] += 1
+
+    def show(self):
+        print("%d clients identified" % len(self.clients))
+        pprint.pprint(dict(self.clients))
+
 
-def escape_quoted_spaces(line):
-    in_quote = False
-    replacement = '!@#'
-    new_line = ""
-    for c in line:
-        new_c = c
-        if c == '"':
-            in_quote = not in_quote
-            new_c = ''
-        elif c == ' ' and in_quote:
-            new_c = replacement
-        new_line += new_c
-    return new_line
-
-
-def unescape_quoted_spaces(line):
-    replacement = '!@#'
-    return line.replace(replacement, ' ')
-
-
-def users(parsed):
-    usernames = []
-    for d in parsed:
-        user, ip = d['client'].split('@')
-        if user not in usernames:
-            usernames.append(user)
-    usernames.sort()
-    print("%d usernames identified" % len(usernames))
-    pprint.pprint(usernames)
-
-
-def clients(parsed):
-    clients = {}
-    for d in parsed:
-        count = clients.get(d['client'], 0)
-        clients[d['client']] = count + 1
-    print("%d clients identified" % len(clients))
-    pprint.pprint(clients)
-
-
-def last(parsed):
-    most_recent = {}
-    now = datetime.datetime.now()
-    for d in parsed:
-        user, ip = d['client'].split('@')
-        then = datetime.datetime.strptime(d['timestamp'], '%Y-%m-%dT%H:%M:%S+0000')
-        difference = now - then
-        days_ago = difference.days
-        most_recent[user] = [days_ago, ip]
-    activity = ["%-12s| %3d days ago via %s" % (user, details[0], details[1]) for user, details in most_recent.items()]
-    activity.sort()
-    print("Most recent activity by username:")
-    pprint.pprint(activity)
-
-
-def per_day(parsed):
-    max_days = 30
-    now = datetime.datetime.now()
-    by_day = {}
-    for d in parsed:
-        user, ip = d['client'].split('@')
-        then = datetime.datetime.strptime(d['timestamp'], '%Y-%m-%dT%H:%M:%S+0000')
-        difference = now - then
-        if difference.days <= max_days:
-            day = then.date()
-            current = by_day.get(day, {'users': [], 'ips': []})
-            if user not in current['users']:
-                current['users'].append(user)
-            if ip not in current['ips']:
-                current['ips'].append(ip)
-            by_day[day] = current
-    print("Hits in the past %d days:" % max_days)
-    data = ["%s | %2d users from %2d IPs" % (day.isoformat(), len(stats['users']), len(stats['ips'])) for day, stats in by_day.items()]
-    data.sort()
-    pprint.pprint(data)
-
-
-def useragents(parsed):
-    uas = {}
-    for d in parsed:
-        ua = d['useragent']
-        count = uas.get(ua, 0)
-        uas[ua] = count + 1
-    print("%d useragents identified" % len(uas))
-    pprint.pprint(uas)
-
-
-def statuscodes(parsed):
-    statuses = {}
-    for d in parsed:
-        status = d['status']
-        statuses[status] = statuses.get(status, 0) + 1
-    print("%d status codes identified" % len(statuses))
-    pprint.pprint(statuses)
-
-
-def not_founds(parsed):
-    paths = {}
-    for d in parsed:
-        if d['status'] == '404':
-            path = d['path']
-            paths[path] = paths.get(path, 0) + 1
-    print("Paths with 404 status codes:")
-    pprint.pprint(paths)
-
-
-f = open('analytics.log', 'rb')
-
-lines = f.readlines()
-
-parsed = []
-for line in lines:
-    prefix, keyvalues = line.split(': ')
-    timestamp, _ = prefix.split()
-    keyvalues = escape_quoted_spaces(keyvalues)
-    kvpairs = []
-    for kv in keyvalues.split():
-        kvpairs.append(unescape_quoted_spaces(kv))
-    try:
-        d = dict([s.split('=') for s in kvpairs])
-    except:
-        print("Failed on '%s'" % line)
-        continue
-    d['timestamp'] = timestamp
-    parsed.append(d)
-
-#users(parsed)
-#clients(parsed)
-#useragents(parsed)
-#statuscodes(parsed)
-not_founds(parsed)
-last(parsed)
-per_day(parsed)
+class Useragents():
+    """Request counts per useragent"""
+    def __init__(self, options):
+        self.useragents = collections.Counter()
+
+    def add(self, record):
+        self.useragents[record.get('useragent')] += 1
+
+    def show(self):
+        print("%d useragents identified" % len(self.useragents))
+        pprint.pprint(dict(self.useragents))
+
+
+class StatusCodes():
+    """Request counts per response status"""
+    def __init__(self, options):
+        self.statuses = collections.Counter()
+
+    def add(self, record):
+        self.statuses[record.get('status')] += 1
+
+    def show(self):
+        print("%d status codes identified" % len(self.statuses))
+        pprint.pprint(dict(self.statuses))
+
+
+class NotFounds():
+    """Request counts for each path which returned a 404"""
+    def __init__(self, options):
+        self.paths = collections.Counter()
+
+    def add(self, record):
+        if record.get('status') == '404':
+            self.paths[record.get('path')] += 1
+
+    def show(self):
+        print("Paths with 404 status codes:")
+        pprint.pprint(dict(self.paths))
+
+
+class Last():
+    """Most recent activity for each username"""
+    def __init__(self, options):
+        self.most_recent = {}
+
+    def add(self, record):
+        # The logs are in time order, so later lines replace earlier ones.
+        # Timestamps are only parsed once per user when the report is shown.
+        self.most_recent[record.get('username')] = (record['timestamp'], record.get('ip'))
+
+    def show(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        activity = []
+        for user, (timestamp, ip) in self.most_recent.items():
+            then = datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+            days_ago = (now - then).days
+            activity.append("%-12s| %3d days ago via %s" % (user, days_ago, ip))
+        activity.sort()
+        print("Most recent activity by username:")
+        pprint.pprint(activity)
+
+
+class PerDay():
+    """Distinct users and IPs per day, for recent days"""
+    def __init__(self, options):
+        self.max_days = options.days
+        today = datetime.date.today()
+        # Dates in the log are ISO 8601, so they can be compared as strings
+        self.earliest = (today - datetime.timedelta(days=self.max_days)).isoformat()
+        self.users = collections.defaultdict(set)
+        self.ips = collections.defaultdict(set)
+
+    def add(self, record):
+        day = record['date']
+        if day >= self.earliest:
+            self.users[day].add(record.get('username'))
+            self.ips[day].add(record.get('ip'))
+
+    def show(self):
+        print("Hits in the past %d days:" % self.max_days)
+        data = ["%s | %2d users from %2d IPs" % (day, len(self.users[day]), len(self.ips[day])) for day in self.users]
+        data.sort()
+        pprint.pprint(data)
+
+
+REPORTS = collections.OrderedDict([
+    ('users',       Users),
+    ('clients',     Clients),
+    ('useragents',  Useragents),
+    ('statuscodes', StatusCodes),
+    ('not_founds',  NotFounds),
+    ('last',        Last),
+    ('per_day',     PerDay),
+])
+
+
+def scan(filenames, reports):
+    """Feeds every record in the logs to each of the reports."""
+    adders = [report.add for report in reports]
+    parsed = skipped = 0
+    for name in filenames:
+        with open_log(name) as f:
+            for line in f:
+                record = parse_line(line)
+                if record is None:
+                    skipped += 1
+                    continue
+                parsed += 1
+                for add in adders:
+                    add(record)
+    return parsed, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports on usage patterns in analytics logs.")
+    parser.add_argument('files', nargs='*', metavar='FILE', default=['analytics.log'],
+        help="analytics.log files (optionally gzipped)")
+    parser.add_argument('-r', '--report', action='append', choices=list(REPORTS), dest='reports',
+        help="report to show (may be repeated; default: all)")
+    parser.add_argument('--days', type=int, default=30, help="days covered by the per_day report (default: 30)")
+    options = parser.parse_args()
+
+    names = options.reports or list(REPORTS)
+    reports = [REPORTS[name](options) for name in names]
+    parsed, skipped = scan(options.files, reports)
+    if skipped:
+        print("Skipped %d malformed lines" % skipped, file=sys.stderr)
+    print("Parsed %d requests" % parsed)
+    for report in reports:
+        report.show()
+
+
+if __name__ == '__main__':
+    main()
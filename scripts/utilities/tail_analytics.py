@@ -0,0 +1,224 @@
+"""
+Incrementally ingests analytics.log, picking up where the previous run stopped.
+
+A checkpoint file records, for each log, its inode, how many bytes have been
+consumed, any incomplete last line and its first few bytes. Each run reads
+only the bytes appended since then and passes the new requests on to the
+summaries: a columnar store (see analytics_store.py) and/or a CSV file in the
+analytics_to_csv.py layout.
+
+    python tail_analytics.py [--store DIR] [--csv FILE] [--checkpoint FILE] LOG [LOG ...]
+
+It's meant to be run from cron every minute or so:
+
+    * * * * * cd /srv/cotracker && PYTHONPATH=cotracker python scripts/utilities/tail_analytics.py \\
+        --store analytics-store --checkpoint analytics.checkpoint cotracker/logs/analytics.log
+
+Rotation is noticed by the log's inode changing. The rest of the old file is
+read first if it's still in the same directory under another name (the app's
+handlers leave the newest segment, e.g. analytics.log.20191018T221300,
+uncompressed for this); otherwise a warning is printed, because the tail of
+the old log can't be recovered. The app's handlers only make the new log when
+they next write to it, so until then the old file goes on being read where it
+is. If the file shrinks or its first bytes change without its inode changing
+(copytruncate), it's read again from the start.
+
+Only one run works at a time; an overlapping run exits without doing anything.
+The checkpoint is saved after the summaries have been written, so a run which
+is killed part way through may repeat (but never skip) a minute of requests.
+The parser lives in checkouts.analytics, so the cotracker directory must be on
+the PYTHONPATH.
+"""
+
+import argparse
+import csv
+import fcntl
+import json
+import os
+import sys
+
+from checkouts.analytics import FIELDS, parse_line
+
+from analytics_store import Store
+
+
+CHUNK_BYTES = 1024 * 1024
+# The start of each log is remembered so that a log which was truncated and
+# then refilled past the old offset can still be recognized
+HEAD_BYTES = 64
+
+
+class Checkpoint():
+    """Per-log read positions, stored as JSON"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_file = None
+        self.positions = {}
+
+    def lock(self):
+        """Takes the checkpoint's lock. Returns False if another run holds it."""
+        self.lock_file = open(self.filename + '.lock', 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                self.positions = json.load(f)
+        return True
+
+    def get(self, log):
+        return self.positions.get(os.path.abspath(log))
+
+    def set(self, log, position):
+        self.positions[os.path.abspath(log)] = position
+
+    def unlock(self):
+        self.lock_file.close()
+        self.lock_file = None
+
+    def save(self):
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.positions, f, indent=2, sort_keys=True)
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+def find_rotated(log, inode):
+    """Returns the name of the file beside the log with the given inode, if
+    there is one."""
+    directory = os.path.dirname(os.path.abspath(log))
+    prefix = os.path.basename(log)
+    for entry in list(os.scandir(directory)):
+        if entry.name != prefix and entry.name.startswith(prefix) and entry.inode() == inode:
+            return entry.path
+    return None
+
+
+def read_lines(f, position, final):
+    """Yields the complete lines in the file after the position's offset,
+    advancing the position as it goes. The trailing incomplete line is kept in
+    the position, unless the file is final (i.e. has been rotated away)."""
+    f.seek(position['offset'])
+    pending = position['partial'].encode('utf-8', 'surrogateescape')
+    while True:
+        chunk = f.read(CHUNK_BYTES)
+        if not chunk:
+            break
+        position['offset'] += len(chunk)
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'replace')
+    if final and pending:
+        yield pending.decode('utf-8', 'replace')
+        pending = b''
+    position['partial'] = pending.decode('utf-8', 'surrogateescape')
+
+
+def read_head(f, size):
+    """Returns the first bytes of the file, as hex"""
+    f.seek(0)
+    return f.read(size).hex()
+
+
+def new_lines(log, position, from_end=False):
+    """Yields the lines added to the log since the position (None for a log
+    which hasn't been read before), updating the position in place."""
+    try:
+        f = open(log, 'rb')
+    except FileNotFoundError:
+        # Rotated, with no requests since; the old file may have more lines
+        rotated = find_rotated(log, position['inode']) if position else None
+        if rotated is not None:
+            with open(rotated, 'rb') as old:
+                yield from read_lines(old, position, final=False)
+        return
+    with f:
+        stat = os.fstat(f.fileno())
+        if not position:
+            offset = stat.st_size if from_end else 0
+            position.update(inode=stat.st_ino, offset=offset, partial='', head='')
+        elif position['inode'] != stat.st_ino:
+            rotated = find_rotated(log, position['inode'])
+            if rotated is not None:
+                with open(rotated, 'rb') as old:
+                    yield from read_lines(old, position, final=True)
+            else:
+                print("%s was rotated and the old file can't be found; requests after byte %d "
+                      "of it were missed" % (log, position['offset']), file=sys.stderr)
+            position.update(inode=stat.st_ino, offset=0, partial='', head='')
+        elif (stat.st_size < position['offset']
+                or read_head(f, len(position['head']) // 2) != position['head']):
+            print("%s was truncated; reading it from the start" % log, file=sys.stderr)
+            position.update(offset=0, partial='')
+        yield from read_lines(f, position, final=False)
+        position['head'] = read_head(f, HEAD_BYTES)
+
+
+def new_records(logs, checkpoint, from_end, counts):
+    """Yields the parsed requests added to each of the logs."""
+    for log in logs:
+        position = checkpoint.get(log) or {}
+        for line in new_lines(log, position, from_end):
+            record = parse_line(line)
+            if record is None:
+                counts['skipped'] += 1
+                continue
+            yield record
+        checkpoint.set(log, position)
+
+
+def tapped(records, callback):
+    """Passes each record to the callback on its way through."""
+    for record in records:
+        callback(record)
+        yield record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally ingests analytics logs.")
+    parser.add_argument('logs', nargs='+', metavar='LOG', help="analytics.log files to follow")
+    parser.add_argument('--checkpoint', default='analytics.checkpoint',
+        help="file recording how far each log has been read (default: analytics.checkpoint)")
+    parser.add_argument('--store', help="columnar store directory to append to (see analytics_store.py)")
+    parser.add_argument('--csv', help="CSV file to append rows to")
+    parser.add_argument('--from-end', action='store_true',
+        help="start logs which aren't in the checkpoint from their current end rather than the beginning")
+    options = parser.parse_args()
+    if not options.store and not options.csv:
+        parser.error("nothing to do without --store or --csv")
+
+    checkpoint = Checkpoint(options.checkpoint)
+    if not checkpoint.lock():
+        return
+
+    counts = {'skipped': 0}
+    records = new_records(options.logs, checkpoint, options.from_end, counts)
+    csv_file = None
+    if options.csv:
+        new_csv = not os.path.exists(options.csv) or os.path.getsize(options.csv) == 0
+        csv_file = open(options.csv, 'a', newline='')
+        writer = csv.DictWriter(csv_file, fieldnames=FIELDS, extrasaction='ignore')
+        if new_csv:
+            writer.writeheader()
+        records = tapped(records, writer.writerow)
+    try:
+        if options.store:
+            Store(options.store).append(records)
+        else:
+            for _ in records:
+                pass
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+    checkpoint.save()
+    checkpoint.unlock()
+
+    if counts['skipped']:
+        print("Skipped %d malformed lines" % counts['skipped'], file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Tests for analytics_store.py
+
+Run from this directory with `python -m unittest`. The queries are run both
+with NumPy (if it's installed) and without.
+"""
+
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SITE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(SITE_ROOT, 'cotracker'))
+
+import analytics_store
+
+
+START = datetime.datetime(2019, 8, 1, tzinfo=datetime.timezone.utc).timestamp()
+PATHS = ['/pilots/', '/pilots/kim/', '/airstrips/', '/checkouts/']
+
+
+def record(seconds, real=None, path='/pilots/', status='200', username='kim'):
+    """Returns a request as parse_line would, at the seconds after START."""
+    moment = datetime.datetime.fromtimestamp(START + seconds, datetime.timezone.utc)
+    fields = {
+        'timestamp': moment.strftime('%Y-%m-%dT%H:%M:%S+0000'), 'method': 'GET', 'path': path,
+        'status': status, 'username': username, 'ip': '10.0.0.1', 'useragent': 'None', 'bytes': 100,
+    }
+    if real is not None:
+        fields.update(real=real, queue=real // 10)
+    return fields
+
+
+def shuffled_records(count, seed=0):
+    """Returns requests about a minute apart over several days, each logged
+    up to 5 seconds late, some of them without timings."""
+    generator = random.Random(seed)
+    records = []
+    for i in range(count):
+        records.append(record(
+            i * 61 - generator.randrange(5),
+            real=generator.choice([None] + list(range(1, 500))),
+            path=generator.choice(PATHS),
+            status=generator.choice(['200', '200', '302', '404', '503']),
+            username=generator.choice(['kim', 'sam', '']),
+        ))
+    return records
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def store(self):
+        store = analytics_store.Store(self.directory)
+        self.addCleanup(lambda: [mapped.close() for mapped in store.maps])
+        return store
+
+    def query(self, **kwargs):
+        """Runs the query both with NumPy (if it's installed) and without,
+        checking that the results agree. Returns them."""
+        results = analytics_store.query(self.store(), **kwargs)
+        if analytics_store.numpy is not None:
+            with mock.patch.object(analytics_store, 'numpy', None):
+                self.assertEqual(analytics_store.query(self.store(), **kwargs), results)
+        return results
+
+
+class AppendTests(StoreTestCase):
+
+    def test_append(self):
+        self.assertEqual(self.store().append([record(0, 5), record(1, 7, path='/airstrips/')]), 2)
+        self.assertEqual(self.store().append([record(2, path='/airstrips/', status='-')]), 1)
+
+        store = self.store()
+        self.assertEqual(store.rows, 3)
+        self.assertEqual(list(store.column('real')), [5, 7, analytics_store.MISSING])
+        self.assertEqual(list(store.column('status')), [200, 200, analytics_store.MISSING])
+        self.assertEqual(store.dictionaries['path'], ['/pilots/', '/airstrips/'])
+        self.assertEqual(list(store.column('path')), [0, 1, 1])
+        self.assertEqual(list(store.column('timestamp')), [START, START + 1, START + 2])
+
+    def test_interrupted(self):
+        self.store().append([record(0, 5)])
+
+        def interrupted():
+            yield record(1, 10, path='/airstrips/')
+            yield record(2, 20, path='/airstrips/')
+            raise KeyboardInterrupt
+
+        # A chunk is written before the interruption, but never committed
+        with mock.patch.object(analytics_store, 'CHUNK_ROWS', 2), self.assertRaises(KeyboardInterrupt):
+            self.store().append(interrupted())
+        self.assertEqual(os.path.getsize(self.store().column_filename('real')), 3 * 4)
+        store = self.store()
+        self.assertEqual(store.rows, 1)
+        self.assertEqual(store.dictionaries['path'], ['/pilots/'])
+
+        # The uncommitted rows are discarded by the next append
+        self.store().append([record(3, 30)])
+        store = self.store()
+        self.assertEqual(store.rows, 2)
+        self.assertEqual(list(store.column('real')), [5, 30])
+        self.assertEqual(self.query(percentiles=(0, 100)), [(None, 2, [5, 30])])
+
+    def test_incompatible(self):
+        self.store().append([record(0, 5)])
+        store = self.store()
+        store.meta['byteorder'] = 'big' if sys.byteorder == 'little' else 'little'
+        store.commit(store.rows)
+        with self.assertRaises(ValueError):
+            self.store()
+
+    def test_skew(self):
+        self.store().append([record(0), record(10), record(7)])
+        self.assertEqual(self.store().meta['skew'], 3)
+        # Lateness is measured across appends too
+        self.store().append([record(5), record(20)])
+        self.assertEqual(self.store().meta['skew'], 5)
+
+
+class QueryTests(StoreTestCase):
+
+    def test_percentiles(self):
+        self.store().append([record(i, real) for i, real in enumerate([40, 10, 30, 20, None])])
+        self.assertEqual(self.query(percentiles=(0, 50, 75, 100)), [(None, 4, [10, 20, 30, 40])])
+        self.assertEqual(self.query(column='queue', percentiles=(100,)), [(None, 4, [4])])
+
+    def test_missing_values_are_left_out(self):
+        self.store().append([record(0, 10), record(1), record(2), record(3, 30)])
+        self.assertEqual(self.query(percentiles=(1, 100)), [(None, 2, [10, 30])])
+
+    def test_filters_and_groups(self):
+        self.store().append([
+            record(0, 10, path='/pilots/'), record(1, 20, path='/pilots/kim/'),
+            record(2, 30, path='/airstrips/', status='404'), record(86400, 40, path='/pilots/'),
+        ])
+        self.assertEqual(self.query(filters={'path': ['/pilots/*']}, percentiles=(100,)), [(None, 3, [40])])
+        self.assertEqual(self.query(filters={'status': ['404']}, percentiles=(100,)), [(None, 1, [30])])
+        self.assertEqual(self.query(group_by='path', percentiles=(100,)), [
+            ('/airstrips/', 1, [30]), ('/pilots/', 2, [40]), ('/pilots/kim/', 1, [20])])
+        self.assertEqual(self.query(group_by='day', percentiles=(100,)), [
+            ('2019-08-01', 3, [30]), ('2019-08-02', 1, [40])])
+
+    def test_time_range(self):
+        self.store().append([record(0, 1), record(10, 2), record(20, 3), record(30, 4)])
+        self.assertEqual(self.query(since=START + 10, until=START + 30, percentiles=(0, 100)), [(None, 2, [2, 3])])
+
+    def test_time_range_out_of_order(self):
+        # Logged by several workers, so a little out of order
+        self.store().append([record(0, 1), record(10, 2), record(20, 3), record(14, 4), record(30, 5), record(26, 6)])
+        results = self.query(since=START + 12, until=START + 27, percentiles=(0, 100))
+        self.assertEqual(results, [(None, 3, [3, 6])])
+
+    def test_agrees_with_a_scan(self):
+        records = shuffled_records(2000)
+        self.store().append(records)
+        epochs = [datetime.datetime.strptime(r['timestamp'], '%Y-%m-%dT%H:%M:%S%z').timestamp() for r in records]
+        for since, until in [(None, None), (START + 3600, START + 7200), (START + 40000, None), (None, START + 999)]:
+            expected = sorted(
+                r['real'] for r, epoch in zip(records, epochs)
+                if 'real' in r and (since is None or epoch >= since) and (until is None or epoch < until))
+            with self.subTest(since=since, until=until):
+                count, values = self.query(since=since, until=until, percentiles=(0, 100))[0][1:]
+                self.assertEqual((count, values), (len(expected), [expected[0], expected[-1]]))
+
+    def test_numpy_agrees(self):
+        self.store().append(shuffled_records(2000))
+        for kwargs in [
+            {}, {'group_by': 'path'}, {'group_by': 'hour', 'since': START + 3600, 'until': START + 86400},
+            {'group_by': 'status', 'column': 'queue'}, {'filters': {'user': ['kim', 'sam']}, 'group_by': 'day'},
+        ]:
+            with self.subTest(**kwargs):
+                self.assertTrue(self.query(**kwargs))
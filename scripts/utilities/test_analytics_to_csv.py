@@ -0,0 +1,89 @@
+"""Tests for analytics_to_csv.py
+
+Run from this directory with `python -m unittest`.
+"""
+
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SITE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(SITE_ROOT, 'cotracker'))
+
+import analytics_to_csv
+
+
+def text_line(time, username, path, real):
+    return ('2019-08-01T%s+0000 [1234]: at=INFO client=%s@10.0.0.1 method=GET path=%s queue=1ms real=%dms '
+            'status=200 bytes=1346 useragent="Mozilla/5.0 (X11)"\n' % (time, username, path, real))
+
+
+def json_line(time, username, path, real):
+    return json.dumps({
+        'v': 1, 'timestamp': '2019-08-01T%s+0000' % time, 'pid': 1234, 'level': 'INFO',
+        'username': username, 'ip': '10.0.0.2', 'method': 'POST', 'path': path,
+        'queue': 2, 'real': real, 'status': 302, 'bytes': 0, 'useragent': 'None',
+    }) + '\n'
+
+
+class AnalyticsToCsvTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.logs = {
+            'analytics.log.1.gz': [text_line('11:00:00', 'kim', '/pilots/', 10),
+                                   text_line('11:00:20', 'sam', '/pilots/kim/', 30)],
+            'analytics.log': [json_line('11:00:10', 'kim', '/checkouts/edit/', 20),
+                              'Traceback (most recent call last):\n',
+                              json_line('11:00:30', 'kim', '/pilots/', 40)],
+        }
+        for name, lines in self.logs.items():
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(os.path.join(self.directory, name), 'wt') as f:
+                f.writelines(lines)
+        self.files = [os.path.join(self.directory, name) for name in ('analytics.log.1.gz', 'analytics.log')]
+        self.output = os.path.join(self.directory, 'cleaned.csv')
+
+    def run_main(self, *arguments):
+        """Runs the script over the logs. Returns the CSV's rows, and what was
+        printed to stdout and stderr."""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        arguments = ['analytics_to_csv.py', '-o', self.output] + list(arguments) + self.files
+        with mock.patch.object(sys, 'argv', arguments), \
+                contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            analytics_to_csv.main()
+        with open(self.output, newline='') as f:
+            return list(csv.DictReader(f)), stdout.getvalue(), stderr.getvalue()
+
+    def test_rows(self):
+        rows, stdout, stderr = self.run_main()
+        self.assertEqual(stdout, 'Done. Wrote 4 records\n')
+        self.assertIn('Skipped 1 malformed lines in %s' % self.files[1], stderr)
+        # In the order of the files
+        self.assertEqual([row['real'] for row in rows], ['10', '30', '20', '40'])
+        self.assertEqual(list(rows[0]), analytics_to_csv.FIELDS)
+        self.assertEqual(
+            [rows[1][field] for field in ('date', 'time', 'username', 'ip', 'method', 'path', 'queue', 'status',
+                                          'bytes', 'useragent', 'db')],
+            ['2019-08-01', '11:00:20', 'sam', '10.0.0.1', 'GET', '/pilots/kim/', '1', '200', '1346',
+             'Mozilla/5.0 (X11)', ''])
+        self.assertEqual(
+            [rows[2][field] for field in ('time', 'pid', 'ip', 'method', 'path', 'queue', 'status', 'bytes')],
+            ['11:00:10', '1234', '10.0.0.2', 'POST', '/checkouts/edit/', '2', '302', '0'])
+
+    def test_merged(self):
+        rows, stdout, stderr = self.run_main('--jobs', '2')
+        self.assertEqual(stdout, 'Done. Wrote 4 records\n')
+        # In timestamp order across the files
+        self.assertEqual([row['time'] for row in rows], ['11:00:00', '11:00:10', '11:00:20', '11:00:30'])
+        unmerged = self.run_main()[0]
+        self.assertEqual(sorted(rows, key=lambda row: row['time']), sorted(unmerged, key=lambda row: row['time']))
@@ -0,0 +1,115 @@
+"""Tests for latency_report.py
+
+Run from this directory with `python -m unittest`.
+"""
+
+import contextlib
+import csv
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SITE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(SITE_ROOT, 'cotracker'))
+
+import latency_report
+
+
+LINE = '2019-08-01T%s+0000 [1234]: at=INFO client=kim@10.0.0.1 method=GET path=%s queue=1ms real=%dms db=%dms status=200 bytes=1346 useragent="None"\n'
+# Logged before the timing breakdown, so without db=
+OLD_LINE = '2019-08-01T11:00:00+0000 [1234]: at=INFO client=kim@10.0.0.1 method=GET path=/pilots/ queue=0ms real=5ms status=200 bytes=1346 useragent="None"\n'
+
+
+def line(time, path, real, db=1):
+    return LINE % (time, path, real, db)
+
+
+class LatencyReportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.log = os.path.join(self.directory, 'analytics.log')
+        with open(self.log, 'w') as f:
+            f.write(line('11:49:05', '/pilots/kim/', 40, db=10))
+            f.write(line('11:59:59', '/pilots/sam/', 20, db=8))
+            f.write(line('12:00:00', '/pilots/kim/', 30, db=6))
+            f.write(OLD_LINE)
+            f.write('Traceback (most recent call last):\n')
+        # A rotated segment, compressed
+        self.segment = os.path.join(self.directory, 'analytics.log.1.gz')
+        with gzip.open(self.segment, 'wt') as f:
+            f.write(line('10:00:00', '/airstrips/', 100))
+
+    def run_main(self, *arguments):
+        output = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['latency_report.py'] + list(arguments)), \
+                contextlib.redirect_stdout(output):
+            latency_report.main()
+        return output.getvalue().splitlines()
+
+    def test_scan(self):
+        sketches = latency_report.scan(self.log, 'real')
+        self.assertEqual(sorted(sketches), [
+            ('GET PilotDetail', '2019-08-01T11:00'), ('GET PilotDetail', '2019-08-01T12:00'),
+            ('GET PilotList', '2019-08-01T11:00'),
+        ])
+        hour = sketches['GET PilotDetail', '2019-08-01T11:00']
+        self.assertEqual((hour.total, hour.maximum), (2, 40))
+
+    def test_missing_timings_are_skipped(self):
+        sketches = latency_report.scan(self.log, 'db')
+        # OLD_LINE has no db= timing, so PilotList has no sketch at all
+        self.assertEqual(sorted(route for route, hour in sketches), ['GET PilotDetail', 'GET PilotDetail'])
+        self.assertEqual(sum(sketch.total for sketch in sketches.values()), 3)
+
+    def test_save_and_load(self):
+        sketches = latency_report.scan(self.log, 'real')
+        saved = os.path.join(self.directory, 'day.json')
+        latency_report.save(saved, 'real', sketches)
+        loaded = latency_report.load(saved, 'real')
+        self.assertEqual(
+            {key: (sketch.to_dict(), sketch.maximum) for key, sketch in loaded.items()},
+            {key: (sketch.to_dict(), sketch.maximum) for key, sketch in sketches.items()},
+        )
+        with self.assertRaises(SystemExit):
+            latency_report.load(saved, 'db')
+
+    def test_table(self):
+        rows = [row.split() for row in self.run_main('-p', '50', '-p', '100', self.log, self.segment)]
+        self.assertEqual(rows[0], ['route', 'count', 'p50', 'p100', 'max'])
+        # Busiest route first
+        self.assertEqual(rows[1:], [
+            ['GET', 'PilotDetail', '3', '30', '40', '40'],
+            ['GET', 'AirstripList', '1', '100', '100', '100'],
+            ['GET', 'PilotList', '1', '5', '5', '5'],
+        ])
+
+    def test_series(self):
+        series = os.path.join(self.directory, 'hourly.csv')
+        self.run_main('--column', 'db', '-p', '100', '--csv', series, self.log)
+        with open(series, newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows, [
+            ['hour', 'route', 'count', 'p100', 'max'],
+            ['2019-08-01T11:00', 'GET PilotDetail', '2', '10', '10'],
+            ['2019-08-01T12:00', 'GET PilotDetail', '1', '6', '6'],
+        ])
+
+    def test_jobs_and_saved_sketches_agree(self):
+        expected = self.run_main(self.log, self.segment)
+        self.assertEqual(self.run_main('--jobs', '2', self.log, self.segment), expected)
+        saved = os.path.join(self.directory, 'day.json')
+        self.run_main('--save', saved, self.segment)
+        self.assertEqual(self.run_main('--load', saved, self.log), expected)
+
+    def test_nothing_found(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.assertEqual(self.run_main('--column', 'tpl', self.log), [])
+        self.assertIn('No requests with tpl= timings found', stderr.getvalue())
@@ -0,0 +1,112 @@
+"""Tests for parse_analytics.py
+
+Run from this directory with `python -m unittest`.
+"""
+
+import ast
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SITE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(SITE_ROOT, 'cotracker'))
+
+import parse_analytics
+
+
+# Today's requests are logged at midnight, so they're never in the future
+TODAY = datetime.datetime.now(datetime.timezone.utc).date()
+YESTERDAY = TODAY - datetime.timedelta(days=1)
+LONG_AGO = TODAY - datetime.timedelta(days=60)
+
+
+def text_line(date, username, ip, path, status):
+    return ('%sT11:00:00+0000 [1234]: at=INFO client=%s@%s method=GET path=%s queue=1ms real=10ms '
+            'status=%s bytes=1346 useragent="Mozilla/5.0 (X11)"\n' % (date, username, ip, path, status))
+
+
+def json_line(date, username, ip, path, status):
+    return json.dumps({
+        'v': 1, 'timestamp': '%sT00:00:00+0000' % date, 'pid': 1234, 'level': 'INFO',
+        'username': username, 'ip': ip, 'method': 'GET', 'path': path,
+        'queue': 2, 'real': 20, 'status': status, 'bytes': 0, 'useragent': 'None',
+    }) + '\n'
+
+
+class ParseAnalyticsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        segment = os.path.join(self.directory, 'analytics.log.1.gz')
+        with gzip.open(segment, 'wt') as f:
+            f.write(text_line(LONG_AGO, 'sam', '10.0.0.9', '/pilots/', 200))
+            f.write(text_line(YESTERDAY, 'kim', '10.0.0.1', '/pilots/', 200))
+            f.write(text_line(YESTERDAY, 'sam', '10.0.0.2', '/nowhere/', 404))
+        log = os.path.join(self.directory, 'analytics.log')
+        with open(log, 'w') as f:
+            f.write(json_line(TODAY, 'kim', '10.0.0.3', '/nowhere/', 404))
+            f.write('Traceback (most recent call last):\n')
+            f.write(json_line(TODAY, 'kim', '10.0.0.3', '/checkouts/', 200))
+        self.files = [segment, log]
+
+    def run_main(self, *reports):
+        """Runs the reports over the logs. Returns each line printed to
+        stdout, and what was printed to stderr."""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        arguments = ['parse_analytics.py'] + ['--report=%s' % report for report in reports] + self.files
+        with mock.patch.object(sys, 'argv', arguments), \
+                contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            parse_analytics.main()
+        return stdout.getvalue().splitlines(), stderr.getvalue()
+
+    def report(self, name):
+        """Returns the heading and the (evaluated) data shown by the report."""
+        lines, stderr = self.run_main(name)
+        self.assertEqual(lines[0], 'Parsed 5 requests')
+        self.assertEqual(stderr, 'Skipped 1 malformed lines\n')
+        return lines[1], ast.literal_eval('\n'.join(lines[2:]))
+
+    def test_users(self):
+        self.assertEqual(self.report('users'), ('2 usernames identified', ['kim', 'sam']))
+
+    def test_clients(self):
+        self.assertEqual(self.report('clients'), ('4 clients identified', {
+            'sam@10.0.0.9': 1, 'kim@10.0.0.1': 1, 'sam@10.0.0.2': 1, 'kim@10.0.0.3': 2}))
+
+    def test_status_codes(self):
+        self.assertEqual(self.report('statuscodes'), ('2 status codes identified', {'200': 3, '404': 2}))
+
+    def test_not_founds(self):
+        self.assertEqual(self.report('not_founds'), ('Paths with 404 status codes:', {'/nowhere/': 2}))
+
+    def test_last(self):
+        heading, activity = self.report('last')
+        self.assertEqual(heading, 'Most recent activity by username:')
+        self.assertEqual(len(activity), 2)
+        self.assertRegex(activity[0], r'^kim +\| +0 days ago via 10\.0\.0\.3$')
+        self.assertRegex(activity[1], r'^sam +\| +[01] days ago via 10\.0\.0\.2$')
+
+    def test_per_day(self):
+        # The request from two months ago is too old for the default 30 days
+        self.assertEqual(self.report('per_day'), ('Hits in the past 30 days:', [
+            '%s |  2 users from  2 IPs' % YESTERDAY,
+            '%s |  1 users from  1 IPs' % TODAY,
+        ]))
+
+    def test_all_reports(self):
+        lines, stderr = self.run_main()
+        headings = [line for line in lines if line[0] not in " [{'"]
+        self.assertEqual(headings, [
+            'Parsed 5 requests', '2 usernames identified', '4 clients identified', '2 useragents identified',
+            '2 status codes identified', 'Paths with 404 status codes:', 'Most recent activity by username:',
+            'Hits in the past 30 days:',
+        ])
@@ -0,0 +1,170 @@
+"""Tests for tail_analytics.py
+
+Run from this directory with `python -m unittest`.
+"""
+
+import contextlib
+import csv
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SITE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(SITE_ROOT, 'cotracker'))
+
+import tail_analytics
+
+
+LINE = '2019-08-01T11:49:%02d+0000 [1234]: at=INFO client=kim@10.0.0.1 method=GET path=/pilots/ queue=0ms real=%dms status=200 bytes=1346 useragent="None"\n'
+
+
+def line(n):
+    return LINE % (n, n)
+
+
+class TailTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.log = os.path.join(self.directory, 'analytics.log')
+        self.position = {}
+
+    def append(self, text, log=None):
+        with open(log or self.log, 'a') as f:
+            f.write(text)
+
+    def read(self, **kwargs):
+        """Returns the lines added since the last read, and what was printed
+        to stderr."""
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            lines = list(tail_analytics.new_lines(self.log, self.position, **kwargs))
+        return lines, stderr.getvalue()
+
+    def rotate(self, name='analytics.log.20190801T114900'):
+        rotated = os.path.join(self.directory, name)
+        os.rename(self.log, rotated)
+        return rotated
+
+
+class NewLinesTests(TailTestCase):
+
+    def test_appended(self):
+        self.append(line(1) + line(2))
+        self.assertEqual(self.read(), ([line(1)[:-1], line(2)[:-1]], ''))
+        self.assertEqual(self.read(), ([], ''))
+        self.append(line(3))
+        self.assertEqual(self.read(), ([line(3)[:-1]], ''))
+
+    def test_from_end(self):
+        self.append(line(1))
+        self.assertEqual(self.read(from_end=True), ([], ''))
+        self.append(line(2))
+        self.assertEqual(self.read(), ([line(2)[:-1]], ''))
+
+    def test_partial_line(self):
+        self.append(line(1) + line(2)[:20])
+        self.assertEqual(self.read()[0], [line(1)[:-1]])
+        self.assertEqual(self.position['partial'], line(2)[:20])
+        self.append(line(2)[20:])
+        self.assertEqual(self.read()[0], [line(2)[:-1]])
+        self.assertEqual(self.position['partial'], '')
+
+    def test_rotated(self):
+        self.append(line(1))
+        self.read()
+        # Written before the rotation, but after the last read
+        self.append(line(2) + line(3)[:20])
+        self.rotate()
+        self.append(line(4))
+        # The rest of the old file comes first, its incomplete line too
+        self.assertEqual(self.read(), ([line(2)[:-1], line(3)[:20], line(4)[:-1]], ''))
+        self.assertEqual(self.position['inode'], os.stat(self.log).st_ino)
+
+    def test_rotated_away(self):
+        self.append(line(1))
+        self.read()
+        self.append(line(2))
+        # e.g. compressed, somewhere else (kept, so its inode isn't reused)
+        os.mkdir(os.path.join(self.directory, 'old'))
+        os.rename(self.rotate(), os.path.join(self.directory, 'old', 'analytics.log.1'))
+        self.append(line(3))
+        lines, warning = self.read()
+        self.assertEqual(lines, [line(3)[:-1]])
+        self.assertIn('was rotated', warning)
+
+    def test_not_yet_recreated(self):
+        self.append(line(1))
+        self.read()
+        rotated = self.rotate()
+        # Until the next request the log doesn't exist, and the old file is
+        # read where it is, keeping its position
+        self.append(line(2) + line(3)[:20], rotated)
+        self.assertEqual(self.read(), ([line(2)[:-1]], ''))
+        self.assertEqual(self.position['inode'], os.stat(rotated).st_ino)
+        self.assertEqual(self.position['partial'], line(3)[:20])
+        self.append(line(4))
+        self.assertEqual(self.read(), ([line(3)[:20], line(4)[:-1]], ''))
+
+    def test_missing(self):
+        self.assertEqual(self.read(), ([], ''))
+        self.assertEqual(self.position, {})
+
+    def test_truncated(self):
+        self.append(line(1) + line(2))
+        self.read()
+        with open(self.log, 'w') as f:
+            f.write(line(3))
+        lines, warning = self.read()
+        self.assertEqual(lines, [line(3)[:-1]])
+        self.assertIn('truncated', warning)
+
+    def test_truncated_and_refilled(self):
+        self.append(line(1))
+        self.read()
+        # Copied and truncated, then written past the old offset
+        with open(self.log, 'w') as f:
+            f.write(line(2).replace('2019', '2020') + line(3))
+        lines, warning = self.read()
+        self.assertEqual(lines, [line(2).replace('2019', '2020')[:-1], line(3)[:-1]])
+        self.assertIn('truncated', warning)
+
+
+class CheckpointTests(TailTestCase):
+
+    def test_save_and_lock(self):
+        filename = os.path.join(self.directory, 'analytics.checkpoint')
+        checkpoint = tail_analytics.Checkpoint(filename)
+        self.assertTrue(checkpoint.lock())
+        checkpoint.set(self.log, {'inode': 1, 'offset': 2, 'partial': '', 'head': ''})
+        checkpoint.save()
+        # Only one run works at a time
+        self.assertFalse(tail_analytics.Checkpoint(filename).lock())
+        checkpoint.unlock()
+
+        checkpoint = tail_analytics.Checkpoint(filename)
+        self.assertTrue(checkpoint.lock())
+        self.addCleanup(checkpoint.unlock)
+        self.assertEqual(checkpoint.get(self.log)['offset'], 2)
+
+    def test_main(self):
+        checkpoint = os.path.join(self.directory, 'analytics.checkpoint')
+        output = os.path.join(self.directory, 'analytics.csv')
+        arguments = ['tail_analytics.py', '--checkpoint', checkpoint, '--csv', output, self.log]
+        self.append(line(1) + 'Traceback (most recent call last):\n')
+        stderr = io.StringIO()
+        with mock.patch.object(sys, 'argv', arguments), contextlib.redirect_stderr(stderr):
+            tail_analytics.main()
+        self.assertIn('Skipped 1 malformed lines', stderr.getvalue())
+        self.append(line(2))
+        with mock.patch.object(sys, 'argv', arguments):
+            tail_analytics.main()
+
+        with open(output, newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row['real'] for row in rows], ['1', '2'])